@@ -1,14 +1,43 @@
 import sys
 import re
 import os
+import time
+import fcntl
 import struct
+import mmap
+import csv
+import json
+import zlib
+import lzma
+import signal
+import socket
+import socketserver
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
 from hashlib import sha1
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from os import path
 from datetime import datetime
+from itertools import islice, repeat
 from uuid import UUID
 
+np = None  # NumPy, imported by load_numpy for stats and the numpy verify engine only
+
 BLOCKCHAIN_PATH = os.getenv("BCHOC_FILE_PATH", default="blockchain.bin")
+# When appended blocks are flushed to disk: never ("none"), before every append returns ("block") or at
+# most FSYNC_INTERVAL seconds after them ("batch"), BCHOC_FSYNC=1 is the older spelling of "block"
+DURABILITY_POLICIES = ("none", "block", "batch")
+DURABILITY = os.getenv("BCHOC_DURABILITY", default="block" if os.getenv("BCHOC_FSYNC") == "1" else "none")
+if DURABILITY not in DURABILITY_POLICIES:
+    DURABILITY = "block"  # An unknown policy gets the safest one
+FSYNC_INTERVAL = 1.0
+SOCKET_PATH = os.getenv("BCHOC_SOCKET", default=BLOCKCHAIN_PATH + ".sock")  # Socket of bchoc serve
+USE_DAEMON = os.getenv("BCHOC_DAEMON", default="0") == "1"  # Run commands through bchoc serve when it is up
+DAEMON_TIMEOUT = float(os.getenv("BCHOC_DAEMON_TIMEOUT", default="600"))  # Seconds to wait for a daemon reply
+GROUP_COMMIT = float(os.getenv("BCHOC_GROUP_COMMIT", default="0")) / 1000  # Group commit window in seconds, 0 is off
 STATES = {
     "INITIAL": b"INITIAL\0\0\0\0",
     "CHECKEDIN": b"CHECKEDIN\0\0",
@@ -17,441 +46,598 @@ STATES = {
     "DESTROYED": b"DESTROYED\0\0",
     "RELEASED": b"RELEASED\0\0\0",
 }
+REMOVED_STATES = (STATES["DISPOSED"], STATES["RELEASED"], STATES["DESTROYED"])
+VALID_STATES = set(STATES.values())
 Block = namedtuple("Block", ["prev_hash", "timestamp", "case_id", "evidence_id", "state", "d_length", "data"])
 BLOCK_FORMAT = "20s d 16s I 11s I"  # Format for byte padding in the struct
 BLOCK_LEN = struct.calcsize(BLOCK_FORMAT)  # Length of a block. Should be 68
 BLOCK_STRUCT = struct.Struct(BLOCK_FORMAT)  # Actual block struct
+# Single fields of a block and where they start, for reading them without unpacking the whole block
+TIMESTAMP_STRUCT = struct.Struct("d")
+TIMESTAMP_POSITION = struct.calcsize("20s d") - TIMESTAMP_STRUCT.size
+CASE_STRUCT = struct.Struct("16s")
+CASE_POSITION = struct.calcsize("20s d")
+EVIDENCE_STRUCT = struct.Struct("I")
+EVIDENCE_POSITION = struct.calcsize("20s d 16s")
+STATE_STRUCT = struct.Struct("11s")
+STATE_POSITION = struct.calcsize("20s d 16s I")
+LENGTH_STRUCT = struct.Struct("I")
+LENGTH_POSITION = BLOCK_LEN - LENGTH_STRUCT.size
+# The same header as a NumPy structured array record, with the native padding of BLOCK_FORMAT, and the
+# state field as an 8 byte head and the 4 bytes after it, set by load_numpy
+BLOCK_DTYPE = None
+STATE_WORDS_DTYPE = None
+# State codes, used by block arrays and state tables: the position of a state in STATES, or UNKNOWN (the
+# last code) for a state that isn't valid, which reads back as bytes(11)
+STATE_NAMES = list(STATES) + ["UNKNOWN"]
+STATE_VALUES = [*STATES.values(), bytes(11)]
+STATE_CODES = {state: code for code, state in enumerate(STATES.values())}
+VerifiedChunk = namedtuple(
+    "VerifiedChunk",
+    [
+        "valid",
+        "block_count",
+        "first_parent",
+        "last_hash",
+        "last_offset",
+        "end",
+        "orphan_parents",
+        "first_states",
+        "last_states",
+        "offsets",  # of the blocks walked, when the states are left to check_state_array
+    ],
+)
+# Sidecar records holding the chain tail and the latest known state of every evidence item
+TAIL_PATH = BLOCKCHAIN_PATH + ".tail"
+TAIL_STRUCT = struct.Struct("<Q Q 20s")  # chain size, tail offset, tail hash
+INDEX_PATH = BLOCKCHAIN_PATH + ".idx"
+INDEX_MAGIC = b"BCI2"
+INDEX_HEADER_STRUCT = struct.Struct("<4s Q Q 20s")  # magic, chain size, tail offset, tail hash
+INDEX_ENTRY_STRUCT = struct.Struct("<I 16s 11s Q")  # evidence id, case id, state, block offset
+INDEX_JOURNAL_LIMIT = 4096  # Records appended after the state table before the index is rewritten
+# A serialized StateTable: the item and case counts, then its id, case, offset and state arrays and the
+# case ids
+STATE_TABLE_HEADER_STRUCT = struct.Struct("<Q Q")
+STATE_TABLE_MERGE = 4096  # Items added to a state table before they are merged into its sorted arrays
+# Bytes of torn final blocks cut off the chain by recovery, kept for inspection
+TORN_PATH = BLOCKCHAIN_PATH + ".torn"
+# Sidecar array with the start offset of every block, in chain order
+OFFSETS_PATH = BLOCKCHAIN_PATH + ".off"
+OFFSETS_MAGIC = b"BCO2"
+OFFSETS_HEADER_STRUCT = struct.Struct("<4s Q 20s d ? 7x")  # magic, chain size, tail hash, last time, times sorted
+OFFSETS_BATCH = 4096  # Number of offsets read at once when walking the chain backward
+# Sidecar posting lists with the block offsets of every case id and evidence id, kept sorted for binary
+# search, blocks appended since the last compaction are listed unsorted in a journal at the end of the file
+POSTINGS_PATH = BLOCKCHAIN_PATH + ".pst"
+POSTINGS_MAGIC = b"BCP1"
+POSTINGS_HEADER_STRUCT = struct.Struct("<4s Q 20s Q Q")  # magic, chain size, tail hash, case postings, item postings
+CASE_POSTING_STRUCT = struct.Struct("<16s Q")  # case id, block offset
+ITEM_POSTING_STRUCT = struct.Struct("<I Q")  # evidence id, block offset
+JOURNAL_POSTING_STRUCT = struct.Struct("<16s I Q")  # case id, evidence id, block offset
+POSTINGS_JOURNAL_LIMIT = 4096  # Journal records kept before the postings are compacted
+# Sidecar checkpoint of the last clean verify
+CHECKPOINT_PATH = BLOCKCHAIN_PATH + ".chk"
+CHECKPOINT_MAGIC = b"BCC2"
+CHECKPOINT_HEADER_STRUCT = struct.Struct("<4s Q Q 20s Q")  # magic, verified size, tail offset, tail hash, blocks
+# Segmented storage, see Segments: the size the blockchain file is cut at (0 keeps the chain in a single
+# file) and the directories segment files are looked up in, the blockchain's own first, then those of
+# BCHOC_SEGMENT_PATH (separated like PATH) that older segments may be moved to
+SEGMENT_SIZE = int(os.getenv("BCHOC_SEGMENT_SIZE", default="0"))
+SEGMENT_DIRS = [path.dirname(BLOCKCHAIN_PATH) or "."]
+SEGMENT_DIRS += [directory for directory in os.getenv("BCHOC_SEGMENT_PATH", default="").split(os.pathsep) if directory]
+MANIFEST_PATH = BLOCKCHAIN_PATH + ".seg"
+MANIFEST_MAGIC = b"BCS1"
+MANIFEST_HEADER_STRUCT = struct.Struct("<4s Q")  # magic, segment count
+# start offset, size, block count, last block offset, parent of the first block, first and last block hashes,
+# earliest and latest timestamps, sealed
+SEGMENT_STRUCT = struct.Struct("<Q Q Q Q 20s 20s 20s d d ? 7x")
+Segment = namedtuple(
+    "Segment",
+    [
+        "start",
+        "size",
+        "block_count",
+        "last_offset",
+        "parent_hash",
+        "first_hash",
+        "last_hash",
+        "first_time",
+        "last_time",
+        "sealed",
+    ],
+)
+# Archives of segments, see Archives: the file name extension of an archive, the size frames are cut at and
+# the decompressed frames kept by a reader
+ARCHIVE_EXTENSION = ".bca"
+ARCHIVE_MAGIC = b"BCA1"
+ARCHIVE_HEADER_STRUCT = struct.Struct("<4s B 7x Q Q 20s")  # magic, compression, segment size, frames, segment sha1
+FRAME_STRUCT = struct.Struct("<Q Q Q")  # segment offset, file offset and compressed size of a frame
+ARCHIVE_COMPRESSIONS = ("zlib", "lzma")  # Compression of an archive, stored as the position in this tuple
+ARCHIVE_FRAME_SIZE = 1 << 16
+ARCHIVE_CACHE_FRAMES = 16
+IndexEntry = namedtuple("IndexEntry", ["state", "case_id", "offset"])
+NewBlock = namedtuple("NewBlock", ["evidence_id", "case_id", "state", "offset", "timestamp"])  # A block just appended
+# Results of the ChainOfCustody engine, case ids are uuids and states are names
+CustodyAction = namedtuple("CustodyAction", ["case_id", "item_id", "state", "timestamp", "owner"])
+LogEntry = namedtuple("LogEntry", ["case_id", "item_id", "state", "timestamp"])
+ItemStatus = namedtuple("ItemStatus", ["case_id", "item_id", "state", "offset"])  # offset of the latest block
+LogPage = namedtuple("LogPage", ["entries", "total"])  # LogEntry tuples of one page, number of matching blocks
+VerifyResult = namedtuple("VerifyResult", ["block_count", "verified_count"])  # all blocks, blocks hashed this run
+ChainStats = namedtuple(
+    "ChainStats",
+    [
+        "block_count",
+        "item_count",
+        "item_states",  # state name: items whose latest block is in that state
+        "case_items",  # case id: items whose latest block belongs to that case
+        "month_actions",  # "YYYY-MM" (UTC): {state name: blocks}
+        "checkout_count",
+        "checkout_seconds",  # time spent CHECKEDOUT, until now for items still out
+        "longest_checkout",
+    ],
+)
+BatchResult = namedtuple("BatchResult", ["line_number", "action", "item_id", "state", "error"])  # error or None
+# A segment file or archive, or the blockchain file as the last, active segment, hashes are hex and None when
+# it's empty
+SegmentInfo = namedtuple(
+    "SegmentInfo",
+    [
+        "number",
+        "path",
+        "block_count",
+        "first_hash",
+        "last_hash",
+        "first_time",
+        "last_time",
+        "sealed",
+        "size",
+        "stored_size",  # bytes of the file, less than size when it's an archive
+        "compression",  # of an archive, None for a plain file
+    ],
+)
+# Output formats of log, and the fields written by the machine-readable ones
+LOG_FORMATS = ("text", "jsonl", "csv")
+LOG_FIELDS = ("case_id", "item_id", "action", "time", "timestamp")
+LOG_FLUSH_BLOCKS = 4096  # Blocks formatted before each write to stdout
+LOG_SORTS = ("time", "case", "item")  # Orders log_page can page through
+VERIFY_ENGINES = ("python", "numpy")  # How verify checks the evidence states, see ChainOfCustody.verify
+PROGRESS_STEP = 1 << 20  # Bytes scanned between two calls of a progress callback
+
+# Chain daemon messages, a length then JSON, and the engine methods it serves
+MESSAGE_HEADER_STRUCT = struct.Struct("!I")
+DAEMON_COMMANDS = (
+    "init",
+    "add",
+    "checkout",
+    "checkin",
+    "remove",
+    "batch",
+    "lookup",
+    "log",
+    "iter_log",
+    "log_page",
+    "verify",
+    "stats",
+    "segments",
+    "archive",
+    "expand",
+)  # Engine methods served, the engine serializes its own writes
+
+BATCH_FIELDS = {"add": ["case_id"], "remove": ["reason", "owner"]}  # Csv columns after action,item_id
+# Commands that write the chain, only these cut a torn final block off it first, see ChainOfCustody.recover
+WRITE_COMMANDS = ("add", "checkout", "checkin", "remove", "init", "batch", "archive", "expand", "serve")
 
 
 def main():
     if len(sys.argv) < 2:
         print_menu()
-    else:
+        return
+    chain = None
+    if USE_DAEMON and sys.argv[1] != "serve":
+        try:
+            chain = RemoteChain()
+        except OSError:
+            pass  # No daemon running, work on the chain directly
+    if chain is None:
+        chain = ChainOfCustody()
+    try:
+        if isinstance(chain, ChainOfCustody) and sys.argv[1] in WRITE_COMMANDS:
+            recovered = chain.recover()
+            if recovered is not None:
+                print(
+                    "Recovered blockchain: cut a torn block of %d bytes at offset %d, saved to %s"
+                    % (recovered[1], recovered[0], TORN_PATH),
+                    file=sys.stderr,
+                )
+        elif isinstance(chain, ChainOfCustody):
+            torn = chain.torn_tail()
+            if torn is not None:  # Reading commands never cut, they stop before reading a half block
+                print(
+                    "Error: blockchain ends in a torn block of %d bytes at offset %d, the next write will cut it"
+                    % (torn[1], torn[0]),
+                    file=sys.stderr,
+                )
+                sys.exit(1)
         if sys.argv[1] == "add":
-            add()
+            add(chain)
         elif sys.argv[1] == "checkout":
-            checkout()
+            checkout(chain)
         elif sys.argv[1] == "checkin":
-            checkin()
+            checkin(chain)
         elif sys.argv[1] == "log":
-            log()
+            log(chain)
         elif sys.argv[1] == "remove":
-            remove()
+            remove(chain)
         elif sys.argv[1] == "init":
-            if len(sys.argv) > 2:
-                sys.exit(1)
-            else:
-                init()
+            init(chain)
         elif sys.argv[1] == "verify":
-            if len(sys.argv) > 2:
-                sys.exit(1)
-            else:
-                verify()
+            verify(chain)
+        elif sys.argv[1] == "batch":
+            batch(chain)
+        elif sys.argv[1] == "status":
+            status(chain)
+        elif sys.argv[1] == "stats":
+            stats(chain)
+        elif sys.argv[1] == "segments":
+            segments(chain)
+        elif sys.argv[1] == "archive":
+            archive(chain)
+        elif sys.argv[1] == "expand":
+            expand(chain)
+        elif sys.argv[1] == "serve":
+            serve(chain)
         else:
             print_menu()
-
-
-# add new evidence item to the blockchain, associate with case id (-c case)
-# more than one item id may be given at a time (using -i), new state = "CHECKEDIN"
-def add():
-    # Parse cli arguments
-    arguments = " ".join(sys.argv[1:])
-    add_regex = r"((-i\s\w+)|(-c\s([^\s]+)))"
-    add_args = re.findall(add_regex, arguments)
-    case_id = None
-    item_ids = []
-    for match in add_args:
-        if match[0][0:2] == "-c":
-            if case_id is None:
-                case_id = match[0][3:]
-            else:  # Only allowed to have one case id
-                sys.exit(1)
-        elif match[0][0:2] == "-i":
-            if match[0][3:0] not in item_ids:
-                item_ids.append(int(match[0][3:]))
-    # If no item_ids have been provided, case id is not a valid uuid-v4, exit
-    if len(item_ids) < 1 or case_id is None:
+    except CustodyError:
         sys.exit(1)
-    else:
-        try:
-            case_id = UUID(case_id, version=4)
-        except ValueError:
-            sys.exit(1)
-    # Iterate of the blockchain to check if item ids already exist somewhere
-    global BLOCKCHAIN_PATH
-    last_block_hash = None
-    if path.exists(BLOCKCHAIN_PATH):
-        with open(BLOCKCHAIN_PATH, "rb") as blockchain:
-            block_bytes = blockchain.read(BLOCK_LEN)  # Parse the block
-            while block_bytes:
-                block = BLOCK_STRUCT.unpack(block_bytes)  # Unpack the block itself
-                block_data = blockchain.read(block[5])  # Get already unpacked data
-                last_block_hash = sha1(block_bytes + block_data)
-                if block[3] in item_ids:  # if item already exists, terminate
-                    blockchain.close()
-                    sys.exit(1)
-                block_bytes = blockchain.read(BLOCK_LEN)  # Parse the block
-        blockchain.close()
-    else:
-        # Open a new blockchain file
-        with open(BLOCKCHAIN_PATH, "wb") as blockchain:
-            # Create a struct format
-            initial_block = Block(
-                prev_hash=0,
-                timestamp=datetime.utcnow().timestamp(),
-                case_id=UUID(int=0),
-                evidence_id=0,
-                state=STATES["INITIAL"],
-                d_length=14,
-                data=b"Initial block\0",
-            )
-            # Pack this struct into a padded binary block
-            initial_block_packed = BLOCK_STRUCT.pack(
-                initial_block.prev_hash.to_bytes(20, byteorder="little"),
-                initial_block.timestamp,
-                initial_block.case_id.int.to_bytes(16, byteorder="little"),
-                initial_block.evidence_id,
-                initial_block.state,
-                len(initial_block.data),
-            )
-            last_block_hash = sha1(initial_block_packed + initial_block.data)
-            # Write block and data separately
-            blockchain.write(initial_block_packed)
-            blockchain.write(initial_block.data)
-            blockchain.close()
-            print(
-                "Blockchain file not found. Created INITIAL block.",
-                "\nCase:",
-                initial_block.case_id,
-                "\nAdded item:",
-                initial_block.evidence_id,
-                "\n  Status:",
-                initial_block.state.decode("utf-8").rstrip("\x00"),
-                "\n  Time of action:",
-                datetime.utcnow().isoformat() + "Z",
-            )
-    # Check for duplicate item ids
-    with open(BLOCKCHAIN_PATH, "rb") as blockchain:
-        block_bytes = blockchain.read(BLOCK_LEN)  # Parse the block
-        while block_bytes:
-            block = BLOCK_STRUCT.unpack(block_bytes)  # Unpack the block itself
-            blockchain.read(block[5])  # We done care b+out data so just skip it
-            if block[3] in item_ids:
-                sys.exit(1)
-            block_bytes = blockchain.read(BLOCK_LEN)  # Parse the block
-    blockchain.close()
+    except OSError as error:
+        print("Error:", error, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        chain.close()
 
-    # Create new blocks from provided info
-    if last_block_hash is not None:
-        with open(BLOCKCHAIN_PATH, "ab") as blockchain:
-            print("Case:", case_id)
-            for item in item_ids:
-                # Pack block to be saved, and write it
-                block = Block(
-                    prev_hash=last_block_hash.digest(),
-                    timestamp=datetime.utcnow().timestamp(),
-                    case_id=case_id,
-                    evidence_id=int(item),
-                    state=STATES["CHECKEDIN"],
-                    d_length=0,
-                    data=b"\0",
-                )
-                try:
-                    packed_block = BLOCK_STRUCT.pack(
-                        block.prev_hash,
-                        block.timestamp,
-                        block.case_id.int.to_bytes(16, byteorder="little"),
-                        block.evidence_id,
-                        block.state,
-                        0,
-                    )
-                    blockchain.write(packed_block)
-                    if block.d_length > 0:
-                        blockchain.write(block.data)
-                except Exception:
-                    sys.exit(1)
-                # Print obtained data
-                print(
-                    "Added item:",
-                    item,
-                    "\n  Status:",
-                    STATES["CHECKEDIN"].decode("utf-8").rstrip("\x00"),
-                    "\n  Time of action:",
-                    datetime.utcnow().isoformat() + "Z",
-                )
-                # Save hash for next iteration
-                last_block_hash = sha1(packed_block)
-            blockchain.close()
 
+# ---- Command line ----
+# Every command parses its arguments, runs on the ChainOfCustody engine and prints the result.
+# Errors raised by the engine are turned into exit code 1 by main.
 
-# add new checkout entry, can only be performed on items already added to blockchain
-def checkout():
-    # Parse cli arguments
-    arguments = " ".join(sys.argv[1:])
-    checkout_regex = r"(-i\s\w+)"
-    checkout_args = re.findall(checkout_regex, arguments)
-    item_id = None
-    if len(checkout_args) != 1:  # User must provide exactly one -i argument
-        sys.exit(1)
-    else:
-        item_id = int(checkout_args[0][3:])
-    # Read through the blockchain to find the last block with this item id
-    last_found_block = None
-    last_block_hash = None
-    global BLOCKCHAIN_PATH
-    if path.exists(BLOCKCHAIN_PATH):
-        with open(BLOCKCHAIN_PATH, "rb") as blockchain:
-            block_bytes = blockchain.read(BLOCK_LEN)  # Parse the block
-            while block_bytes:
-                block = BLOCK_STRUCT.unpack(block_bytes)  # Unpack the block itself
-                block_data = blockchain.read(block[5])  # Get already unpacked data
-                last_block_hash = sha1(block_bytes + block_data)
-                if block[3] == item_id:  # if item already exists, terminate
-                    last_found_block = block
-                block_bytes = blockchain.read(BLOCK_LEN)  # Parse the block
-        blockchain.close()
-    # if no blocks have been found, there's nothing to checkout
-    if last_block_hash is None or last_found_block is None or last_found_block[4] != STATES["CHECKEDIN"]:
-        sys.exit(1)
-    else:
-        # Create an updated block and write it
-        block = Block(
-            prev_hash=last_block_hash.digest(),
-            timestamp=datetime.utcnow().timestamp(),
-            case_id=UUID(int=int.from_bytes(last_found_block[2], byteorder="little")),
-            evidence_id=last_found_block[3],
-            state=STATES["CHECKEDOUT"],
-            d_length=0,
-            data=b"\0",
-        )
-        with open(BLOCKCHAIN_PATH, "ab") as blockchain:
-            block_packed = BLOCK_STRUCT.pack(
-                block.prev_hash,
-                block.timestamp,
-                block.case_id.int.to_bytes(16, byteorder="little"),
-                block.evidence_id,
-                block.state,
-                block.d_length,
-            )
-            # Write block and data separately
-            blockchain.write(block_packed)
-            blockchain.close()
+
+# add new evidence item to the blockchain, associate with case id (-c case)
+# more than one item id may be given at a time (using -i), new state = "CHECKEDIN"
+def add(chain):
+    arguments = parse_command("add", " ".join(sys.argv[2:]))
+    created = not path.exists(BLOCKCHAIN_PATH)
+    actions = chain.add(**arguments)
+    if created:
         print(
-            "Case:",
-            block.case_id,
+            "Blockchain file not found. Created INITIAL block.",
+            "\nCase:",
+            UUID(int=0),
             "\nAdded item:",
-            block.evidence_id,
+            0,
+            "\n  Status:",
+            "INITIAL",
+            "\n  Time of action:",
+            datetime.utcnow().isoformat() + "Z",
+        )
+    print("Case:", actions[0].case_id)
+    for action in actions:
+        print(
+            "Added item:",
+            action.item_id,
             "\n  Status:",
-            block.state.decode("utf-8").rstrip("\x00"),
-            "\n  Time:",
-            datetime.fromtimestamp(block.timestamp).isoformat(),
+            action.state,
+            "\n  Time of action:",
+            datetime.utcnow().isoformat() + "Z",
         )
 
 
+# add new checkout entry, can only be performed on items already added to blockchain
+def checkout(chain):
+    action = chain.checkout(**parse_command("checkout", " ".join(sys.argv[2:])))
+    print(
+        "Case:",
+        action.case_id,
+        "\nAdded item:",
+        action.item_id,
+        "\n  Status:",
+        action.state,
+        "\n  Time:",
+        datetime.fromtimestamp(action.timestamp).isoformat(),
+    )
+
+
 # add new checkin entry, can only be performed on item already added to the blockchain
 # "-i" determines the item id to be checked in after it is added
-def checkin():
-    # Parse cli arguments to obtain id, or determine if the function call is invalid
-    arguments = " ".join(sys.argv[1:])
-    checkin_regex = r"(-i\s\w+)"
-    checkin_args = re.findall(checkin_regex, arguments)
-    item_id = None
-    if len(checkin_args) != 1:  # User must provide exactly one -i argument
-        sys.exit(1)
+def checkin(chain):
+    action = chain.checkin(**parse_command("checkin", " ".join(sys.argv[2:])))
+    print(
+        "Case:",
+        action.case_id,
+        "\nAdded item:",
+        action.item_id,
+        "\n  Status:",
+        action.state,
+        "\n  Time of action:",
+        datetime.fromtimestamp(action.timestamp).isoformat(),
+    )
+
+
+# Display blockchain oldest to newest (unless -r is given for reverse), see ChainOfCustody.iter_log
+def log(chain):
+    arguments = " ".join(sys.argv[2:])
+    output_format = "text"
+    format_match = re.search(r"--format\s([^\s]+)", arguments)
+    if format_match is not None:
+        if format_match.group(1) not in LOG_FORMATS:
+            raise InvalidArgumentError("unknown format %s" % format_match.group(1))
+        output_format = format_match.group(1)
+    filters = parse_command("log", arguments)
+    if not path.exists(BLOCKCHAIN_PATH):
+        chain.init()
+        print("Blockchain file not found. Created INITIAL block.")
+    try:
+        write_blocks(chain.iter_log(**filters), output_format)
+    except ChainError as error:
+        print("Error:", error, file=sys.stderr)
+        raise
+
+
+# prevent further action on a given evidence, item must be "CHECKEDIN"
+# changes the tag of the evidence to "RELEASED", "DESTROYED", or "DISPOSED"
+def remove(chain):
+    action = chain.remove(**parse_command("remove", " ".join(sys.argv[2:])))
+    print(
+        "Case:",
+        action.case_id,
+        "\nRemoved item:",
+        action.item_id,
+        "\n  Status:",
+        action.state,
+        "\n  Owner info:",
+        "" if action.owner is None else action.owner,
+        "\n  Time of action:",
+        datetime.fromtimestamp(action.timestamp),
+    )
+
+
+# starts up or checks for initial block
+def init(chain):
+    parse_command("init", " ".join(sys.argv[2:]))
+    if chain.init():
+        print("Blockchain file not found. Created INITIAL block.")
     else:
-        item_id = int(checkin_args[0][3:])
-    # Read through the blockchain to find the last block with this item id
-    last_found_block = None
-    last_block_hash = None
-    global BLOCKCHAIN_PATH
-    if path.exists(BLOCKCHAIN_PATH):
-        with open(BLOCKCHAIN_PATH, "rb") as blockchain:
-            block_bytes = blockchain.read(BLOCK_LEN)  # Parse the block
-            while block_bytes:
-                block = BLOCK_STRUCT.unpack(block_bytes)  # Unpack the block itself
-                block_data = blockchain.read(block[5])  # Get already unpacked data
-                last_block_hash = sha1(block_bytes + block_data)
-                if block[3] == item_id:  # if item already exists, terminate
-                    last_found_block = block
-                block_bytes = blockchain.read(BLOCK_LEN)  # Parse the block
-        blockchain.close()
-    # if no blocks have been found, there's nothing to checkout
-    if last_block_hash is None or last_found_block is None or last_found_block[4] != STATES["CHECKEDOUT"]:
-        sys.exit(1)
+        print("Blockchain file found with INITIAL block.")
+
+
+# apply a stream of custody operations read from a file (-f path) or stdin in one invocation, see
+# ChainOfCustody.batch for the format, the outcome of every line is reported
+def batch(chain):
+    arguments = " ".join(sys.argv[2:])
+    batch_regex = r"(-f\s([^\s]+))"
+    batch_args = re.findall(batch_regex, arguments)
+    if len(batch_args) > 1 or len(re.sub(batch_regex, "", arguments).strip()) > 0:
+        raise InvalidArgumentError("batch takes at most one -f file")
+    if not path.exists(BLOCKCHAIN_PATH):
+        raise ChainError("blockchain not found")
+    if len(batch_args) == 1:
+        try:
+            lines = open(batch_args[0][1], "r", newline="").readlines()
+        except OSError:
+            raise InvalidArgumentError("cannot read %s" % batch_args[0][1])
     else:
-        # Create an updated block and write it
-        block = Block(
-            prev_hash=last_block_hash.digest(),
-            timestamp=datetime.utcnow().timestamp(),
-            case_id=UUID(int=int.from_bytes(last_found_block[2], byteorder="little")),
-            evidence_id=last_found_block[3],
-            state=STATES["CHECKEDIN"],
-            d_length=0,
-            data=b"\0",
+        lines = sys.stdin.readlines()
+    results = chain.batch(lines)
+    failed = 0
+    for result in results:
+        if result.error is None:
+            print("Line %d: %s item %d -> %s" % (result.line_number, result.action, result.item_id, result.state))
+        else:
+            print("Line %d: ERROR %s" % (result.line_number, result.error))
+            failed += 1
+    print("Applied:", len(results) - failed, "\nFailed:", failed)
+    if failed > 0:
+        sys.exit(1)
+
+
+# show the latest state of an item, "-i" determines the item id
+def status(chain):
+    try:
+        item_status = chain.lookup(**parse_command("status", " ".join(sys.argv[2:])))
+    except ChainError as error:
+        print("Error:", error, file=sys.stderr)
+        raise
+    print("Case:", item_status.case_id, "\nItem:", item_status.item_id, "\n  Status:", item_status.state)
+
+
+# print the compliance report aggregates of the whole chain, see ChainOfCustody.stats
+def stats(chain):
+    parse_command("stats", " ".join(sys.argv[2:]))
+    try:
+        result = chain.stats()
+    except CustodyError as error:
+        print("Error:", error, file=sys.stderr)
+        raise
+    print("Transactions in blockchain:", result.block_count)
+    print("Items:", result.item_count)
+    print("Items per state:")
+    for state, count in result.item_states.items():
+        print("  %s: %d" % (state, count))
+    print("Items per case:")
+    for case_id, count in result.case_items.items():
+        print("  %s: %d" % (case_id, count))
+    print("Blocks per month:")
+    for month, actions in result.month_actions.items():
+        print("  %s: %s" % (month, ", ".join("%s %d" % action for action in actions.items())))
+    print("Checkouts:", result.checkout_count)
+    if result.checkout_count > 0:
+        print(
+            "  Time checked out: %.1fs (mean %.1fs, longest %.1fs)"
+            % (result.checkout_seconds, result.checkout_seconds / result.checkout_count, result.longest_checkout)
         )
-        with open(BLOCKCHAIN_PATH, "ab") as blockchain:
-            block_packed = BLOCK_STRUCT.pack(
-                block.prev_hash,
-                block.timestamp,
-                block.case_id.int.to_bytes(16, byteorder="little"),
-                block.evidence_id,
-                block.state,
-                block.d_length,
+
+
+# list the segments of the blockchain, see ChainOfCustody.segments
+def segments(chain):
+    parse_command("segments", " ".join(sys.argv[2:]))
+    try:
+        result = chain.segments()
+    except CustodyError as error:
+        print("Error:", error, file=sys.stderr)
+        raise
+    for segment in result:
+        print(
+            "Segment %d: %s\n  Blocks: %d\n  Sealed: %s"
+            % (segment.number, segment.path, segment.block_count, "yes" if segment.sealed else "no")
+        )
+        if segment.block_count > 0:
+            print("  First block: %s\n  Last block: %s" % (segment.first_hash, segment.last_hash))
+            print(
+                "  Time: %sZ to %sZ"
+                % tuple(
+                    datetime.fromtimestamp(time).isoformat(timespec="microseconds")
+                    for time in (segment.first_time, segment.last_time)
+                )
             )
-            # Write block and data separately
-            blockchain.write(block_packed)
-            blockchain.close()
+        if segment.compression is not None:
+            print("  Archived: %d of %d bytes (%s)" % (segment.stored_size, segment.size, segment.compression))
+
+
+# compress old segments into archives, see ChainOfCustody.archive
+def archive(chain):
+    arguments = parse_command("archive", " ".join(sys.argv[2:]))
+    try:
+        result = chain.archive(**arguments)
+    except CustodyError as error:
+        print("Error:", error, file=sys.stderr)
+        raise
+    if len(result) == 0:
+        print("No segments to archive")
+    for segment in result:
         print(
-            "Case:",
-            block.case_id,
-            "\nAdded item:",
-            block.evidence_id,
-            "\n  Status:",
-            block.state.decode("utf-8").rstrip("\x00"),
-            "\n  Time of action:",
-            datetime.fromtimestamp(block.timestamp).isoformat(),
+            "Archived segment %d: %s\n  %d of %d bytes (%s)"
+            % (segment.number, segment.path, segment.stored_size, segment.size, segment.compression)
         )
 
 
-# Display blockchain oldest to newest (unless -r is given for reverse)
-def log():
-    # Parse cli arguments
-    arguments = " ".join(sys.argv[1:])
-    log_regex = r"((-i|-n)\s\w+|-r|--reverse|(-c\s([^\s]+)))"
-    log_args = re.finditer(log_regex, arguments)
-    reverse = False
-    number_of_items = 0
-    case_ids = []
-    item_ids = []
-    for match in log_args:
-        groups = match.groups()
-        if groups[0] == "-r" or groups[0] == "--reverse":
-            reverse = True
-        elif groups[1] == "-n":
-            number_of_items = int(groups[0][3:])
-        elif groups[0][0:2] == "-c":
-            if groups[3] not in case_ids:
-                try:
-                    case_ids.append(UUID(groups[3], version=4))
-                except Exception:
-                    sys.exit(1)
-        elif groups[1] == "-i":
-            if groups[0][3:] not in item_ids:
-                item_ids.append(int(groups[0][3:]))
-    # Obtain blocks for later analysis
-    all_blocks = []
-    global BLOCKCHAIN_PATH
-    if path.exists(BLOCKCHAIN_PATH):
-        with open(BLOCKCHAIN_PATH, "rb") as blockchain:
-            block_bytes = blockchain.read(BLOCK_LEN)  # Parse the block
-            while block_bytes:
-                block = BLOCK_STRUCT.unpack(block_bytes)  # Unpack the block itself
-                if (
-                    (len(case_ids) == 0 and len(item_ids) == 0 and block not in all_blocks)
-                    or (len(case_ids) == 0 and block[3] in item_ids and block not in all_blocks)
-                    or (
-                        len(item_ids) == 0
-                        and UUID(int=int.from_bytes(block[2], byteorder="little")) in case_ids
-                        and block not in all_blocks
-                    )
-                    or (
-                        block[3] in item_ids
-                        and UUID(int=int.from_bytes(block[2], byteorder="little")) in case_ids
-                        and block not in all_blocks
-                    )
-                ):
-                    all_blocks.append(block)
-                blockchain.read(block[5])  # We done care b+out data so just skip it
-                block_bytes = blockchain.read(BLOCK_LEN)  # Parse the block
-        blockchain.close()
+# restore archived segments, see ChainOfCustody.expand
+def expand(chain):
+    arguments = parse_command("expand", " ".join(sys.argv[2:]))
+    try:
+        result = chain.expand(**arguments)
+    except CustodyError as error:
+        print("Error:", error, file=sys.stderr)
+        raise
+    if len(result) == 0:
+        print("No archived segments")
+    for segment in result:
+        print("Expanded segment %d: %s" % (segment.number, segment.path))
+
+
+# parse blockchain and validate all entries, see ChainOfCustody.verify
+def verify(chain):
+    arguments = parse_command("verify", " ".join(sys.argv[2:]))
+    if not path.exists(BLOCKCHAIN_PATH):
+        print("Transactions in blockchain: 0")
+        return
+    try:
+        result = chain.verify(**arguments)
+    except ChainError as error:
+        if error.bad_block is None:
+            print("Error:", error, file=sys.stderr)
+        if error.block_count is not None:
+            print("Transactions in blockchain:", error.block_count)
+        if error.bad_block is not None and error.parent_block is None:
+            print("State of blockchain: ERROR", "\nBad block:", error.bad_block.hex(), "\nParent block: NOT FOUND")
+        elif error.bad_block is not None:
+            print(
+                "State of blockchain: ERROR",
+                "\nBad block:",
+                error.bad_block.hex(),
+                "\nParent block:",
+                error.parent_block.hex(),
+                "\nTwo blocks found with same parent.",
+            )
+        sys.exit(1)
+    print("Transactions in blockchain:", result.block_count)
+    print("State of blockchain: CLEAN")
+
+
+# ---- Argument parsing ----
+# Turn the command line arguments of a command into the keyword arguments of its ChainOfCustody method,
+# shared by the command line and the GUI.
+
+
+# parse the arguments of command, raises InvalidArgumentError when they can't be understood
+def parse_command(command, arguments):
+    if command == "add":
+        parser = parse_add
+    elif command == "checkout" or command == "checkin" or command == "status":
+        parser = parse_item
+    elif command == "log":
+        parser = parse_log
+    elif command == "remove":
+        parser = parse_remove
+    elif command == "init":
+        parser = parse_init
+    elif command == "verify":
+        parser = parse_verify
+    elif command == "stats":
+        parser = parse_stats
+    elif command == "segments":
+        parser = parse_segments
+    elif command == "archive":
+        parser = parse_archive
+    elif command == "expand":
+        parser = parse_expand
     else:
-        # Open a new blockchain file
-        blockchain = open(BLOCKCHAIN_PATH, "ab")
-        # Create a struct format
-        initial_block = Block(
-            prev_hash=0,
-            timestamp=datetime.utcnow().timestamp(),
-            case_id=UUID(int=0),
-            evidence_id=0,
-            state=STATES["INITIAL"],
-            d_length=14,
-            data=b"Initial block\0",
-        )
-        all_blocks.append(initial_block)
-        # Pack this struct into a padded binary block
-        initial_block_packed = BLOCK_STRUCT.pack(
-            initial_block.prev_hash.to_bytes(20, byteorder="little"),
-            initial_block.timestamp,
-            initial_block.case_id.int.to_bytes(16, byteorder="little"),
-            initial_block.evidence_id,
-            initial_block.state,
-            len(initial_block.data),
-        )
-        # Write block and data separately
-        blockchain.write(initial_block_packed)
-        blockchain.write(initial_block.data)
-        blockchain.close()
-        print("Blockchain file not found. Created INITIAL block.")
-    # If -n param was not given, determine the max amount
-    if number_of_items == 0:
-        number_of_items = len(all_blocks)
-    # Print out results according to provided params
-    if len(all_blocks) > 0:
-        if reverse:
-            for block in reversed(all_blocks):
-                if number_of_items == 0:
-                    break
-                else:
-                    print("Case:", UUID(int=int.from_bytes(block[2], byteorder="little")))
-                    print("Item:", block[3])
-                    print("Action:", block[4].decode("utf-8").rstrip("\x00"))
-                    print("Time:", datetime.fromtimestamp(block[1]).strftime("%Y-%m-%dT%H:%M:%S.%f") + "Z")
-                    number_of_items -= 1
-                    if number_of_items != 0:
-                        print()
-        else:
-            for block in all_blocks:
-                if number_of_items == 0:
-                    break
-                else:
-                    print("Case:", UUID(int=int.from_bytes(block[2], byteorder="little")))
-                    print("Item:", block[3])
-                    print("Action:", block[4].decode("utf-8").rstrip("\x00"))
-                    print("Time:", datetime.fromtimestamp(block[1]).strftime("%Y-%m-%dT%H:%M:%S.%f") + "Z")
-                    number_of_items -= 1
-                    if number_of_items != 0:
-                        print()
+        raise InvalidArgumentError("unknown command %s" % command)
+    try:
+        return parser(arguments)
+    except ValueError as error:
+        raise InvalidArgumentError(str(error))
 
 
-# prevent further action on a given evidence, item must be "CHECKEDIN"
-# changes the tag of the evidence to "RELEASED", "DESTROYED", or "DISPOSED"
-def remove():
-    # Find -o params and fix the quote encapsulated string
+# -c case_id -i item_id [-i item_id ...]
+def parse_add(arguments):
+    case_id = None
+    item_ids = []
+    for match in re.findall(r"((-i\s\w+)|(-c\s([^\s]+)))", arguments):
+        if match[0][0:2] == "-c":
+            if case_id is not None:  # Only allowed to have one case id
+                raise InvalidArgumentError("only one case id may be given")
+            case_id = match[0][3:]
+        elif match[0][0:2] == "-i":
+            item_ids.append(int(match[0][3:]))
+    if len(item_ids) < 1 or case_id is None:
+        raise InvalidArgumentError("a case id and at least one item id are required")
+    return {"case_id": case_id, "item_ids": item_ids}
+
+
+# -i item_id, for checkout, checkin and status
+def parse_item(arguments):
+    item_args = re.findall(r"(-i\s\w+)", arguments)
+    if len(item_args) != 1:  # User must provide exactly one -i argument
+        raise InvalidArgumentError("exactly one item id is required")
+    return {"item_id": int(item_args[0][3:])}
+
+
+# -i item_id -y reason [-o owner]
+def parse_remove(arguments):
     # Shell removes the quotes when parsing arguments, but keeps the whole string as a single param
-    # for index, argument in enumerate(sys.argv):
-    #    if argument == "-o":
-    #        sys.argv[index + 1] = '"%s"' % (sys.argv[index + 1])
-
-    # Parse params
-    arguments = " ".join(sys.argv[1:])
-    # remove_regex = r"((-i|-y|--why)\s\w+|(-o\s\"(.*?)\"))"
-    remove_regex = r"((-i|-y|--why)\s\w+|(-o\s(.*\w+)))"
-    remove_args = re.finditer(remove_regex, arguments)
     item_id = None
     reason = None
     owner = None
-    for match in remove_args:
+    for match in re.finditer(r"((-i|-y|--why)\s\w+|(-o\s(.*\w+)))", arguments):
         groups = match.groups()
         if groups[1] == "-i":
-            if item_id is None:
-                item_id = int(groups[0][3:])
-            else:
-                sys.exit(1)
+            if item_id is not None:
+                raise InvalidArgumentError("only one item id may be given")
+            item_id = int(groups[0][3:])
         elif groups[1] == "-y":
-            if reason is None:
-                reason = groups[0][3:]
-            else:
-                sys.exit(1)
+            if reason is not None:
+                raise InvalidArgumentError("only one reason may be given")
+            reason = groups[0][3:]
         elif groups[1] == "--why":
             if reason is None:
                 reason = groups[0][6:]
@@ -459,215 +645,2949 @@ def remove():
             owner = groups[3]
     # Group index needs to be fixed because it can contain parts of another param
     if owner is not None:
-        possible_indexes = []
-        try:
-            possible_indexes.append(owner.index("-y"))
-        except ValueError:
-            pass
-        try:
-            possible_indexes.append(owner.index("--why"))
-        except ValueError:
-            pass
-        try:
-            possible_indexes.append(owner.index("-i"))
-        except ValueError:
-            pass
+        possible_indexes = [owner.index(flag) for flag in ("-y", "--why", "-i") if flag in owner]
         if len(possible_indexes) > 0:
             owner = owner[0 : min(possible_indexes)]  # noqa: E203
-    # This needs a list of item ids, and a reason
-    # Reason format must be one of the three
-    # If reason is RELEASED, owned must be specified
-    if (
-        (item_id is None or reason is None)
-        or (reason != "DISPOSED" and reason != "DESTROYED" and reason != "RELEASED")
-        or (reason == "RELEASED" and owner is None)
+    if item_id is None or reason is None:
+        raise InvalidArgumentError("an item id and a reason are required")
+    return {"item_id": item_id, "reason": reason, "owner": owner}
+
+
+# [-r] [-n num_entries] [-c case_id] [-i item_id] [-s state] [--since time] [--until time]
+def parse_log(arguments):
+    filters = {
+        "reverse": False,
+        "limit": 0,
+        "case_ids": set(),
+        "item_ids": set(),
+        "states": set(),
+        "since": None,
+        "until": None,
+    }
+    for option, value in re.findall(r"(--since|--until)\s([^\s]+)", arguments):
+        filters[option[2:]] = datetime.fromisoformat(value.rstrip("Z")).timestamp()
+    for match in re.finditer(r"((-i|-n|-s)\s\w+|-r|--reverse|(-c\s([^\s]+)))", arguments):
+        groups = match.groups()
+        if groups[0] == "-r" or groups[0] == "--reverse":
+            filters["reverse"] = True
+        elif groups[1] == "-n":
+            filters["limit"] = int(groups[0][3:])
+        elif groups[0][0:2] == "-c":
+            filters["case_ids"].add(UUID(groups[3], version=4))
+        elif groups[1] == "-i":
+            filters["item_ids"].add(int(groups[0][3:]))
+        elif groups[1] == "-s":
+            if groups[0][3:] not in STATES:
+                raise InvalidArgumentError("unknown state %s" % groups[0][3:])
+            filters["states"].add(groups[0][3:])
+    return filters
+
+
+# init takes no arguments
+def parse_init(arguments):
+    if len(arguments.strip()) > 0:
+        raise InvalidArgumentError("init takes no arguments")
+    return {}
+
+
+# no arguments
+def parse_stats(arguments):
+    if len(arguments.strip()) > 0:
+        raise InvalidArgumentError("stats takes no arguments")
+    return {}
+
+
+# no arguments
+def parse_segments(arguments):
+    if len(arguments.strip()) > 0:
+        raise InvalidArgumentError("segments takes no arguments")
+    return {}
+
+
+# [-n num_segments] [--lzma] [--cut]
+def parse_archive(arguments):
+    archive_regex = r"(-n\s\d+|--lzma|--cut)"
+    archive_args = re.findall(archive_regex, arguments)
+    if len(re.sub(archive_regex, "", arguments).strip()) > 0:
+        raise InvalidArgumentError("unknown archive arguments")
+    count = parse_expand(" ".join(match for match in archive_args if match[0:2] == "-n"))["count"]
+    compression = "lzma" if "--lzma" in archive_args else "zlib"
+    return {"count": count, "compression": compression, "cut": "--cut" in archive_args}
+
+
+# [-n num_segments]
+def parse_expand(arguments):
+    count_args = re.findall(r"-n\s(\d+)", arguments)
+    if len(re.sub(r"-n\s\d+", "", arguments).strip()) > 0 or len(count_args) > 1:
+        raise InvalidArgumentError("unknown segment arguments")
+    if len(count_args) == 0:
+        return {"count": None}
+    if int(count_args[0]) < 1:
+        raise InvalidArgumentError("at least one segment is required")
+    return {"count": int(count_args[0])}
+
+
+# [--full] [--jobs num_jobs] [--engine python|numpy]
+def parse_verify(arguments):
+    verify_regex = r"(--full|--jobs\s\d+|--engine\s\w+)"
+    verify_args = re.findall(verify_regex, arguments)
+    if len(re.sub(verify_regex, "", arguments).strip()) > 0:
+        raise InvalidArgumentError("unknown verify arguments")
+    jobs = 1
+    engine = "python"
+    for match in verify_args:
+        if match[0:6] == "--jobs":
+            jobs = int(match[7:])
+        elif match[0:8] == "--engine":
+            engine = match[9:]
+            if engine not in VERIFY_ENGINES:
+                raise InvalidArgumentError("unknown engine %s" % engine)
+    if jobs < 1:
+        raise InvalidArgumentError("at least one job is required")
+    return {"full": "--full" in verify_args, "jobs": jobs, "engine": engine}
+
+
+# turn a json or csv batch line into a dict with action, item_id and the fields of that action
+# json values are type checked, item_id is an integer or a string of digits, the other fields are strings
+def parse_batch_line(line):
+    if line.lstrip().startswith("{"):
+        operation = json.loads(line)
+        if not isinstance(operation, dict):
+            raise ValueError("operation must be an object")
+        for field in ["action", "item_id", "case_id", "reason", "owner"]:
+            value = operation.get(field)
+            if field == "item_id" and (isinstance(value, bool) or not isinstance(value, (int, str, type(None)))):
+                raise InvalidArgumentError("item_id must be an integer")
+            if field != "item_id" and not isinstance(value, (str, type(None))):
+                raise InvalidArgumentError("%s must be a string" % field)
+        return operation
+    values = [value.strip() for value in next(csv.reader([line]))]
+    fields = ["action", "item_id"] + BATCH_FIELDS.get(values[0], [])
+    return {field: value for field, value in zip(fields, values) if value != ""}
+
+
+# ---- Chain of custody engine ----
+# ChainOfCustody runs the custody commands in process. It keeps the latest-state index, the chain
+# tail and an append handle open between calls and only reloads them when the chain changed on disk.
+# Methods return namedtuples and raise CustodyError subclasses instead of exiting.
+# The scanning methods (log, iter_log and verify) take an optional progress(scanned, total) callback,
+# called every PROGRESS_STEP bytes with the chain offset reached and the chain size. The callback may
+# raise CancelledError to stop the scan, which releases the chain map on the way out.
+
+
+class CustodyError(Exception):
+    pass
+
+
+# arguments that are missing, malformed or out of range
+class InvalidArgumentError(CustodyError):
+    pass
+
+
+# the item was never added to the blockchain
+class ItemNotFoundError(CustodyError):
+    pass
+
+
+# the item is already in the blockchain
+class DuplicateItemError(CustodyError):
+    pass
+
+
+# the item is not in the state the action requires
+class InvalidStateError(CustodyError):
+    pass
+
+
+# a progress callback stopped the operation
+class CancelledError(CustodyError):
+    pass
+
+
+# the blockchain is missing, unreadable or failed verification
+# block_count, bad_block and parent_block are set when verify found a broken link
+class ChainError(CustodyError):
+    def __init__(self, message, block_count=None, bad_block=None, parent_block=None):
+        super().__init__(message)
+        self.block_count = block_count
+        self.bad_block = bad_block
+        self.parent_block = parent_block
+
+
+# blocks validated and chained onto each other in memory, waiting to be appended with a single write
+class PendingBlocks:
+    def __init__(self, chain_size, tail_hash):
+        self.chain_size = chain_size
+        self.prev_hash = tail_hash
+        self.tail_hash = tail_hash
+        self.buffer = bytearray()
+        self.new_entries = []
+        self.entries = {}  # Index entries of the items the pending blocks changed
+
+    # chain a block onto the last pending one
+    def push(self, evidence_id, case_id, state, data=b""):
+        timestamp = datetime.utcnow().timestamp()
+        block_packed = pack_block(self.tail_hash, timestamp, case_id, evidence_id, state, data)
+        offset = self.chain_size + len(self.buffer)
+        self.buffer += block_packed
+        self.tail_hash = sha1(block_packed).digest()
+        self.entries[evidence_id] = IndexEntry(state, case_id, offset)
+        self.new_entries.append(NewBlock(evidence_id, case_id, state, offset, timestamp))
+        return timestamp
+
+
+# a single item operation waiting in the group commit queue for the thread leading the next group
+class QueuedOperation:
+    def __init__(self, operation):
+        self.operation = operation  # The arguments of ChainOfCustody.stage after pending
+        self.done = threading.Event()
+        self.lead = False  # Set with done cleared when this thread has to lead the next group
+        self.result = None
+        self.error = None
+
+
+# Writes hold an advisory lock on the blockchain file from validation to append, so any number of
+# processes (and threads, through mutex) can write to the same chain and it stays valid. With a group
+# commit window, single item operations queued within the window are validated and appended together
+# with one write and one fsync by whichever waiting thread leads the group.
+class ChainOfCustody:
+    def __init__(self, group_commit=GROUP_COMMIT, durability=DURABILITY, segment_size=SEGMENT_SIZE):
+        self.blockchain = None  # Append handle, opened by the first write and locked around each write
+        self.mutex = threading.Lock()  # Serializes the threads using the index in memory
+        self.entries = None
+        self.chain_size = 0
+        self.tail_hash = None
+        self.chain_stat = None
+        self.group_commit = group_commit
+        self.group_mutex = threading.Lock()
+        self.group_queue = []
+        self.group_leading = False
+        self.durability = durability
+        self.unsynced = False  # Appends not flushed to disk yet, with the "batch" policy
+        self.sync_timer = None
+        self.segment_size = segment_size
+        self.cut_error = None  # Why the last cut of the active segment failed, reported once
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.sync_timer is not None:
+            self.sync_timer.cancel()
+            self.sync_timer = None
+        if self.blockchain is not None:
+            if self.unsynced:
+                os.fsync(self.blockchain.fileno())
+                self.unsynced = False
+            self.blockchain.close()
+            self.blockchain = None
+
+    # flush the appends the "batch" policy left unsynced, run by the sync timer
+    def sync(self):
+        with self.mutex:
+            self.sync_timer = None
+            if self.unsynced and self.blockchain is not None:
+                os.fsync(self.blockchain.fileno())
+            self.unsynced = False
+
+    # cut a torn final block, left by a crash in the middle of an append, off the chain, and finish a cut of
+    # the blockchain file into a segment that was interrupted the same way, see find_torn_tail
+    # only for commands that write, a chain this process can't write is left as it is so it can still be read
+    # returns the offset and the size of the bytes cut, or None when the chain ended on a block boundary
+    def recover(self):
+        if not path.exists(BLOCKCHAIN_PATH) or path.getsize(BLOCKCHAIN_PATH) == 0:
+            return None
+        if not os.access(BLOCKCHAIN_PATH, os.W_OK):
+            return None
+        with self.locked():
+            if is_last_segment(self.blockchain, load_manifest()):
+                self.replace(replace_blockchain())
+                return None
+            return recover_tail(self.blockchain)
+
+    # the offset and size of the torn final block recover would cut, or None, without changing the chain
+    def torn_tail(self):
+        if not path.exists(BLOCKCHAIN_PATH):
+            return None
+        return find_torn_tail()
+
+    # create the blockchain with its INITIAL block, or check that an existing one starts with it
+    # returns True when the blockchain was created
+    def init(self):
+        if not path.exists(BLOCKCHAIN_PATH) or path.getsize(BLOCKCHAIN_PATH) == 0:
+            with self.locked(create=True):
+                # Another process may have created it while this one waited for the lock, or it may have
+                # just been cut into a segment
+                if os.fstat(self.blockchain.fileno()).st_size == 0 and len(load_manifest()) == 0:
+                    initial_block = pack_block(
+                        bytes(20), datetime.utcnow().timestamp(), bytes(16), 0, STATES["INITIAL"], b"Initial block\0"
+                    )
+                    append_blocks(initial_block, self.blockchain)
+                    return True
+        try:
+            blocks = iter_blocks()
+            _, initial_block, _ = next(blocks)
+            blocks.close()
+        except (StopIteration, struct.error, OSError, ValueError):
+            raise ChainError("blockchain has no INITIAL block")
+        if initial_block[4] != STATES["INITIAL"]:
+            raise ChainError("blockchain has no INITIAL block")
+        return False
+
+    # add new items to case_id in state CHECKEDIN, creating the blockchain if needed
+    # nothing is written unless every item can be added, returns a CustodyAction per item
+    def add(self, case_id, item_ids):
+        item_ids = list(dict.fromkeys(item_ids))
+        if len(item_ids) == 0:
+            raise InvalidArgumentError("at least one item id is required")
+        case_bytes(case_id)  # Validate the arguments before the blockchain is created
+        for item_id in item_ids:
+            check_item_id(item_id)
+        self.init()
+        with self.locked():
+            pending = self.begin()
+            actions = [self.stage(pending, "add", item_id, case_id) for item_id in item_ids]
+            self.commit(pending)
+        return actions
+
+    # check out a CHECKEDIN item, returns a CustodyAction
+    def checkout(self, item_id):
+        return self.apply("checkout", item_id)
+
+    # check in a CHECKEDOUT item, returns a CustodyAction
+    def checkin(self, item_id):
+        return self.apply("checkin", item_id)
+
+    # remove a CHECKEDIN item for reason DISPOSED, DESTROYED or RELEASED (which needs the owner)
+    # returns a CustodyAction
+    def remove(self, item_id, reason, owner=None):
+        return self.apply("remove", item_id, reason=reason, owner=owner)
+
+    # the latest state of an item, straight from the index in memory, returns an ItemStatus
+    def lookup(self, item_id):
+        with self.mutex:
+            self.begin()
+            entry = self.entries.get(item_id)
+        if entry is None:
+            raise ItemNotFoundError("item %d not found" % item_id)
+        return ItemStatus(case_uuid(entry.case_id), item_id, decode_state(entry.state), entry.offset)
+
+    # the blocks matching the filters as LogEntry tuples, see iter_log
+    def log(
+        self, reverse=False, limit=0, case_ids=(), item_ids=(), states=(), since=None, until=None, progress=None
     ):
-        sys.exit(1)
-    last_found_block = None
-    last_block_hash = None
-    global BLOCKCHAIN_PATH
-    if path.exists(BLOCKCHAIN_PATH):
-        with open(BLOCKCHAIN_PATH, "rb") as blockchain:
-            block_bytes = blockchain.read(BLOCK_LEN)  # Parse the block
-            while block_bytes:
-                block = BLOCK_STRUCT.unpack(block_bytes)  # Unpack the block itself
-                block_data = blockchain.read(block[5])  # Get already unpacked data
-                last_block_hash = sha1(block_bytes + block_data)
-                if block[3] == item_id:  # if item already exists, terminate
-                    last_found_block = block
-                block_bytes = blockchain.read(BLOCK_LEN)  # Parse the block
-        blockchain.close()
-    # if no blocks have been found, there's nothing to checkout
-    if last_block_hash is None or last_found_block is None or last_found_block[4] != STATES["CHECKEDIN"]:
-        sys.exit(1)
-    else:
-        # Create an updated block and write it
-        data_length = 0
-        original_owner = None
-        if owner is None:
-            original_owner = ""
-            owner = b"\0"
+        blocks = self.iter_log(reverse, limit, case_ids, item_ids, states, since, until, progress)
+        return (LogEntry(case_uuid(block[2]), block[3], decode_state(block[4]), block[1]) for _, block, _ in blocks)
+
+    # the count blocks at position start of the log sorted by time (chain order), case or item, for
+    # showing a log one page at a time, returns a LogPage
+    # without filters a page is read straight from the offset index or from the sorted posting lists,
+    # so its cost doesn't depend on the position or on the size of the chain, cases are grouped in the
+    # order of their stored bytes, with case and item filters the matching offsets are sorted first
+    def log_page(self, start, count, reverse=False, sort="time", case_ids=(), item_ids=()):
+        if sort not in LOG_SORTS:
+            raise InvalidArgumentError("unknown sort %s" % sort)
+        if start < 0 or count < 0:
+            raise InvalidArgumentError("a page can't start or count below 0")
+        case_ids = {case_bytes(case_id) for case_id in case_ids}
+        item_ids = set(item_ids)
+        if len(case_ids) > 0 or len(item_ids) > 0:
+            offsets = lookup_postings(case_ids, item_ids)
+            if offsets is None:
+                predicate = compile_filter(case_ids, item_ids, set(), None, None)
+                offsets = [offset for offset, _, _ in iter_blocks(predicate=predicate)]
+            if sort != "time":
+                offsets = sort_offsets(offsets, sort)
+            total = len(offsets)
+            if reverse:
+                offsets.reverse()
+            blocks = iter_blocks_at(offsets[start : start + count])  # noqa: E203
+        elif sort == "time":
+            total, _ = load_offsets()
+            first, last = page_positions(start, count, total, reverse)
+            blocks = iter_blocks_indexed(first, last, reverse)
         else:
-            original_owner = owner
-            owner = owner + "\0"
-            data_length = len(owner)
-        block = Block(
-            prev_hash=last_block_hash.digest(),
-            timestamp=datetime.utcnow().timestamp(),
-            case_id=UUID(int=int.from_bytes(last_found_block[2], byteorder="little")),
-            evidence_id=last_found_block[3],
-            state=STATES[reason],
-            d_length=data_length,
-            data=owner,
-        )
-        with open(BLOCKCHAIN_PATH, "ab") as blockchain:
-            block_packed = BLOCK_STRUCT.pack(
-                block.prev_hash,
-                block.timestamp,
-                block.case_id.int.to_bytes(16, byteorder="little"),
-                block.evidence_id,
-                block.state,
-                block.d_length,
+            section = read_posting_section(sort, start, count, reverse)
+            if section is None:
+                raise ChainError("no posting lists to sort by %s" % sort)
+            offsets, total = section
+            blocks = iter_blocks_at(offsets)
+        entries = [LogEntry(case_uuid(block[2]), block[3], decode_state(block[4]), block[1]) for _, block, _ in blocks]
+        return LogPage(entries, total)
+
+    # stream the blocks of the blockchain oldest first, or newest first when reversed, as (offset, header,
+    # block bytes) tuples like iter_blocks
+    # blocks flow through filter -> de-duplicate -> limit, so a limit stops reading once it has enough
+    # reverse walks the chain backward through the offset index, case and item ids only read blocks from
+    # their posting lists and since/until binary search the offset index for the time range, the filters
+    # themselves are compiled to checks on the raw block bytes
+    def iter_log(
+        self, reverse=False, limit=0, case_ids=(), item_ids=(), states=(), since=None, until=None, progress=None
+    ):
+        case_ids = {case_bytes(case_id) for case_id in case_ids}
+        item_ids = set(item_ids)
+        try:
+            states = {STATES[state] for state in states}
+        except KeyError as error:
+            raise InvalidArgumentError("unknown state %s" % error.args[0])
+        offsets = None
+        if len(case_ids) > 0 or len(item_ids) > 0:
+            # Read only the blocks listed in the posting lists of the requested cases and items
+            offsets = lookup_postings(case_ids, item_ids)
+        window = None
+        if offsets is None and (since is not None or until is not None):
+            # Binary search the time range, None when timestamps are out of order and the chain must be scanned
+            window = find_time_window(since, until)
+        predicate = compile_filter(case_ids, item_ids, states, since, until)
+        if offsets is not None:
+            blocks = iter_blocks_at(reversed(offsets) if reverse else offsets, predicate)
+        elif window is not None:
+            blocks = iter_blocks_indexed(window[0], window[1], reverse, predicate, progress)
+        elif reverse:
+            blocks = iter_blocks_indexed(reverse=True, predicate=predicate, progress=progress)
+        else:
+            blocks = iter_blocks(predicate=predicate, progress=progress)
+        blocks = unique_offsets(blocks)
+        if limit > 0:
+            blocks = islice(blocks, limit)
+        return blocks
+
+    # validate the links and evidence states of the whole chain, returns a VerifyResult
+    # links are checked while streaming: a healthy block points at the block right before it, so only
+    # the parents of blocks that don't are remembered and resolved by find_broken_link afterwards
+    # a clean run leaves a checkpoint, so the next run only validates blocks appended since (unless full)
+    # with jobs > 1 the chain is split into chunks that worker processes validate through their own
+    # memory map, the links and evidence states are then stitched across chunk boundaries in order
+    # engine "python" checks the evidence states block by block, engine "numpy" (which needs NumPy) leaves
+    # them out of the walk and checks them all at once with check_state_array
+    def verify(self, full=False, jobs=1, progress=None, engine="python"):
+        if engine not in VERIFY_ENGINES:
+            raise InvalidArgumentError("unknown engine %s" % engine)
+        if engine == "numpy" and load_numpy() is None:
+            raise CustodyError("the numpy engine needs NumPy, install it with pip install numpy")
+        if not path.exists(BLOCKCHAIN_PATH):
+            return VerifyResult(0, 0)
+        start = 0
+        block_count = 0
+        last_hash = None
+        tail_offset = 0
+        orphan_parents = set()
+        evidence_states = StateTable()
+        segments, sealed_states = load_manifest(states=True)
+        if not full:
+            check_segments()
+            checkpoint = load_checkpoint()
+            if checkpoint is not None:
+                start, tail_offset, last_hash, block_count, evidence_states = checkpoint
+            elif sealed_states is not None:
+                # Resume after the last sealed segment
+                sealed = [segment for segment in segments if segment.sealed]
+                start = sealed[-1].start + sealed[-1].size
+                tail_offset, last_hash = sealed[-1].last_offset, sealed[-1].last_hash
+                block_count = sum(segment.block_count for segment in sealed)
+                evidence_states = sealed_states
+        # The chain is verified up to the end of each segment not sealed yet and then to its end, so the
+        # evidence states at the end of the last of these segments are known for sealing them
+        segment_ends = [segment.start + segment.size for segment in segments if not segment.sealed]
+        segment_ends = [end for end in segment_ends if end >= start]
+        seal_states = None
+        chain_size = start
+        verified_count = 0
+        check_states = engine == "python"
+        for end in [*segment_ends, None]:
+            range_start = chain_size
+            try:
+                if jobs > 1:
+                    chunks = verify_chunks(range_start, jobs, progress, check_states, end)
+                else:
+                    chunks = [verify_chunk(range_start, end, evidence_states, progress, check_states)]
+            except struct.error:
+                raise ChainError("blockchain is truncated")
+            # Stitch the chunks together
+            range_offsets = array("Q")
+            for chunk in chunks:
+                if not chunk.valid:
+                    raise ChainError("invalid evidence state at offset %d" % chunk.last_offset)
+                if chunk.block_count == 0:
+                    continue
+                for evidence_id, state in chunk.first_states.items():
+                    if not valid_transition(evidence_states.get_state(evidence_id), state):
+                        raise ChainError("invalid evidence state")
+                evidence_states.update(chunk.last_states)
+                range_offsets.extend(chunk.offsets)
+                if last_hash is not None and chunk.first_parent != last_hash:
+                    orphan_parents.add(chunk.first_parent)
+                orphan_parents.update(chunk.orphan_parents)
+                last_hash = chunk.last_hash
+                tail_offset = chunk.last_offset
+                chain_size = chunk.end
+                verified_count += chunk.block_count
+            if not check_states and chain_size > range_start:
+                # The offsets of the blocks just walked, never those of the offset index, which is only a cache
+                invalid_offset = check_state_array(range_offsets, evidence_states)
+                if invalid_offset is not None:
+                    raise ChainError("invalid evidence state at offset %d" % invalid_offset)
+            if end is not None and end == segment_ends[-1] and chain_size == end:
+                seal_states, _ = StateTable.from_bytes(evidence_states.to_bytes())
+        block_count += verified_count
+        if len(orphan_parents) > 0:
+            broken_link = find_broken_link(orphan_parents, progress)
+            if broken_link is not None:
+                bad_block, parent_block = broken_link
+                message = "parent block not found" if parent_block is None else "two blocks found with same parent"
+                raise ChainError(message, block_count, bad_block, parent_block)
+        if block_count > 0 and chain_size > start:
+            write_checkpoint(chain_size, tail_offset, last_hash, block_count, evidence_states)
+        if seal_states is not None:
+            with self.locked():
+                seal_segments(segment_ends[-1], seal_states)
+        return VerifyResult(block_count, verified_count)
+
+    # counts and durations over the whole chain for reports, computed as NumPy array operations over the
+    # block headers, returns a ChainStats
+    def stats(self):
+        if load_numpy() is None:
+            raise CustodyError("stats needs NumPy, install it with pip install numpy")
+        if not path.exists(BLOCKCHAIN_PATH):
+            raise ChainError("blockchain not found")
+        _, headers = load_block_array()
+        return chain_stats(headers, datetime.utcnow().timestamp())
+
+    # the segments of the chain (see Segments) in chain order, the blockchain file last as the active
+    # segment, returns a list of SegmentInfo
+    def segments(self):
+        if not path.exists(BLOCKCHAIN_PATH):
+            raise ChainError("blockchain not found")
+        segments = load_manifest()
+        stored = [stored_segment(number) for number in range(1, len(segments) + 1)]
+        paths = [
+            segment_path(number, "" if compression is None else ARCHIVE_EXTENSION)
+            for number, (compression, _) in enumerate(stored, start=1)
+        ]
+        active_start = segments[-1].start + segments[-1].size if len(segments) > 0 else 0
+        chain_size, _ = load_tail()
+        paths.append(BLOCKCHAIN_PATH)
+        stored.append((None, chain_size - active_start))
+        if chain_size > active_start:
+            segments.append(describe_segment(active_start, chain_size))
+        results = [
+            SegmentInfo(
+                number,
+                file_path,
+                segment.block_count,
+                segment.first_hash.hex(),
+                segment.last_hash.hex(),
+                segment.first_time,
+                segment.last_time,
+                segment.sealed,
+                segment.size,
+                stored_size,
+                compression,
             )
-            # Write block and data separately
-            blockchain.write(block_packed)
-            if data_length > 0:
-                blockchain.write(owner.encode("utf-8"))
-            blockchain.close()
-        print(
-            "Case:",
-            block.case_id,
-            "\nRemoved item:",
-            block.evidence_id,
-            "\n  Status:",
-            block.state.decode("utf-8").rstrip("\x00"),
-            "\n  Owner info:",
-            original_owner,
-            "\n  Time of action:",
-            datetime.fromtimestamp(block.timestamp),
-        )
+            for number, (file_path, segment, (compression, stored_size)) in enumerate(
+                zip(paths, segments, stored), start=1
+            )
+        ]
+        if len(results) < len(paths):
+            results.append(SegmentInfo(len(paths), BLOCKCHAIN_PATH, 0, None, None, None, None, False, 0, 0, None))
+        return results
 
+    # compress segments into archives (see Archives), all the segments cut so far or those numbered up to
+    # count, with cut the blockchain file is cut into a segment first, so the whole chain is archived
+    # segments are compressed without the write lock, which is only taken to swap an archive in for its
+    # segment file, returns the SegmentInfo of every segment archived
+    def archive(self, count=None, compression="zlib", cut=False):
+        if compression not in ARCHIVE_COMPRESSIONS:
+            raise InvalidArgumentError("unknown compression %s" % compression)
+        if not path.exists(BLOCKCHAIN_PATH):
+            raise ChainError("blockchain not found")
+        with self.locked():
+            segments = load_manifest()
+            active_start = segments[-1].start + segments[-1].size if len(segments) > 0 else 0
+            if is_last_segment(self.blockchain, segments):
+                self.replace(replace_blockchain())  # Finish an interrupted cut, see recover
+            elif cut and os.fstat(self.blockchain.fileno()).st_size > 0:
+                chain_size, _ = load_tail()
+                if chain_size - active_start != os.fstat(self.blockchain.fileno()).st_size:
+                    raise ChainError("blockchain ends in a torn block")
+                try:
+                    self.replace(cut_segment(self.blockchain, chain_size))
+                except OSError as error:
+                    raise ChainError("blockchain could not be cut: %s" % error)
+                segments = load_manifest()
+        archived = []
+        for number, segment in enumerate(segments[:count], start=1):
+            segment_file = segment_path(number)
+            if not path.exists(segment_file):
+                continue  # Archived already
+            archive_file = path.join(path.dirname(segment_file), segment_name(number) + ARCHIVE_EXTENSION)
+            try:
+                archive_temporary = write_archive(segment_file, archive_file, segment, compression)
+            except FileNotFoundError:
+                continue  # Archived by another process meanwhile
+            with self.locked():
+                if not path.exists(segment_file):
+                    os.remove(archive_temporary)  # Archived by another process meanwhile
+                    continue
+                os.replace(archive_temporary, archive_file)
+                os.remove(segment_file)
+            archived.append(number)
+        return [result for result in self.segments() if result.number in archived]
 
-# starts up or checks for initial block
-def init():
-    global BLOCKCHAIN_PATH
-    if path.exists(BLOCKCHAIN_PATH):
-        try:
-            blockchain = open(BLOCKCHAIN_PATH, "rb")
-            initial_block = BLOCK_STRUCT.unpack(blockchain.read(BLOCK_LEN))
-            blockchain.close()
-            if initial_block[4] == STATES["INITIAL"]:
-                print("Blockchain file found with INITIAL block.")
-            else:
-                sys.exit(1)
-        except Exception:
-            sys.exit(1)
-    else:
-        # Open a new blockchain file
-        blockchain = open(BLOCKCHAIN_PATH, "ab")
-        # Create a struct format
-        initial_block = Block(
-            prev_hash=0,
-            timestamp=datetime.utcnow().timestamp(),
-            case_id=UUID(int=0),
-            evidence_id=0,
-            state=STATES["INITIAL"],
-            d_length=14,
-            data=b"Initial block\0",
-        )
-        # Pack this struct into a padded binary block
-        initial_block_packed = BLOCK_STRUCT.pack(
-            initial_block.prev_hash.to_bytes(20, byteorder="little"),
-            initial_block.timestamp,
-            initial_block.case_id.int.to_bytes(16, byteorder="little"),
-            initial_block.evidence_id,
-            initial_block.state,
-            len(initial_block.data),
-        )
-        # Write block and data separately
-        blockchain.write(initial_block_packed)
-        blockchain.write(initial_block.data)
-        blockchain.close()
-        print("Blockchain file not found. Created INITIAL block.")
+    # decompress the archived segments, all of them or those numbered up to count, back into their segment
+    # files, byte for byte, returns the SegmentInfo of every segment expanded
+    def expand(self, count=None):
+        if not path.exists(BLOCKCHAIN_PATH):
+            raise ChainError("blockchain not found")
+        expanded = []
+        for number in range(1, len(load_manifest()[:count]) + 1):
+            archive_file = segment_path(number, ARCHIVE_EXTENSION)
+            if path.exists(segment_path(number)) or not path.exists(archive_file):
+                continue  # Not archived
+            segment_file = path.join(path.dirname(archive_file), segment_name(number))
+            try:
+                segment_temporary = expand_archive(archive_file, segment_file)
+            except FileNotFoundError:
+                continue  # Expanded by another process meanwhile
+            with self.locked():
+                if not path.exists(archive_file):
+                    os.remove(segment_temporary)  # Expanded by another process meanwhile
+                    continue
+                os.replace(segment_temporary, segment_file)
+                os.remove(archive_file)
+            expanded.append(number)
+        return [result for result in self.segments() if result.number in expanded]
 
+    # apply custody operations given as batch lines, every line is either a json object or csv starting
+    # with action,item_id, for example:
+    #   {"action": "add", "item_id": 3, "case_id": "65cc391d-6568-4dcc-a3f1-86a2f04140f3"}
+    #   checkout,3
+    #   remove,3,RELEASED,"Doe, John"
+    # operations are validated against the index, the valid ones are appended with a single write
+    # returns a BatchResult per line, with the error of the lines that were rejected
+    def batch(self, lines):
+        if not path.exists(BLOCKCHAIN_PATH):
+            raise ChainError("blockchain not found")
+        with self.locked():
+            return self.stage_lines(pending=self.begin(), lines=lines)
 
-# parse blockchain and validate all entries
-def verify():
-    # Iterate of the blockchain to check if item ids already exist somewhere
-    global BLOCKCHAIN_PATH
-    all_previous_hashes = []
-    all_hashes = []
-    evidence_states = {}
-    if path.exists(BLOCKCHAIN_PATH):
+    # stage the batch lines onto pending and commit the valid ones, see batch
+    def stage_lines(self, pending, lines):
+        if pending.tail_hash is None:
+            raise ChainError("blockchain not found")
+        results = []
+        for line_number, line in enumerate(lines, start=1):
+            if line.strip() == "" or line.lstrip().startswith("#"):
+                continue
+            try:
+                operation = parse_batch_line(line)
+                action = operation["action"]
+                item_id = int(operation["item_id"])
+            except (ValueError, KeyError, TypeError):
+                results.append(BatchResult(line_number, None, None, None, "malformed operation"))
+                continue
+            except InvalidArgumentError as error:
+                results.append(BatchResult(line_number, None, None, None, str(error)))
+                continue
+            try:
+                custody_action = self.stage(
+                    pending, action, item_id, operation.get("case_id"), operation.get("reason"), operation.get("owner")
+                )
+            except CustodyError as error:
+                results.append(BatchResult(line_number, action, item_id, None, str(error)))
+                continue
+            results.append(BatchResult(line_number, action, item_id, custody_action.state, None))
+        self.commit(pending)
+        return results
+
+    # make sure the index in memory describes the chain on disk, reloading it if the chain was changed
+    # since the last call, and start a set of pending blocks on its tail
+    # under the write lock this re-validates the tail, as other processes may have appended to the chain
+    def begin(self):
+        chain_stat = stat_chain()
+        if self.entries is None or chain_stat != self.chain_stat:
+            self.entries, self.chain_size, self.tail_hash = load_index()
+            self.chain_stat = chain_stat
+        return PendingBlocks(self.chain_size, self.tail_hash)
+
+    # hold the write lock, mutex for the threads of this process and an exclusive advisory lock on the
+    # blockchain file for the other processes, kept on the append handle
+    # only init creates a missing blockchain file (create), otherwise a missing one raises ChainError
+    @contextmanager
+    def locked(self, create=False):
+        with self.mutex:
+            while True:
+                if self.blockchain is None:
+                    try:
+                        append_flags = os.O_WRONLY | os.O_APPEND | (os.O_CREAT if create else 0)
+                        self.blockchain = os.fdopen(os.open(BLOCKCHAIN_PATH, append_flags, 0o666), "ab")
+                    except FileNotFoundError:
+                        raise ChainError("blockchain not found")
+                fcntl.flock(self.blockchain.fileno(), fcntl.LOCK_EX)
+                chain_stat = stat_chain()
+                if chain_stat is not None and chain_stat[0] == os.fstat(self.blockchain.fileno()).st_ino:
+                    break
+                self.close()  # The chain was replaced while waiting for the lock, lock the new one
+            try:
+                yield
+            finally:
+                fcntl.flock(self.blockchain.fileno(), fcntl.LOCK_UN)
+
+    # validate a single operation and append its block, through the group commit queue when there is
+    # a window
+    def apply(self, action, item_id, case_id=None, reason=None, owner=None):
+        if self.group_commit > 0:
+            return self.apply_grouped((action, item_id, case_id, reason, owner))
+        with self.locked():
+            pending = self.begin()
+            custody_action = self.stage(pending, action, item_id, case_id, reason, owner)
+            self.commit(pending)
+        return custody_action
+
+    # queue an operation for the next group and wait for its result, the first thread to queue one
+    # leads the group, after a group the lead passes to the oldest operation still queued
+    def apply_grouped(self, operation):
+        queued = QueuedOperation(operation)
+        with self.group_mutex:
+            self.group_queue.append(queued)
+            queued.lead = not self.group_leading
+            self.group_leading = True
+        while True:
+            if queued.lead:
+                queued.lead = False
+                self.commit_group()
+            queued.done.wait()
+            if not queued.lead:
+                break
+        if queued.error is not None:
+            raise queued.error
+        return queued.result
+
+    # wait out the group commit window, then validate the queued operations and append the valid ones
+    # with one write and one fsync
+    def commit_group(self):
+        time.sleep(self.group_commit)
+        with self.group_mutex:
+            group = self.group_queue
+            self.group_queue = []
         try:
-            with open(BLOCKCHAIN_PATH, "rb") as blockchain:
-                block_bytes = blockchain.read(BLOCK_LEN)  # Parse the block
-                while block_bytes:
-                    block = BLOCK_STRUCT.unpack(block_bytes)  # Unpack the block itself
-                    block_data = blockchain.read(block[5])  # Get already unpacked data
-                    all_previous_hashes.append(block[0].hex())  # Obtain previous_hash from every block in the chain
-                    all_hashes.append(sha1(block_bytes + block_data).hexdigest())  # Obtain hash of current block
-                    # Check if evidence state is wrong
+            with self.locked():
+                pending = self.begin()
+                for queued in group:
                     try:
-                        if (  # If an item has been removed, it cannot appear again
-                            evidence_states[block[3]] == STATES["DISPOSED"]
-                            or evidence_states[block[3]] == STATES["RELEASED"]
-                            or evidence_states[block[3]] == STATES["DESTROYED"]
-                        ):
-                            if block[4] in STATES.values():
-                                sys.exit(1)
-                        elif (  # no double checkouts
-                            evidence_states[block[3]] == STATES["CHECKEDOUT"] and evidence_states[block[3]] == block[4]
-                        ) or (  # no double checkins
-                            evidence_states[block[3]] == STATES["CHECKEDIN"] and evidence_states[block[3]] == block[4]
-                        ):
-                            sys.exit(1)
-                        elif block[4] not in STATES.values():  # some kind of a fake state
-                            sys.exit(1)
-                    except KeyError:
-                        pass
-                    # Record last known evidence item state
-                    evidence_states[block[3]] = block[4]
-                    # Check owner status in case block was RELEASED
-                    if block[4] == STATES["RELEASED"]:
-                        if block[5] == 0:
-                            sys.exit(1)
-                    # Continue reading
-                    block_bytes = blockchain.read(BLOCK_LEN)  # Parse the block
-            blockchain.close()
-        except struct.error:
-            sys.exit(1)
-        print("Transactions in blockchain:", len(all_hashes))
-        # Check for blocks with missing parent
-        for i, hash in enumerate(all_previous_hashes):
-            if i != 0 and hash not in all_hashes:
-                print("State of blockchain: ERROR", "\nBad block:", all_hashes[i], "\nParent block: NOT FOUND")
-                sys.exit(1)
+                        queued.result = self.stage(pending, *queued.operation)
+                    except CustodyError as error:
+                        queued.error = error
+                self.commit(pending, fsync=True)
+        except Exception as error:
+            for queued in group:
+                queued.result, queued.error = None, queued.error or error
+        with self.group_mutex:
+            if len(self.group_queue) > 0:
+                self.group_queue[0].lead = True
+                self.group_queue[0].done.set()
+            else:
+                self.group_leading = False
+        for queued in group:
+            queued.done.set()
+
+    # validate an operation against the index and the pending blocks, then chain its block onto them
+    # returns a CustodyAction, raises a CustodyError when the operation is not allowed
+    def stage(self, pending, action, item_id, case_id=None, reason=None, owner=None):
+        check_item_id(item_id)
+        entry = pending.entries.get(item_id, self.entries.get(item_id))
+        data = b""
+        if action == "add":
+            if entry is not None:
+                raise DuplicateItemError("item %d already exists" % item_id)
+            case_id = case_bytes(case_id)
+            state = STATES["CHECKEDIN"]
+        elif entry is None:
+            raise ItemNotFoundError("item %d not found" % item_id)
+        elif action == "checkout" or action == "checkin":
+            required_state = STATES["CHECKEDIN"] if action == "checkout" else STATES["CHECKEDOUT"]
+            if entry.state != required_state:
+                raise InvalidStateError("item %d is not %s" % (item_id, decode_state(required_state)))
+            case_id = entry.case_id
+            state = STATES["CHECKEDOUT"] if action == "checkout" else STATES["CHECKEDIN"]
+        elif action == "remove":
+            if reason != "DISPOSED" and reason != "DESTROYED" and reason != "RELEASED":
+                raise InvalidArgumentError("invalid reason")
+            if reason == "RELEASED" and not owner:
+                raise InvalidArgumentError("owner required for RELEASED")
+            if entry.state != STATES["CHECKEDIN"]:
+                raise InvalidStateError("item %d is not CHECKEDIN" % item_id)
+            if owner:
+                data = owner.encode("utf-8") + b"\0"
+            case_id = entry.case_id
+            state = STATES[reason]
+        else:
+            raise InvalidArgumentError("unknown action %s" % action)
+        timestamp = pending.push(item_id, case_id, state, data)
+        return CustodyAction(case_uuid(case_id), item_id, decode_state(state), timestamp, owner or None)
 
-        # Check if there any blocks with the same parent
-        prev_hash_duplicate_check = set([x for x in all_previous_hashes if all_previous_hashes.count(x) > 1])
-        if len(prev_hash_duplicate_check) > 0:
+    # append the pending blocks with a single write and record them in the sidecars and in memory
+    # the caller holds the write lock, fsync overrides the durability policy
+    def commit(self, pending, fsync=None):
+        if len(pending.buffer) == 0:
+            return
+        if fsync is None:
+            fsync = self.durability == "block"
+        append_blocks(pending.buffer, self.blockchain, fsync)
+        self.unsynced = not fsync and self.durability == "batch"
+        if self.unsynced and self.sync_timer is None:
+            self.sync_timer = threading.Timer(FSYNC_INTERVAL, self.sync)
+            self.sync_timer.daemon = True
+            self.sync_timer.start()
+        chain_size = pending.chain_size + len(pending.buffer)
+        record_append(pending.prev_hash, pending.new_entries, chain_size, pending.tail_hash)
+        self.entries.update(pending.entries)
+        self.chain_size = chain_size
+        self.tail_hash = pending.tail_hash
+        if self.segment_size > 0 and os.fstat(self.blockchain.fileno()).st_size >= self.segment_size:
             try:
-                t = list(prev_hash_duplicate_check)[0]
-                index = None
-                for i, hash in enumerate(all_previous_hashes):
-                    if hash == t:
-                        index = i
-                if index is not None:
-                    print(
-                        "State of blockchain: ERROR",
-                        "\nBad block:",
-                        all_hashes[index],
-                        "\nParent block:",
-                        all_previous_hashes[index],
-                        "\nTwo blocks found with same parent.",
-                    )
-                    sys.exit(1)
-            except ValueError:
+                self.replace(cut_segment(self.blockchain, chain_size))
+                self.cut_error = None
+            except OSError as error:
+                # The blocks are in and the next commit tries again, but a lasting failure (a file system
+                # without hard links, a full disk) would let the active segment grow without bound
+                if str(error) != self.cut_error:
+                    print("Warning: the blockchain segment could not be cut:", error, file=sys.stderr)
+                self.cut_error = str(error)
+        self.chain_stat = stat_chain()
+
+    # switch to the append handle of a blockchain file that replaced the locked one, the caller holds the
+    # write lock, which the new handle holds as well
+    def replace(self, blockchain):
+        self.blockchain.close()
+        self.blockchain = blockchain
+        self.unsynced = False  # A cut synced the old file
+
+
+# the positions first and last of a page of count rows at row start out of total, counted from the end
+# when reverse
+def page_positions(start, count, total, reverse):
+    start = min(start, total)
+    if reverse:
+        return max(total - start - count, 0), max(total - start, 0)
+    return min(start, total), min(start + count, total)
+
+
+# sort block offsets by the case (stored bytes) or item of their blocks, then by offset
+def sort_offsets(offsets, sort):
+    if len(offsets) == 0:
+        return offsets
+    field_struct, position = (CASE_STRUCT, CASE_POSITION) if sort == "case" else (EVIDENCE_STRUCT, EVIDENCE_POSITION)
+    chain = ChainMap()
+    try:
+        return sorted(
+            offsets, key=lambda offset: (field_struct.unpack_from(*chain.locate(offset + position))[0], offset)
+        )
+    finally:
+        chain.close()
+
+
+# the identity of the blockchain file, which changes whenever it is written or replaced
+def stat_chain():
+    return stat_file(BLOCKCHAIN_PATH)
+
+
+# the identity of a file, None if it doesn't exist
+def stat_file(file_path):
+    try:
+        file_stat = os.stat(file_path)
+    except OSError:
+        return None
+    return file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns
+
+
+# turn a case id (a uuid or its string form) into the 16 bytes stored in a block
+def case_bytes(case_id):
+    try:
+        return UUID(str(case_id), version=4).int.to_bytes(16, byteorder="little")
+    except (ValueError, TypeError):
+        raise InvalidArgumentError("invalid case id")
+
+
+# turn the 16 bytes of a case id stored in a block into a uuid
+def case_uuid(case_id):
+    return UUID(int=int.from_bytes(case_id, byteorder="little"))
+
+
+# item ids are stored as 32 bit unsigned integers
+def check_item_id(item_id):
+    if not 0 <= item_id < 2**32:
+        raise InvalidArgumentError("invalid item id")
+
+
+# ---- Chain daemon ----
+# bchoc serve keeps a ChainOfCustody open behind a Unix socket, so its index, tail and append handle stay
+# hot across requests from any number of processes. Messages are a 4 byte big-endian length followed by
+# a JSON object:
+#   request  {"command": "checkout", "arguments": {"item_id": 3}}
+#   response {"ok": true, "result": ...} or {"ok": false, "error": "InvalidStateError", "message": ...}
+# Results are the engine's namedtuples as objects tagged with "_type". The engine serializes its writes
+# with its write lock, so requests run side by side, and with BCHOC_GROUP_COMMIT set the appends of
+# concurrent clients are grouped into one write and one fsync.
+# RemoteChain is the client, with the same methods as ChainOfCustody.
+
+
+# send one message over a socket
+def send_message(connection, message):
+    payload = json.dumps(message, separators=(",", ":")).encode("utf-8")
+    connection.sendall(MESSAGE_HEADER_STRUCT.pack(len(payload)) + payload)
+
+
+# read exactly size bytes from a socket, None if it was closed first
+def receive_exactly(connection, size):
+    buffer = bytearray()
+    while len(buffer) < size:
+        received = connection.recv(size - len(buffer))
+        if len(received) == 0:
+            return None
+        buffer += received
+    return bytes(buffer)
+
+
+# read one message from a socket, None if it was closed
+def receive_message(connection):
+    header = receive_exactly(connection, MESSAGE_HEADER_STRUCT.size)
+    if header is None:
+        return None
+    payload = receive_exactly(connection, MESSAGE_HEADER_STRUCT.unpack(header)[0])
+    if payload is None:
+        return None
+    return json.loads(payload)
+
+
+# turn arguments and results into JSON values, namedtuples become objects tagged with their type
+def encode_value(value):
+    if isinstance(value, tuple) and hasattr(value, "_asdict"):
+        encoded = {"_type": type(value).__name__}
+        for field, field_value in value._asdict().items():
+            encoded[field] = encode_value(field_value)
+        return encoded
+    if isinstance(value, (list, tuple, set)):
+        return [encode_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: encode_value(item) for key, item in value.items()}
+    if isinstance(value, UUID):
+        return str(value)
+    if isinstance(value, bytes):
+        return value.hex()
+    return value
+
+
+# turn JSON values back into results, the inverse of encode_value
+def decode_value(value):
+    if isinstance(value, list):
+        return [decode_value(item) for item in value]
+    if isinstance(value, dict) and value.get("_type") in RESULT_TYPES:
+        fields = {field: decode_value(field_value) for field, field_value in value.items() if field != "_type"}
+        if "case_id" in fields:
+            fields["case_id"] = UUID(fields["case_id"])
+        return RESULT_TYPES[value["_type"]](**fields)
+    return value
+
+
+# handles the requests of one client connection until it disconnects
+class DaemonHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                request = receive_message(self.request)
+            except (OSError, ValueError):
+                return
+            if request is None:
+                return
+            try:
+                response = {"ok": True, "result": encode_value(self.server.run_request(request))}
+            except CustodyError as error:
+                response = {"ok": False, "error": type(error).__name__, "message": str(error)}
+                if isinstance(error, ChainError):
+                    response["block_count"] = error.block_count
+                    response["bad_block"] = encode_value(error.bad_block)
+                    response["parent_block"] = encode_value(error.parent_block)
+            except (TypeError, ValueError, KeyError, AttributeError) as error:
+                response = {"ok": False, "error": "InvalidArgumentError", "message": str(error)}
+            except Exception as error:  # Anything else fails this request only, the connection stays usable
+                response = {"ok": False, "error": "CustodyError", "message": str(error) or type(error).__name__}
+            try:
+                send_message(self.request, response)
+            except OSError:
+                return
+
+
+# a threaded Unix socket server holding the chain every request runs on
+class ChainDaemon(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, chain):
+        super().__init__(socket_path, DaemonHandler)
+        self.chain = chain
+
+    # run a request on the chain, returns the result to encode
+    def run_request(self, request):
+        command = request["command"]
+        arguments = request.get("arguments", {})
+        if command not in DAEMON_COMMANDS:
+            raise InvalidArgumentError("unknown command %s" % command)
+        result = getattr(self.chain, command)(**arguments)
+        if command == "iter_log":
+            # Only the header fields write_blocks reads travel, see RemoteChain.iter_log
+            return [[offset, block[1], block[2], block[3], block[4]] for offset, block, _ in result]
+        if command == "log":
+            return list(result)
+        return result
+
+
+# serve the chain on the daemon socket until interrupted
+def serve(chain):
+    if len(sys.argv) > 2:
+        print("Error: serve takes no arguments", file=sys.stderr)
+        raise InvalidArgumentError("serve takes no arguments")
+    if path.exists(SOCKET_PATH):
+        try:
+            RemoteChain().close()
+        except OSError:
+            os.remove(SOCKET_PATH)  # Left behind by a daemon that didn't shut down
+        else:
+            print("Error: a daemon is already serving", SOCKET_PATH, file=sys.stderr)
+            raise ChainError("a daemon is already serving %s" % SOCKET_PATH)
+    with ChainDaemon(SOCKET_PATH, chain) as daemon:
+        signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=daemon.shutdown).start())
+        print("Serving", BLOCKCHAIN_PATH, "on", SOCKET_PATH)
+        sys.stdout.flush()
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(SOCKET_PATH)
+
+
+# client of bchoc serve with the methods of ChainOfCustody, errors are raised as the same types
+# a daemon that doesn't answer within DAEMON_TIMEOUT seconds raises ChainError and closes the connection
+class RemoteChain:
+    def __init__(self, socket_path=None):
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.settimeout(DAEMON_TIMEOUT)
+        try:
+            self.connection.connect(SOCKET_PATH if socket_path is None else socket_path)
+        except OSError:
+            self.connection.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    # run a command on the daemon and wait for its result
+    def call(self, command, **arguments):
+        try:
+            send_message(self.connection, {"command": command, "arguments": encode_value(arguments)})
+            response = receive_message(self.connection)
+        except socket.timeout:
+            self.close()  # A late reply would answer the next call
+            raise ChainError("the daemon didn't answer within %g seconds" % DAEMON_TIMEOUT)
+        if response is None:
+            raise ChainError("the daemon closed the connection")
+        if response["ok"]:
+            return decode_value(response["result"])
+        error_type = ERROR_TYPES.get(response["error"], CustodyError)
+        if error_type is ChainError:
+            raise ChainError(
+                response["message"],
+                response.get("block_count"),
+                None if response.get("bad_block") is None else bytes.fromhex(response["bad_block"]),
+                None if response.get("parent_block") is None else bytes.fromhex(response["parent_block"]),
+            )
+        raise error_type(response["message"])
+
+    def init(self):
+        return self.call("init")
+
+    def add(self, case_id, item_ids):
+        return self.call("add", case_id=case_id, item_ids=item_ids)
+
+    def checkout(self, item_id):
+        return self.call("checkout", item_id=item_id)
+
+    def checkin(self, item_id):
+        return self.call("checkin", item_id=item_id)
+
+    def remove(self, item_id, reason, owner=None):
+        return self.call("remove", item_id=item_id, reason=reason, owner=owner)
+
+    def lookup(self, item_id):
+        return self.call("lookup", item_id=item_id)
+
+    def batch(self, lines):
+        return self.call("batch", lines=lines)
+
+    def verify(self, full=False, jobs=1, engine="python"):
+        return self.call("verify", full=full, jobs=jobs, engine=engine)
+
+    def stats(self):
+        return self.call("stats")
+
+    def segments(self):
+        return self.call("segments")
+
+    def archive(self, count=None, compression="zlib", cut=False):
+        return self.call("archive", count=count, compression=compression, cut=cut)
+
+    def expand(self, count=None):
+        return self.call("expand", count=count)
+
+    def log(self, reverse=False, limit=0, case_ids=(), item_ids=(), states=(), since=None, until=None):
+        filters = {"case_ids": case_ids, "item_ids": item_ids, "states": states, "since": since, "until": until}
+        return iter(self.call("log", reverse=reverse, limit=limit, **filters))
+
+    def log_page(self, start, count, reverse=False, sort="time", case_ids=(), item_ids=()):
+        return self.call(
+            "log_page", start=start, count=count, reverse=reverse, sort=sort, case_ids=case_ids, item_ids=item_ids
+        )
+
+    # the blocks come back as (offset, header, None), with the prev hash and data length of the header left out
+    def iter_log(self, reverse=False, limit=0, case_ids=(), item_ids=(), states=(), since=None, until=None):
+        filters = {"case_ids": case_ids, "item_ids": item_ids, "states": states, "since": since, "until": until}
+        rows = self.call("iter_log", reverse=reverse, limit=limit, **filters)
+        return (
+            (offset, (None, timestamp, bytes.fromhex(case_id), item_id, bytes.fromhex(state), None), None)
+            for offset, timestamp, case_id, item_id, state in rows
+        )
+
+
+# Types the daemon protocol carries
+RESULT_TYPES = {
+    result_type.__name__: result_type
+    for result_type in (
+        CustodyAction, LogEntry, LogPage, VerifyResult, BatchResult, ItemStatus, ChainStats, SegmentInfo
+    )
+}
+ERROR_TYPES = {
+    error_type.__name__: error_type
+    for error_type in (
+        CustodyError,
+        InvalidArgumentError,
+        ItemNotFoundError,
+        DuplicateItemError,
+        InvalidStateError,
+        CancelledError,
+        ChainError,
+    )
+}
+
+
+# ---- Log output ----
+
+
+# plan the case (16 byte ids), item, state, since and until filters of log as checks on the raw bytes of a block
+# returns a predicate taking the chain view and a block offset, or None when nothing is filtered
+# the checks run cheapest first and compare packed fields, so nothing is decoded for blocks that fail
+def compile_filter(case_ids, item_ids, states, since, until):
+    checks = []
+    if len(item_ids) == 1:
+        item_id = next(iter(item_ids))
+        checks.append(lambda view, offset: EVIDENCE_STRUCT.unpack_from(view, offset + EVIDENCE_POSITION)[0] == item_id)
+    elif len(item_ids) > 1:
+        checks.append(lambda view, offset: EVIDENCE_STRUCT.unpack_from(view, offset + EVIDENCE_POSITION)[0] in item_ids)
+    if len(case_ids) > 0:
+        checks.append(lambda view, offset: CASE_STRUCT.unpack_from(view, offset + CASE_POSITION)[0] in case_ids)
+    if len(states) > 0:
+        checks.append(lambda view, offset: STATE_STRUCT.unpack_from(view, offset + STATE_POSITION)[0] in states)
+    if since is not None:
+        checks.append(lambda view, offset: TIMESTAMP_STRUCT.unpack_from(view, offset + TIMESTAMP_POSITION)[0] >= since)
+    if until is not None:
+        checks.append(lambda view, offset: TIMESTAMP_STRUCT.unpack_from(view, offset + TIMESTAMP_POSITION)[0] < until)
+    if len(checks) == 0:
+        return None
+    if len(checks) == 1:
+        return checks[0]
+    return lambda view, offset: all(check(view, offset) for check in checks)
+
+
+# drop a block if it comes right after itself, which can happen when several sources are merged
+def unique_offsets(blocks):
+    last_offset = None
+    for offset, block, block_bytes in blocks:
+        if offset != last_offset:
+            yield offset, block, block_bytes
+        last_offset = offset
+
+
+# write blocks to stdout as text (the log format, separated by empty lines), JSON Lines or CSV
+# records are joined and written to sys.stdout.buffer every LOG_FLUSH_BLOCKS blocks, and the string form
+# of every distinct case and state is built once
+def write_blocks(blocks, output_format="text"):
+    cases = {}
+    states = {}
+    if output_format == "jsonl":
+        record = '{{"case_id": "{}", "item_id": {}, "action": {}, "time": "{}Z", "timestamp": {!r}}}\n'
+        quote_state = json.dumps
+    elif output_format == "csv":
+        record = "{},{},{},{}Z,{!r}\n"
+        quote_state = quote_csv
+    else:
+        record = "Case: {}\nItem: {}\nAction: {}\nTime: {}Z\n"
+        quote_state = str
+    output = sys.stdout.buffer
+    sys.stdout.flush()  # Anything already printed goes out first
+    lines = [",".join(LOG_FIELDS) + "\n"] if output_format == "csv" else []
+    for index, (_, block, _) in enumerate(blocks):
+        case_id = cases.get(block[2])
+        if case_id is None:
+            case_id = cases[block[2]] = str(UUID(int=int.from_bytes(block[2], byteorder="little")))
+        state = states.get(block[4])
+        if state is None:
+            state = states[block[4]] = quote_state(decode_state(block[4]))
+        if index > 0 and output_format == "text":
+            lines.append("\n")
+        time = datetime.fromtimestamp(block[1]).isoformat(timespec="microseconds")
+        lines.append(record.format(case_id, block[3], state, time, block[1]))
+        if len(lines) >= LOG_FLUSH_BLOCKS:
+            output.write("".join(lines).encode("utf-8"))
+            lines.clear()
+    output.write("".join(lines).encode("utf-8"))
+    output.flush()
+
+
+# quote a CSV field if it holds a separator, quote or line break
+def quote_csv(value):
+    if any(character in value for character in ',"\r\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+# ---- Verify ----
+
+
+# whether an item may move from previous_state to state, previous_state is None for a new item
+def valid_transition(previous_state, state):
+    if previous_state is None:
+        return True
+    if previous_state in REMOVED_STATES:  # If an item has been removed, it cannot appear again
+        return state not in VALID_STATES
+    if (  # no double checkouts or checkins
+        previous_state == STATES["CHECKEDOUT"] or previous_state == STATES["CHECKEDIN"]
+    ) and previous_state == state:
+        return False
+    return state in VALID_STATES  # some kind of a fake state
+
+
+# valid_transition as a table of [previous state code, state code], with bytes(11) standing for the
+# UNKNOWN states and an extra previous code, len(STATE_NAMES), for a new item, set by load_numpy
+STATE_TRANSITIONS = None
+
+
+# hash and validate the blocks between start and end, either in process or in a worker of verify --jobs
+# known_states is a StateTable of the items before start, items it doesn't know have their first state
+# reported in first_states so the caller can check it once the earlier chunks are known, last_states
+# has the latest (state, case id, offset) of every item of the chunk
+# without check_states only the links are walked and the block offsets recorded, the states are left to
+# check_state_array
+def verify_chunk(start, end, known_states=None, progress=None, check_states=True):
+    if known_states is None:
+        known_states = StateTable()
+    block_count = 0
+    first_parent = None
+    last_hash = None
+    last_offset = start
+    chunk_end = start
+    orphan_parents = set()
+    first_states = {}
+    last_states = {}
+    offsets = array("Q")
+    for offset, block, block_bytes in iter_blocks(start, end, progress=progress):
+        if last_hash is None:
+            first_parent = block[0]
+        elif block[0] != last_hash:
+            orphan_parents.add(block[0])
+        last_hash = sha1(block_bytes).digest()
+        last_offset = offset
+        chunk_end = offset + BLOCK_LEN + block[5]
+        block_count += 1
+        if not check_states:
+            offsets.append(offset)
+            continue
+        # Check if evidence state is wrong
+        last_state = last_states.get(block[3])
+        previous_state = known_states.get_state(block[3]) if last_state is None else last_state[0]
+        if previous_state is None:
+            first_states[block[3]] = block[4]
+        elif not valid_transition(previous_state, block[4]):
+            return VerifiedChunk(
+                False, block_count, first_parent, last_hash, last_offset, chunk_end, None, None, None, None
+            )
+        # Check owner status in case block was RELEASED
+        if block[4] == STATES["RELEASED"] and block[5] == 0:
+            return VerifiedChunk(
+                False, block_count, first_parent, last_hash, last_offset, chunk_end, None, None, None, None
+            )
+        # Record last known evidence item state
+        last_states[block[3]] = (block[4], block[2], offset)
+    return VerifiedChunk(
+        True,
+        block_count,
+        first_parent,
+        last_hash,
+        last_offset,
+        chunk_end,
+        orphan_parents,
+        first_states,
+        last_states,
+        offsets,
+    )
+
+
+# verify the blocks between start and end (the end of the chain by default) in worker processes, returns
+# the chunks in chain order
+# the chunks are cut at offsets of the offset index, which is only a cache: unless the walk of every chunk
+# ends right where the next one starts, they are cut again by walking the chain and verified once more
+# progress is reported as chunks finish, cancelling drops the chunks not started yet
+def verify_chunks(start, jobs, progress=None, check_states=True, end=None):
+    chunk_bounds = split_chain(start, jobs * 4, end)
+    try:
+        chunks = run_chunks(chunk_bounds, jobs, progress, check_states)
+        if all(chunk.end == chunk_end for chunk, (_, chunk_end) in zip(chunks, chunk_bounds)):
+            return chunks
+    except (ChainError, struct.error):
+        pass  # Cut inside a block, the offset index doesn't match the chain
+    return run_chunks(scan_chain(start, jobs * 4, end), jobs, progress, check_states)
+
+
+# verify the chunks between chunk_bounds in worker processes, see verify_chunks
+def run_chunks(chunk_bounds, jobs, progress=None, check_states=True):
+    chunks = []
+    with ProcessPoolExecutor(jobs) as executor:
+        try:
+            chunk_arguments = (*zip(*chunk_bounds), repeat(None), repeat(None), repeat(check_states))
+            for chunk in executor.map(verify_chunk, *chunk_arguments) if chunk_bounds else []:
+                chunks.append(chunk)
+                if progress is not None:
+                    progress(chunk.end, chunk_bounds[-1][1])
+        except CancelledError:
+            executor.shutdown(cancel_futures=True)
+            raise
+    return chunks
+
+
+# split the blocks between start and end (the end of the chain by default) into about count chunks, at the
+# block offsets of the offset index (see open_offsets), so the chain is only walked when the index is stale
+# returns the (start, end) offsets of every chunk
+def split_chain(start, count, end=None):
+    chain = ChainMap()
+    chain_size = chain.size if end is None else min(end, chain.size)
+    chain.close()
+    if chain_size <= start:
+        return []
+    chunk_len = max((chain_size - start) // count, BLOCK_LEN)
+    chunk_starts = [start]
+    with open_offsets() as (offsets, _):
+        position = bisect_left(offsets, start)
+        while True:
+            position = bisect_left(offsets, chunk_starts[-1] + chunk_len, position)
+            if position == len(offsets) or not chunk_starts[-1] < offsets[position] < chain_size:
+                break
+            chunk_starts.append(offsets[position])
+    return list(zip(chunk_starts, chunk_starts[1:] + [chain_size]))
+
+
+# split_chain walking only the data lengths of the blocks, for when the offset index can't be trusted
+def scan_chain(start, count, end=None):
+    chain = ChainMap()
+    try:
+        chain_size = chain.size if end is None else min(end, chain.size)
+        chunk_len = max((chain_size - start) // count, BLOCK_LEN)
+        chunk_bounds = []
+        if chain_size <= start:
+            return chunk_bounds
+        chunk_start = start
+        offset = start
+        while offset < chain_size:
+            chain_view, part_offset = chain.locate(offset)
+            part_start = offset - part_offset
+            part_end = min(chain_size - part_start, len(chain_view))
+            while part_offset < part_end:
+                if part_start + part_offset - chunk_start >= chunk_len:
+                    chunk_bounds.append((chunk_start, part_start + part_offset))
+                    chunk_start = part_start + part_offset
+                part_offset += BLOCK_LEN + LENGTH_STRUCT.unpack_from(chain_view, part_offset + LENGTH_POSITION)[0]
+            offset = part_start + part_offset
+        chunk_bounds.append((chunk_start, chain_size))
+    finally:
+        chain.close()
+    return chunk_bounds
+
+
+# second pass over a chain with blocks that don't point at their predecessor
+# finds the first block whose parent doesn't exist, or else a parent shared by two blocks
+# returns the hashes of the bad block and its parent (None when not found), or None if all links hold
+def find_broken_link(orphan_parents, progress=None):
+    found_parents = set()
+    children = {}  # parent hash -> [(block number, block hash)] for every block pointing at it
+    for index, (_, block, block_bytes) in enumerate(iter_blocks(progress=progress)):
+        block_hash = sha1(block_bytes).digest()
+        if block_hash in orphan_parents:
+            found_parents.add(block_hash)
+        if block[0] in orphan_parents:
+            children.setdefault(block[0], []).append((index, block_hash))
+    # Check for blocks with missing parent
+    missing = [child for parent in orphan_parents - found_parents for child in children[parent]]
+    missing = [child for child in missing if child[0] != 0]
+    if len(missing) > 0:
+        return min(missing)[1], None
+    # Check if there any blocks with the same parent
+    shared_parents = [parent for parent in children if len(children[parent]) > 1]
+    if len(shared_parents) > 0:
+        parent = min(shared_parents, key=lambda parent: children[parent][1][0])
+        return children[parent][-1][1], parent
+    return None
+
+
+# validate the evidence states of the blocks at block_offsets (an array of offsets in chain order) with
+# array operations, the same rules as valid_transition and RELEASED blocks needing owner data
+# the blocks are sorted by item (keeping their chain order within an item), so the previous state of
+# every block is the code right before it, or the one in known_states for the first block of an item,
+# and each (previous, state) pair is looked up in STATE_TRANSITIONS
+# known_states is updated with the latest state of every item
+# returns the offset of the first invalid block in chain order, None if all are valid
+def check_state_array(block_offsets, known_states):
+    load_numpy()
+    offsets = np.frombuffer(block_offsets, np.uint64)
+    headers = gather_headers(offsets)
+    codes = state_codes(headers)
+    order = item_order(headers["evidence_id"])
+    item_ids = headers["evidence_id"][order]
+    sorted_codes = codes[order]
+    first_of_item = np.ones(len(order), bool)
+    first_of_item[1:] = item_ids[1:] != item_ids[:-1]
+    previous_codes = np.empty(len(order), np.uint8)
+    previous_codes[1:] = sorted_codes[:-1]
+    previous_codes[first_of_item] = len(STATE_NAMES)  # A new item
+    known_states.merge()
+    if len(known_states) > 0 and first_of_item.any():
+        # The table is sorted by id already
+        known_ids = np.frombuffer(known_states.ids, np.uint32)
+        known_codes = np.frombuffer(known_states.states, np.uint8)
+        first_positions = np.flatnonzero(first_of_item)
+        found = np.searchsorted(known_ids, item_ids[first_positions]).clip(max=len(known_ids) - 1)
+        known = known_ids[found] == item_ids[first_positions]
+        previous_codes[first_positions[known]] = known_codes[found[known]]
+        del known_ids, known_codes  # The table can't grow while NumPy holds its arrays
+    invalid = ~STATE_TRANSITIONS[previous_codes, sorted_codes]
+    invalid |= (sorted_codes == STATE_NAMES.index("RELEASED")) & (headers["d_length"][order] == 0)
+    last_of_item = np.ones(len(order), bool)
+    last_of_item[:-1] = first_of_item[1:]
+    latest = order[last_of_item]
+    known_states.update_arrays(
+        headers["evidence_id"][latest], codes[latest], headers["case_id"][latest], offsets[latest]
+    )
+    if not invalid.any():
+        return None
+    return int(offsets[order[invalid].min()])
+
+
+# ---- Verify checkpoint ----
+# After a clean verify the checkpoint stores how far the chain was verified, the offset and hash of
+# the last verified block, the block count and the state of every evidence item at that point.
+
+
+# save the result of a clean verify
+def write_checkpoint(chain_size, tail_offset, tail_hash, block_count, evidence_states):
+    records = (
+        CHECKPOINT_HEADER_STRUCT.pack(CHECKPOINT_MAGIC, chain_size, tail_offset, tail_hash, block_count)
+        + evidence_states.to_bytes()
+    )
+    try:
+        replace_file(CHECKPOINT_PATH, records)
+    except OSError:
+        pass  # Without a checkpoint the next verify is simply a full one
+
+
+# load the checkpoint if the last verified block is still in place
+# returns the verified size, tail offset, tail hash, block count and the StateTable of the evidence
+# states, or None
+def load_checkpoint():
+    try:
+        with open(CHECKPOINT_PATH, "rb") as checkpoint:
+            records = checkpoint.read()
+        magic, chain_size, tail_offset, tail_hash, block_count = CHECKPOINT_HEADER_STRUCT.unpack_from(records)
+        if magic != CHECKPOINT_MAGIC or not block_matches(tail_offset, chain_size, tail_hash):
+            return None
+        evidence_states, _ = StateTable.from_bytes(memoryview(records)[CHECKPOINT_HEADER_STRUCT.size :])
+    except (OSError, struct.error, ValueError):
+        return None
+    return chain_size, tail_offset, tail_hash, block_count, evidence_states
+
+
+# ---- Block writer ----
+
+
+# pack a block and its data, ready to be appended after the block with hash prev_hash
+def pack_block(prev_hash, timestamp, case_id, evidence_id, state, data=b""):
+    return BLOCK_STRUCT.pack(prev_hash, timestamp, case_id, evidence_id, state, len(data)) + data
+
+
+# strip the padding off a packed state
+def decode_state(state):
+    return state.decode("utf-8").rstrip("\x00")
+
+
+# append already packed blocks to the blockchain with a single write, through an open append handle
+# or by opening the blockchain for this write only
+def append_blocks(buffer, blockchain=None, fsync=DURABILITY != "none"):
+    if blockchain is None:
+        with open(BLOCKCHAIN_PATH, "ab") as blockchain:
+            append_blocks(buffer, blockchain, fsync)
+        return
+    blockchain.write(buffer)
+    blockchain.flush()
+    if fsync:
+        os.fsync(blockchain.fileno())
+
+
+# ---- Segments ----
+# With a SEGMENT_SIZE the blockchain file is only the active segment, the one blocks are appended to. The
+# commit that grows it past SEGMENT_SIZE cuts it into the next segment file: the file is hard linked under
+# the segment's name, listed in the manifest and replaced by an empty blockchain file, whose first block
+# still points at the last block of the segment. Offsets stay positions in the whole chain, so the
+# sidecars describe the same chain before and after a cut.
+# The manifest records the first and last block hashes, block count and time range of every segment and
+# whether it is sealed. A verify that went through a segment seals it, the manifest then keeps the
+# evidence states at the end of the last sealed segment. Sealed segments are never written again: verify
+# only checks their size and last block (unless full) and resumes after them without a checkpoint, the
+# index is rebuilt from their states, and backups can copy them once. A segment can be moved to any
+# directory of BCHOC_SEGMENT_PATH without touching appends to the active segment.
+
+
+# the file name of segment number, counted from 1
+def segment_name(number):
+    return "%s.%06d" % (path.basename(BLOCKCHAIN_PATH), number)
+
+
+# the path of segment number, or of its archive with extension ARCHIVE_EXTENSION, in the first directory of
+# SEGMENT_DIRS holding it or else where it's cut
+def segment_path(number, extension=""):
+    for directory in SEGMENT_DIRS:
+        if path.exists(path.join(directory, segment_name(number) + extension)):
+            return path.join(directory, segment_name(number) + extension)
+    return path.join(SEGMENT_DIRS[0], segment_name(number) + extension)
+
+
+# read the manifest, returns the list of Segment records, [] for a chain kept in a single file, and with
+# states the StateTable at the end of the last sealed segment (None if none is sealed) as well
+def load_manifest(states=False):
+    try:
+        with open(MANIFEST_PATH, "rb") as manifest:
+            records = manifest.read() if states else manifest.read(MANIFEST_HEADER_STRUCT.size)
+            magic, segment_count = MANIFEST_HEADER_STRUCT.unpack_from(records)
+            if not states:
+                records += manifest.read(segment_count * SEGMENT_STRUCT.size)
+        table_start = MANIFEST_HEADER_STRUCT.size + segment_count * SEGMENT_STRUCT.size
+        if magic != MANIFEST_MAGIC or len(records) < table_start:
+            raise ValueError("segment manifest is truncated")
+        segment_records = records[MANIFEST_HEADER_STRUCT.size : table_start]  # noqa: E203
+        segments = [Segment(*record) for record in SEGMENT_STRUCT.iter_unpack(segment_records)]
+        sealed_states = None
+        if states and len(records) > table_start:
+            sealed_states, _ = StateTable.from_bytes(memoryview(records)[table_start:])
+    except FileNotFoundError:
+        return ([], None) if states else []
+    except (OSError, struct.error, ValueError):
+        raise ChainError("segment manifest is damaged")
+    return (segments, sealed_states) if states else segments
+
+
+# replace the manifest, durably since the segments can't be found without it
+def write_manifest(segments, sealed_states=None):
+    records = bytearray(MANIFEST_HEADER_STRUCT.pack(MANIFEST_MAGIC, len(segments)))
+    for segment in segments:
+        records += SEGMENT_STRUCT.pack(*segment)
+    if sealed_states is not None:
+        records += sealed_states.to_bytes()
+    replace_file(MANIFEST_PATH, records, durable=True)
+
+
+# whether an open blockchain file is still the last segment, after a cut was interrupted before the
+# blockchain file was replaced
+def is_last_segment(chain_file, segments):
+    if len(segments) == 0:
+        return False
+    try:
+        segment_stat = os.stat(segment_path(len(segments)))
+    except OSError:
+        return False
+    chain_stat = os.fstat(chain_file.fileno())
+    return (segment_stat.st_dev, segment_stat.st_ino) == (chain_stat.st_dev, chain_stat.st_ino)
+
+
+# cut the blockchain file, the active segment ending at chain offset end, into the next segment, the caller
+# holds the write lock through the append handle blockchain
+# returns the append handle of the new, empty blockchain file, holding the write lock the same way
+def cut_segment(blockchain, end):
+    os.fsync(blockchain.fileno())
+    segments, sealed_states = load_manifest(states=True)
+    start = segments[-1].start + segments[-1].size if len(segments) > 0 else 0
+    segment = describe_segment(start, end)
+    segment_file = path.join(SEGMENT_DIRS[0], segment_name(len(segments) + 1))
+    if path.exists(segment_file):
+        os.remove(segment_file)  # Left by a cut interrupted before the manifest listed it
+    os.link(BLOCKCHAIN_PATH, segment_file)
+    write_manifest(segments + [segment], sealed_states)
+    return replace_blockchain()
+
+
+# replace the blockchain file with an empty one, which ends a cut
+# returns an append handle on the new file, holding the write lock
+def replace_blockchain():
+    blockchain = open(BLOCKCHAIN_PATH + ".new", "ab")
+    blockchain.truncate(0)
+    fcntl.flock(blockchain.fileno(), fcntl.LOCK_EX)
+    os.replace(BLOCKCHAIN_PATH + ".new", BLOCKCHAIN_PATH)
+    return blockchain
+
+
+# seal the segments ending at or before chain offset end, which a verify found clean with evidence_states
+# at end, the caller holds the write lock
+def seal_segments(end, evidence_states):
+    segments = [
+        segment._replace(sealed=segment.sealed or segment.start + segment.size <= end) for segment in load_manifest()
+    ]
+    sealed = [segment for segment in segments if segment.sealed]
+    if len(sealed) > 0 and sealed[-1].start + sealed[-1].size == end:
+        write_manifest(segments, evidence_states)
+
+
+# check that the sealed segments still have their size and last block, raises ChainError if one doesn't
+def check_segments():
+    chain = ChainMap()
+    try:
+        for number, segment in enumerate(chain.segments, start=1):
+            if not segment.sealed:
+                break
+            chain_view, last_offset = chain.locate(segment.last_offset)
+            if sha1(chain_view[last_offset:]).digest() != segment.last_hash:
+                raise ChainError("segment %d was changed" % number)
+    finally:
+        chain.close()
+
+
+# the Segment record of the blocks between start and end, found through the offset index
+def describe_segment(start, end):
+    chain = ChainMap()
+    try:
+        with open_offsets() as (offsets, sorted_times):
+            first = bisect_left(offsets, start)
+            last = bisect_left(offsets, end, first)
+            block_hashes = []
+            blocks = []
+            for offset in (offsets[first], offsets[last - 1]):
+                chain_view, part_offset = chain.locate(offset)
+                blocks.append(BLOCK_STRUCT.unpack_from(chain_view, part_offset))
+                block_hash = sha1(chain_view[part_offset : part_offset + BLOCK_LEN + blocks[-1][5]])  # noqa: E203
+                block_hashes.append(block_hash.digest())
+            if sorted_times:
+                times = [blocks[0][1], blocks[1][1]]
+            else:
+                times = [
+                    TIMESTAMP_STRUCT.unpack_from(*chain.locate(offsets[position] + TIMESTAMP_POSITION))[0]
+                    for position in range(first, last)
+                ]
+            last_offset = offsets[last - 1]
+    finally:
+        chain.close()
+    return Segment(
+        start, end - start, last - first, last_offset, blocks[0][0], *block_hashes, min(times), max(times), False
+    )
+
+
+# ---- Archives ----
+# A segment can be compressed into an archive, a file named like it with ARCHIVE_EXTENSION. Its blocks are
+# grouped into frames of about ARCHIVE_FRAME_SIZE bytes, never splitting a block, and every frame is
+# compressed on its own with zlib or lzma. The header and the frame index (the segment offset, file offset
+# and compressed size of every frame) come first, so a block is read by decompressing only the frame
+# holding it. The bytes of the segment don't change, nor do the hashes and offsets of its blocks or its
+# manifest record, and expanding an archive restores the segment file byte for byte, checked against the
+# size and sha1 of the segment kept in the header.
+
+
+def compress_frame(frame, compression):
+    if compression == "lzma":
+        return lzma.compress(frame)
+    return zlib.compress(frame, 9)
+
+
+def decompress_frame(frame, compression):
+    if compression == "lzma":
+        return lzma.decompress(frame)
+    return zlib.decompress(frame)
+
+
+# an archive opened for reading, with its header and frame index, frames are decompressed on first use and
+# the last ARCHIVE_CACHE_FRAMES of them are kept
+# raises ChainError when the archive is damaged, FileNotFoundError when there is none
+class SegmentArchive:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.archive = open(file_path, "rb")
+        try:
+            magic, compression, self.size, frame_count, self.digest = ARCHIVE_HEADER_STRUCT.unpack(
+                self.archive.read(ARCHIVE_HEADER_STRUCT.size)
+            )
+            if magic != ARCHIVE_MAGIC or compression >= len(ARCHIVE_COMPRESSIONS) or frame_count == 0:
+                raise ValueError("not an archive")
+            frames = list(FRAME_STRUCT.iter_unpack(self.archive.read(frame_count * FRAME_STRUCT.size)))
+            if len(frames) != frame_count:
+                raise ValueError("frame index is truncated")
+        except (OSError, struct.error, ValueError):
+            self.archive.close()
+            raise ChainError("archive %s is damaged" % file_path)
+        self.compression = ARCHIVE_COMPRESSIONS[compression]
+        self.starts = [frame[0] for frame in frames]
+        self.frame_offsets = [frame[1] for frame in frames]
+        self.frame_sizes = [frame[2] for frame in frames]
+        self.frames = {}
+
+    # the decompressed bytes of a frame
+    def frame(self, number):
+        frame_view = self.frames.pop(number, None)
+        if frame_view is None:
+            frame_end = self.starts[number + 1] if number + 1 < len(self.starts) else self.size
+            try:
+                frame = os.pread(self.archive.fileno(), self.frame_sizes[number], self.frame_offsets[number])
+                frame_view = memoryview(decompress_frame(frame, self.compression))
+            except (OSError, zlib.error, lzma.LZMAError):
+                raise ChainError("archive %s is damaged" % self.file_path)
+            if len(frame_view) != frame_end - self.starts[number]:
+                raise ChainError("archive %s is damaged" % self.file_path)
+            if len(self.frames) >= ARCHIVE_CACHE_FRAMES:
+                del self.frames[next(iter(self.frames))]  # The least recently used
+        self.frames[number] = frame_view
+        return frame_view
+
+    # the frame holding a segment offset and the offset within it
+    def locate(self, offset):
+        number = bisect_right(self.starts, offset) - 1
+        return self.frame(number), offset - self.starts[number]
+
+    # the (segment offset, frame) of the frames between segment offsets start and end
+    def iter_frames(self, start=0, end=None):
+        first = max(bisect_right(self.starts, start) - 1, 0)
+        last = len(self.starts) if end is None else bisect_left(self.starts, end)
+        for number in range(first, last):
+            yield self.starts[number], self.frame(number)
+
+    def close(self):
+        self.frames.clear()
+        self.archive.close()
+
+
+# compress the segment file into an archive at archive_file, segment is its manifest record
+# the archive is written to a temporary file next to archive_file (see temporary_name) and read back before
+# it is returned, the caller moves it in
+# returns the path of the archive written
+def write_archive(segment_file, archive_file, segment, compression="zlib"):
+    archive_temporary = temporary_name(archive_file)
+    segment_map, segment_view = map_file(segment_file)
+    try:
+        if len(segment_view) != segment.size:
+            raise ChainError("segment %s was changed" % segment_file)
+        frame_starts = [0]
+        offset = 0
+        while offset < len(segment_view):
+            if offset - frame_starts[-1] >= ARCHIVE_FRAME_SIZE:
+                frame_starts.append(offset)
+            offset += BLOCK_LEN + LENGTH_STRUCT.unpack_from(segment_view, offset + LENGTH_POSITION)[0]
+        frame_ends = frame_starts[1:] + [len(segment_view)]
+        header = ARCHIVE_HEADER_STRUCT.pack(
+            ARCHIVE_MAGIC,
+            ARCHIVE_COMPRESSIONS.index(compression),
+            len(segment_view),
+            len(frame_starts),
+            sha1(segment_view).digest(),
+        )
+        frame_index = bytearray()
+        file_offset = ARCHIVE_HEADER_STRUCT.size + len(frame_starts) * FRAME_STRUCT.size
+        with open(archive_temporary, "wb") as archive:
+            archive.seek(file_offset)
+            for frame_start, frame_end in zip(frame_starts, frame_ends):
+                frame = compress_frame(segment_view[frame_start:frame_end], compression)
+                frame_index += FRAME_STRUCT.pack(frame_start, file_offset, len(frame))
+                archive.write(frame)
+                file_offset += len(frame)
+            archive.seek(0)
+            archive.write(header)
+            archive.write(frame_index)
+            archive.flush()
+            os.fsync(archive.fileno())
+        try:
+            read_back = check_archive(archive_temporary)
+        except ChainError:
+            read_back = False
+        if not read_back:
+            raise ChainError("archive %s does not read back" % archive_file)
+    except BaseException:
+        remove_temporary(archive_temporary)
+        raise
+    finally:
+        unmap_file(segment_map, segment_view)
+    return archive_temporary
+
+
+# decompress an archive into a segment file at segment_file, written to a temporary file next to it (see
+# temporary_name) and checked against the archive's size and sha1 before it is returned, the caller moves it in
+# returns the path of the segment file written
+def expand_archive(archive_file, segment_file):
+    segment_temporary = temporary_name(segment_file)
+    try:
+        with open(segment_temporary, "wb") as segment:
+            if not check_archive(archive_file, segment):
+                raise ChainError("archive %s is damaged" % archive_file)
+            segment.flush()
+            os.fsync(segment.fileno())
+    except BaseException:
+        remove_temporary(segment_temporary)
+        raise
+    return segment_temporary
+
+
+# decompress every frame of an archive, writing them to output if given
+# returns whether they add up to the size and sha1 of the segment it was made from
+def check_archive(archive_file, output=None):
+    archive = SegmentArchive(archive_file)
+    try:
+        digest = sha1()
+        size = 0
+        for _, frame in archive.iter_frames():
+            digest.update(frame)
+            size += len(frame)
+            if output is not None:
+                output.write(frame)
+        return size == archive.size and digest.digest() == archive.digest
+    finally:
+        archive.close()
+
+
+# the compression and size on disk of segment number, for a segment file None and its size
+def stored_segment(number):
+    segment_file = segment_path(number)
+    if path.exists(segment_file):
+        return None, path.getsize(segment_file)
+    try:
+        archive = SegmentArchive(segment_path(number, ARCHIVE_EXTENSION))
+    except FileNotFoundError:
+        raise ChainError("segment %d is missing" % number)
+    try:
+        return archive.compression, os.fstat(archive.archive.fileno()).st_size
+    finally:
+        archive.close()
+
+
+# ---- Block reader ----
+
+
+# map a file read-only (the blockchain by default), returns the map and a memoryview over it
+def map_file(file_path=None):
+    with open(BLOCKCHAIN_PATH if file_path is None else file_path, "rb") as mapped_file:
+        file_map = mmap.mmap(mapped_file.fileno(), 0, access=mmap.ACCESS_READ)
+    return file_map, memoryview(file_map)
+
+
+# release a map returned by map_file
+def unmap_file(file_map, file_view):
+    file_view.release()
+    try:
+        file_map.close()
+    except BufferError:
+        pass  # A caller still holds a block view, the map is closed once it is released
+
+
+# a temporary file next to file_path named after the process and thread, so processes or threads writing
+# the same file side by side never write into each other's temporary file
+def temporary_name(file_path):
+    return "%s.%d.%d.tmp" % (file_path, os.getpid(), threading.get_ident())
+
+
+# remove a temporary file left by a failed write, if it was created at all
+def remove_temporary(temporary_path):
+    try:
+        os.remove(temporary_path)
+    except OSError:
+        pass
+
+
+# atomically replace a file with records, flushed to disk first when durable
+# the records go through a temporary file (see temporary_name), which is removed if anything fails
+def replace_file(file_path, records, durable=False):
+    temporary_path = temporary_name(file_path)
+    try:
+        with open(temporary_path, "wb") as temporary:
+            temporary.write(records)
+            if durable:
+                temporary.flush()
+                os.fsync(temporary.fileno())
+        os.replace(temporary_path, file_path)
+    except BaseException:
+        remove_temporary(temporary_path)
+        raise
+
+
+# the whole blockchain mapped read-only: the segments of the manifest (see Segments), each mapped (or its
+# archive opened, see Archives) on first use, followed by the blockchain file, mapped up to its size when
+# the map was made
+# blocks never span two parts, nor two frames of an archive, so a block is read through the view of the part
+# (or frame) holding its offset
+class ChainMap:
+    def __init__(self):
+        while True:
+            manifest_stat = stat_file(MANIFEST_PATH)
+            self.segments = load_manifest()
+            self.starts = [segment.start for segment in self.segments]
+            self.maps = [None] * len(self.segments)
+            self.views = [None] * len(self.segments)
+            self.archives = [None] * len(self.segments)
+            self.size = self.segments[-1].start + self.segments[-1].size if len(self.segments) > 0 else 0
+            try:
+                with open(BLOCKCHAIN_PATH, "rb") as chain_file:
+                    file_size = os.fstat(chain_file.fileno()).st_size
+                    if file_size > 0 and not is_last_segment(chain_file, self.segments):
+                        chain_map = mmap.mmap(chain_file.fileno(), file_size, access=mmap.ACCESS_READ)
+                        self.starts.append(self.size)
+                        self.maps.append(chain_map)
+                        self.views.append(memoryview(chain_map))
+                        self.archives.append(None)
+                        self.size += file_size
+            except FileNotFoundError:
                 pass
-        print("State of blockchain: CLEAN")
+            if stat_file(MANIFEST_PATH) == manifest_stat:
+                break
+            self.close()  # A segment was cut meanwhile
+
+    # map a segment, or open its archive when it has no segment file, unless that's done already
+    # raises ChainError if it's missing or doesn't have the size listed in the manifest
+    def open_part(self, part):
+        if self.views[part] is not None or self.archives[part] is not None:
+            return
+        try:
+            self.maps[part], self.views[part] = map_file(segment_path(part + 1))
+            size = len(self.views[part])
+        except FileNotFoundError:
+            try:
+                self.archives[part] = SegmentArchive(segment_path(part + 1, ARCHIVE_EXTENSION))
+            except FileNotFoundError:
+                raise ChainError("segment %d is missing" % (part + 1))
+            size = self.archives[part].size
+        except (OSError, ValueError):
+            raise ChainError("segment %d is missing" % (part + 1))
+        if size != self.segments[part].size:
+            raise ChainError("segment %d was changed" % (part + 1))
+
+    # the view of the part holding a chain offset, or of the frame holding it in an archived segment, and
+    # the offset within it
+    def locate(self, offset):
+        part = bisect_right(self.starts, offset) - 1
+        self.open_part(part)
+        if self.archives[part] is not None:
+            return self.archives[part].locate(offset - self.starts[part])
+        return self.views[part], offset - self.starts[part]
+
+    # the (chain offset, view) of the parts holding the chain between start and end, frame by frame in
+    # archived segments, so only the frames needed are decompressed
+    def iter_parts(self, start, end):
+        for part in range(max(bisect_right(self.starts, start) - 1, 0), bisect_left(self.starts, end)):
+            self.open_part(part)
+            if self.archives[part] is None:
+                yield self.starts[part], self.views[part]
+                continue
+            part_start = self.starts[part]
+            for frame_start, frame in self.archives[part].iter_frames(start - part_start, end - part_start):
+                yield part_start + frame_start, frame
+
+    def close(self):
+        for part, chain_view in enumerate(self.views):
+            if chain_view is not None:
+                unmap_file(self.maps[part], chain_view)
+                self.maps[part] = self.views[part] = None
+            if self.archives[part] is not None:
+                self.archives[part].close()
+                self.archives[part] = None
+
+
+# walk the blockchain through a read-only memory map, from the block at offset start up to end
+# yields the offset of every block, its unpacked header and a memoryview over the header and data,
+# so hashing a block does not copy it
+# blocks for which predicate(view, offset) is false are skipped without being unpacked, the view being
+# that of the part holding the block and the offset within it (see ChainMap)
+# progress(offset, chain size) is called every PROGRESS_STEP bytes
+def iter_blocks(start=0, end=None, predicate=None, progress=None):
+    chain = ChainMap()
+    chain_size = chain.size if end is None else min(end, chain.size)
+    offset = start
+    next_report = start
+    try:
+        while offset < chain_size:
+            chain_view, part_offset = chain.locate(offset)
+            part_start = offset - part_offset
+            part_end = min(chain_size - part_start, len(chain_view))
+            while part_offset < part_end:
+                # A header cut short, or a data length running past the end of the part, is reported rather
+                # than read as a shorter block
+                if part_end - part_offset >= BLOCK_LEN:
+                    data_length = LENGTH_STRUCT.unpack_from(chain_view, part_offset + LENGTH_POSITION)[0]
+                    block_end = part_offset + BLOCK_LEN + data_length
+                if part_end - part_offset < BLOCK_LEN or block_end > len(chain_view):
+                    raise ChainError("blockchain is truncated at offset %d" % (part_start + part_offset))
+                if progress is not None and part_start + part_offset >= next_report:
+                    progress(part_start + part_offset, chain.size)
+                    next_report = part_start + part_offset + PROGRESS_STEP
+                if predicate is not None and not predicate(chain_view, part_offset):
+                    part_offset = block_end
+                    continue
+                block = BLOCK_STRUCT.unpack_from(chain_view, part_offset)  # Unpack the header in place
+                yield part_start + part_offset, block, chain_view[part_offset:block_end]
+                part_offset = block_end
+            offset = part_start + part_offset
+    finally:
+        chain.close()
+
+
+# read the blocks starting at the given offsets, yielding and filtering the same as iter_blocks
+def iter_blocks_at(offsets, predicate=None):
+    chain = ChainMap()
+    try:
+        for offset in offsets:
+            chain_view, part_offset = chain.locate(offset)
+            if predicate is not None and not predicate(chain_view, part_offset):
+                continue
+            block = BLOCK_STRUCT.unpack_from(chain_view, part_offset)
+            yield offset, block, chain_view[part_offset : part_offset + BLOCK_LEN + block[5]]  # noqa: E203
+    finally:
+        chain.close()
+
+
+# walk the blocks between positions first and last of the offset index, yielding and filtering the same
+# as iter_blocks, reverse walks them newest to oldest, only the blocks actually consumed are read
+# progress is called once per batch of offsets, with the bytes walked so far in either direction
+def iter_blocks_indexed(first=0, last=None, reverse=False, predicate=None, progress=None):
+    chain = ChainMap()
+    try:
+        with open_offsets() as (block_offsets, _):
+            last = len(block_offsets) if last is None else min(last, len(block_offsets))
+            position = last if reverse else first
+            while (position > first) if reverse else (position < last):
+                batch_first = max(position - OFFSETS_BATCH, first) if reverse else position
+                batch_last = position if reverse else min(position + OFFSETS_BATCH, last)
+                offsets = block_offsets[batch_first:batch_last].tolist()
+                if progress is not None:
+                    progress(chain.size - offsets[-1] if reverse else offsets[0], chain.size)
+                for offset in reversed(offsets) if reverse else offsets:
+                    chain_view, part_offset = chain.locate(offset)
+                    if predicate is not None and not predicate(chain_view, part_offset):
+                        continue
+                    block = BLOCK_STRUCT.unpack_from(chain_view, part_offset)
+                    yield offset, block, chain_view[part_offset : part_offset + BLOCK_LEN + block[5]]  # noqa: E203
+                position = batch_first if reverse else batch_last
+    finally:
+        chain.close()
+
+
+# ---- Block arrays ----
+# The headers of the whole chain as a NumPy structured array of BLOCK_DTYPE records, for reports that
+# run as array operations instead of a Python loop per block. The memory map is seen through
+# np.frombuffer as overlapping 68 byte windows, one starting at every byte, so the data between headers
+# is skipped by picking the windows at the offsets of the offset index (for verify, at the offsets of the
+# blocks it walked), a single gather for the whole chain however many blocks carry data.
+
+
+# import NumPy the first time it's needed, as the import alone takes longer than most commands, and set
+# the constants built with it, returns the module or None when NumPy isn't installed
+def load_numpy():
+    global np, BLOCK_DTYPE, STATE_WORDS_DTYPE, STATE_TRANSITIONS
+    if np is not None:
+        return np
+    try:
+        import numpy
+    except ImportError:
+        return None
+    BLOCK_DTYPE = numpy.dtype(
+        {
+            "names": list(Block._fields[:6]),
+            "formats": ["S20", "=f8", "S16", "=u4", "S11", "=u4"],
+            "offsets": [0, TIMESTAMP_POSITION, CASE_POSITION, EVIDENCE_POSITION, STATE_POSITION, LENGTH_POSITION],
+            "itemsize": BLOCK_LEN,
+        }
+    )
+    # The state's last 3 bytes and a padding byte make the 4 bytes after the head
+    STATE_WORDS_DTYPE = numpy.dtype(
+        {
+            "names": ["head", "tail"],
+            "formats": ["<u8", "<u4"],
+            "offsets": [STATE_POSITION, STATE_POSITION + 8],
+            "itemsize": BLOCK_LEN,
+        }
+    )
+    STATE_TRANSITIONS = numpy.array(
+        [
+            [valid_transition(previous_state, state) for state in STATE_VALUES]
+            for previous_state in [*STATE_VALUES, None]
+        ]
+    )
+    np = numpy
+    return np
+
+
+# load the offsets and the headers of the blocks starting between start and end (the whole chain by
+# default), returns a uint64 offset array and a BLOCK_DTYPE array
+def load_block_array(start=0, end=None):
+    load_numpy()
+    with open_offsets() as (block_offsets, _):
+        offsets = np.frombuffer(block_offsets, np.uint64).copy()
+    bounds = np.array([start, np.iinfo(np.uint64).max if end is None else end], np.uint64)
+    first, last = np.searchsorted(offsets, bounds)
+    offsets = offsets[first:last]
+    return offsets, gather_headers(offsets)
+
+
+# the headers of the blocks at offsets, a uint64 array in chain order, as a BLOCK_DTYPE array
+def gather_headers(offsets):
+    if len(offsets) == 0:
+        return np.zeros(0, BLOCK_DTYPE)
+    chain = ChainMap()
+    try:
+        # One gather per part of the chain (or frame of an archived segment) holding any of the offsets
+        headers = None
+        for part_start, chain_view in chain.iter_parts(int(offsets[0]), int(offsets[-1]) + 1):
+            part_bounds = np.array([part_start, part_start + len(chain_view)], np.uint64)
+            first, last = np.searchsorted(offsets, part_bounds).tolist()
+            if first == last:
+                continue
+            chain_bytes = np.frombuffer(chain_view, np.uint8)
+            windows = np.lib.stride_tricks.as_strided(
+                chain_bytes, (len(chain_bytes) - BLOCK_LEN + 1, BLOCK_LEN), (1, 1), writeable=False
+            )
+            part_offsets = (offsets[first:last] - np.uint64(part_start)).astype(np.intp)
+            part_headers = windows[part_offsets].view(BLOCK_DTYPE).reshape(-1)
+            del chain_bytes, windows  # Release the views of the map before unmapping it
+            if last - first == len(offsets):
+                headers = part_headers
+                continue
+            if headers is None:
+                headers = np.empty(len(offsets), BLOCK_DTYPE)
+            headers[first:last] = part_headers
+    finally:
+        chain.close()
+    return headers
+
+
+# the position in STATE_NAMES of the state of each header, UNKNOWN for states that aren't valid
+# a state is read as an 8 byte head and a 3 byte tail, the head is looked up among the valid states
+# (whose heads all differ) and the tail has to match too
+def state_codes(headers):
+    state_words = headers.view(STATE_WORDS_DTYPE)
+    heads = np.ascontiguousarray(state_words["head"])
+    tails = state_words["tail"] & np.uint32(0xFFFFFF)  # The 4th byte is the padding before d_length
+    valid_heads = np.array([int.from_bytes(state[:8], "little") for state in STATES.values()], np.uint64)
+    valid_tails = np.array([int.from_bytes(state[8:], "little") for state in STATES.values()], np.uint32)
+    valid_order = np.argsort(valid_heads)
+    positions = valid_order[np.searchsorted(valid_heads[valid_order], heads).clip(max=len(STATES) - 1)]
+    found = (valid_heads[positions] == heads) & (valid_tails[positions] == tails)
+    return np.where(found, positions, len(STATES)).astype(np.uint8)
+
+
+# the positions of item_ids ordered by item, in their original order within an item (a stable argsort)
+# each item id is sorted together with its position as one 64 bit key
+def item_order(item_ids):
+    keys = (item_ids.astype(np.uint64) << np.uint64(32)) | np.arange(len(item_ids), dtype=np.uint64)
+    return (np.sort(keys) & np.uint64(0xFFFFFFFF)).astype(np.intp)
+
+
+# the ChainStats of an array of block headers, items still checked out count as out until now
+def chain_stats(headers, now):
+    codes = state_codes(headers)
+    blocks = np.flatnonzero(codes != STATE_NAMES.index("INITIAL"))
+    item_ids = headers["evidence_id"][blocks]
+    # Blocks of the same item next to each other, in chain order
+    order = blocks[item_order(item_ids)]
+    sorted_ids = headers["evidence_id"][order]
+    last_of_item = np.ones(len(order), bool)
+    last_of_item[:-1] = sorted_ids[1:] != sorted_ids[:-1]
+    latest = order[last_of_item]
+    state_counts = np.bincount(codes[latest], minlength=len(STATE_NAMES))
+    item_states = {STATE_NAMES[code]: int(count) for code, count in enumerate(state_counts) if count > 0}
+    cases, case_counts = np.unique(headers["case_id"][latest], return_counts=True)
+    case_items = {str(case_uuid(case)): int(count) for case, count in zip(cases.tolist(), case_counts.tolist())}
+    # One counter per month and state, counted in a single pass
+    months = (headers["timestamp"][blocks] * 1e6).astype("datetime64[us]").astype("datetime64[M]").astype(np.int64)
+    first_month = months.min() if len(months) > 0 else 0
+    month_counts = np.bincount((months - first_month) * len(STATE_NAMES) + codes[blocks])
+    month_actions = {}
+    for key in np.flatnonzero(month_counts).tolist():
+        month = str(np.datetime64(int(first_month) + key // len(STATE_NAMES), "M"))
+        month_actions.setdefault(month, {})[STATE_NAMES[key % len(STATE_NAMES)]] = int(month_counts[key])
+    # A checkout lasts until the next block of the same item
+    checkouts = np.flatnonzero(codes[order] == STATE_NAMES.index("CHECKEDOUT"))
+    ends = np.full(len(checkouts), now)
+    followed = ~last_of_item[checkouts]
+    ends[followed] = headers["timestamp"][order[checkouts[followed] + 1]]
+    durations = np.maximum(ends - headers["timestamp"][order[checkouts]], 0)
+    return ChainStats(
+        len(headers),
+        len(latest),
+        item_states,
+        case_items,
+        month_actions,
+        len(checkouts),
+        float(durations.sum()),
+        float(durations.max()) if len(durations) > 0 else 0.0,
+    )
+
+
+# ---- Chain tail and latest-state index ----
+# The tail record stores the size of the chain and the offset and hash of its last block, so a
+# write path can find the hash to chain onto by re-hashing a single block instead of the whole file.
+# The index lives next to the blockchain and maps every evidence id to the state, case id and
+# offset of its most recent block. Its header pins it to the same tail, so a stale index is
+# detected without reading the chain. It holds a serialized StateTable, followed by the records of
+# the blocks appended since it was written.
+
+
+# the latest state, case id and block offset of every evidence item, kept by the engine for its write
+# paths, by verify and in the index and verify checkpoint sidecars
+# items are held in parallel arrays sorted by evidence id, 17 bytes an item: the id, the state code (see
+# STATE_CODES), a case code (the position of the case id in case_ids) and the offset
+# new items wait in added until STATE_TABLE_MERGE of them (or an eighth of the table) are merged in
+class StateTable:
+    def __init__(self):
+        self.ids = array("I")
+        self.states = array("B")
+        self.cases = array("I")
+        self.offsets = array("Q")
+        self.case_ids = []
+        self.case_codes = {}
+        self.added = {}  # evidence id -> (state code, case code, offset)
+
+    def __len__(self):
+        return len(self.ids) + len(self.added)
+
+    # the IndexEntry of an item, or default if it isn't in the table
+    def get(self, evidence_id, default=None):
+        record = self.find(evidence_id)
+        if record is None:
+            return default
+        return IndexEntry(STATE_VALUES[record[0]], self.case_ids[record[1]], record[2])
+
+    # the latest state of an item, or None if it isn't in the table
+    def get_state(self, evidence_id):
+        record = self.find(evidence_id)
+        return None if record is None else STATE_VALUES[record[0]]
+
+    # the (state code, case code, offset) of an item, or None
+    def find(self, evidence_id):
+        record = self.added.get(evidence_id)
+        if record is not None:
+            return record
+        position = bisect_left(self.ids, evidence_id)
+        if position < len(self.ids) and self.ids[position] == evidence_id:
+            return self.states[position], self.cases[position], self.offsets[position]
+        return None
+
+    # record the latest block of an item
+    def set(self, evidence_id, state, case_id, offset):
+        state_code = STATE_CODES.get(state, len(STATES))
+        case_code = self.case_code(case_id)
+        position = bisect_left(self.ids, evidence_id)
+        if position < len(self.ids) and self.ids[position] == evidence_id:
+            self.states[position] = state_code
+            self.cases[position] = case_code
+            self.offsets[position] = offset
+            return
+        self.added[evidence_id] = (state_code, case_code, offset)
+        if len(self.added) >= max(STATE_TABLE_MERGE, len(self.ids) >> 3):
+            self.merge()
+
+    # record the latest blocks of items given as {evidence id: (state, case id, offset)}
+    def update(self, entries):
+        for evidence_id, entry in entries.items():
+            self.set(evidence_id, *entry)
+
+    # the code of a case id, added to case_ids if it's new
+    def case_code(self, case_id):
+        case_code = self.case_codes.get(case_id)
+        if case_code is None:
+            case_code = len(self.case_ids)
+            self.case_ids.append(case_id)
+            self.case_codes[case_id] = case_code
+        return case_code
+
+    # merge the added items into the sorted arrays, copying the stretches between them with slices
+    def merge(self):
+        if len(self.added) == 0:
+            return
+        ids, states, cases, offsets = array("I"), array("B"), array("I"), array("Q")
+        previous = 0
+        for evidence_id in sorted(self.added):
+            position = bisect_left(self.ids, evidence_id, previous)
+            ids += self.ids[previous:position]
+            states += self.states[previous:position]
+            cases += self.cases[previous:position]
+            offsets += self.offsets[previous:position]
+            state_code, case_code, offset = self.added[evidence_id]
+            ids.append(evidence_id)
+            states.append(state_code)
+            cases.append(case_code)
+            offsets.append(offset)
+            previous = position
+        ids += self.ids[previous:]
+        states += self.states[previous:]
+        cases += self.cases[previous:]
+        offsets += self.offsets[previous:]
+        self.ids, self.states, self.cases, self.offsets = ids, states, cases, offsets
+        self.added = {}
+
+    # record the latest blocks of items given as NumPy arrays of sorted unique evidence ids, state codes,
+    # case ids (S16, as read by load_block_array) and offsets, see check_state_array
+    def update_arrays(self, evidence_ids, state_codes, case_ids, offsets):
+        load_numpy()
+        self.merge()
+        distinct_cases, case_positions = np.unique(case_ids, return_inverse=True)
+        case_codes = np.array(
+            [self.case_code(case_id.ljust(16, b"\0")) for case_id in distinct_cases.tolist()], np.uint32
+        )[case_positions.reshape(-1)]
+        table_ids = np.frombuffer(self.ids, np.uint32)
+        positions = np.searchsorted(table_ids, evidence_ids)
+        known = positions < len(table_ids)
+        known[known] = table_ids[positions[known]] == evidence_ids[known]
+        columns = [np.frombuffer(self.ids, np.uint32), np.frombuffer(self.states, np.uint8)]
+        columns += [np.frombuffer(self.cases, np.uint32), np.frombuffer(self.offsets, np.uint64)]
+        values = [evidence_ids, state_codes, case_codes, offsets]
+        for column, column_values in zip(columns[1:], values[1:]):
+            column[positions[known]] = column_values[known]
+        new = ~known
+        merged = [
+            np.insert(column, positions[new], column_values[new]) for column, column_values in zip(columns, values)
+        ]
+        del table_ids, columns  # Release the arrays before replacing them
+        self.ids, self.states, self.cases, self.offsets = (
+            array(column.typecode, merged_column.tobytes())
+            for column, merged_column in zip((self.ids, self.states, self.cases, self.offsets), merged)
+        )
+
+    # the table as bytes, ready to be written with a single write
+    def to_bytes(self):
+        self.merge()
+        return b"".join(
+            [
+                STATE_TABLE_HEADER_STRUCT.pack(len(self.ids), len(self.case_ids)),
+                self.ids.tobytes(),
+                self.cases.tobytes(),
+                self.offsets.tobytes(),
+                self.states.tobytes(),
+                b"".join(self.case_ids),
+            ]
+        )
+
+    # read a table written by to_bytes at the start of buffer, returns it and the bytes it took up
+    # raises ValueError when buffer is too short
+    @classmethod
+    def from_bytes(cls, buffer):
+        table = cls()
+        item_count, case_count = STATE_TABLE_HEADER_STRUCT.unpack_from(buffer)
+        position = STATE_TABLE_HEADER_STRUCT.size
+        for column in (table.ids, table.cases, table.offsets, table.states):
+            column.frombytes(buffer[position : position + item_count * column.itemsize])
+            position += item_count * column.itemsize
+            if len(column) != item_count:
+                raise ValueError("state table is truncated")
+        for _ in range(case_count):
+            table.case_code(bytes(buffer[position : position + 16]))
+            position += 16
+        if position > len(buffer):
+            raise ValueError("state table is truncated")
+        return table, position
+
+    # build a table from {evidence id: (state, case id, offset)}
+    @classmethod
+    def from_entries(cls, entries):
+        table = cls()
+        for evidence_id in sorted(entries):
+            state, case_id, offset = entries[evidence_id]
+            table.ids.append(evidence_id)
+            table.states.append(STATE_CODES.get(state, len(STATES)))
+            table.cases.append(table.case_code(case_id))
+            table.offsets.append(offset)
+        return table
+
+
+# check that the bytes between offset and end still hash to block_hash, with last that they end the chain
+def block_matches(offset, end, block_hash, last=False):
+    chain = ChainMap()
+    try:
+        if offset >= end or chain.size < end or (last and chain.size != end):
+            return False
+        chain_view, part_offset = chain.locate(offset)
+        return sha1(chain_view[part_offset : part_offset + end - offset]).digest() == block_hash  # noqa: E203
+    finally:
+        chain.close()
+
+
+# check that the block at tail_offset is the last block of the chain and still has the same hash
+def tail_matches(chain_size, tail_offset, tail_hash):
+    return chain_size > 0 and block_matches(tail_offset, chain_size, tail_hash, last=True)
+
+
+# scan the blockchain to find its last block, used when the tail record can't be trusted
+# a segmented chain is only scanned after its last segment
+def scan_tail():
+    segments = load_manifest()
+    chain_size = 0
+    tail_offset = 0
+    tail_hash = None
+    if len(segments) > 0:
+        chain_size = segments[-1].start + segments[-1].size
+        tail_offset, tail_hash = segments[-1].last_offset, segments[-1].last_hash
+    for offset, block, block_bytes in iter_blocks(chain_size):
+        tail_hash = sha1(block_bytes).digest()
+        tail_offset = offset
+        chain_size = offset + BLOCK_LEN + block[5]
+    if tail_hash is not None:
+        write_tail(chain_size, tail_offset, tail_hash)
+    return chain_size, tail_hash
+
+
+# find a torn final block: bytes after the block the tail record describes that don't make up a whole
+# block, as a crash in the middle of an append leaves them
+# only the tail is checked, without a tail record describing a prefix of the blockchain file (the active
+# segment of a segmented chain) nothing is found, so a block damaged in the middle of the chain is left for
+# verify to report instead of being mistaken for a torn one
+# returns the chain offset and the size of the torn bytes, or None
+def find_torn_tail():
+    segments = load_manifest()
+    file_start = segments[-1].start + segments[-1].size if len(segments) > 0 else 0  # Chain offset of the file
+    file_size = path.getsize(BLOCKCHAIN_PATH)
+    try:
+        with open(TAIL_PATH, "rb") as tail:
+            chain_size, tail_offset, tail_hash = TAIL_STRUCT.unpack(tail.read())
+    except (OSError, struct.error):
+        return None
+    if not file_start <= chain_size < file_start + file_size or not block_matches(tail_offset, chain_size, tail_hash):
+        return None
+    torn_size = file_start + file_size - chain_size
+    with open(BLOCKCHAIN_PATH, "rb") as chain_file:
+        chain_file.seek(chain_size - file_start)
+        header = chain_file.read(BLOCK_LEN)
+    if len(header) == BLOCK_LEN and BLOCK_LEN + LENGTH_STRUCT.unpack_from(header, LENGTH_POSITION)[0] <= torn_size:
+        return None  # Whole blocks follow the tail record, they are not cut
+    return chain_size, torn_size
+
+
+# cut a torn final block, see find_torn_tail, the caller holds the write lock
+# the bytes cut are appended to TORN_PATH first
+# returns the chain offset and the size of the bytes cut, or None when there is no torn block
+def recover_tail(blockchain):
+    torn = find_torn_tail()
+    if torn is None:
+        return None
+    file_size = os.fstat(blockchain.fileno()).st_size
+    with open(BLOCKCHAIN_PATH, "rb") as chain_file:
+        chain_file.seek(file_size - torn[1])
+        torn_bytes = chain_file.read()
+    with open(TORN_PATH, "ab") as torn_file:
+        torn_file.write(torn_bytes)
+        torn_file.flush()
+        os.fsync(torn_file.fileno())
+    os.ftruncate(blockchain.fileno(), file_size - torn[1])
+    os.fsync(blockchain.fileno())
+    return torn
+
+
+# overwrite the tail record
+def write_tail(chain_size, tail_offset, tail_hash):
+    try:
+        replace_file(TAIL_PATH, TAIL_STRUCT.pack(chain_size, tail_offset, tail_hash))
+    except OSError:
+        pass  # The tail record is only a cache, the next append will rescan
+
+
+# return the chain size and the hash of the last block
+# falls back to a full rescan when the tail record is missing or the chain was changed outside bchoc
+def load_tail():
+    try:
+        with open(TAIL_PATH, "rb") as tail:
+            chain_size, tail_offset, tail_hash = TAIL_STRUCT.unpack(tail.read())
+        if tail_matches(chain_size, tail_offset, tail_hash):
+            return chain_size, tail_hash
+    except (OSError, struct.error):
+        pass
+    return scan_tail()
+
+
+# scan the blockchain and rebuild the index from scratch, or from the evidence states at the end of the
+# last sealed segment of a segmented chain
+def build_index():
+    segments, sealed_states = load_manifest(states=True)
+    latest = {}
+    chain_size = 0
+    tail_offset = 0
+    tail_hash = None
+    if sealed_states is not None:
+        sealed = [segment for segment in segments if segment.sealed][-1]
+        chain_size = sealed.start + sealed.size
+        tail_offset, tail_hash = sealed.last_offset, sealed.last_hash
+    for offset, block, block_bytes in iter_blocks(chain_size):
+        tail_hash = sha1(block_bytes).digest()
+        tail_offset = offset
+        latest[block[3]] = (block[4], block[2], offset)
+        chain_size = offset + BLOCK_LEN + block[5]
+    if sealed_states is None:
+        entries = StateTable.from_entries(latest)
     else:
-        print("Transactions in blockchain: 0")
+        entries = sealed_states
+        entries.update(latest)
+    if tail_hash is not None:
+        write_tail(chain_size, tail_offset, tail_hash)
+        write_index(entries, chain_size, tail_offset, tail_hash)
+    return entries, chain_size, tail_hash
+
+
+# write the full index (a StateTable) atomically with a single write, replacing any previous one
+def write_index(entries, chain_size, tail_offset, tail_hash):
+    records = INDEX_HEADER_STRUCT.pack(INDEX_MAGIC, chain_size, tail_offset, tail_hash) + entries.to_bytes()
+    try:
+        replace_file(INDEX_PATH, records)
+    except OSError:
+        pass  # The index is only a cache, the next lookup will rebuild it
+
+
+# load the index, rebuilding it when it is missing or no longer matches the chain
+# the records update_index appended after the table are applied on top of it, and once there are more
+# than INDEX_JOURNAL_LIMIT of them the index is rewritten as a single table
+# returns the StateTable of the entries, the chain size and the hash of the last block
+def load_index():
+    if not path.exists(BLOCKCHAIN_PATH):
+        return StateTable(), 0, None
+    chain_size, tail_hash = load_tail()
+    try:
+        with open(INDEX_PATH, "rb") as index:
+            records = index.read()
+        magic, index_size, tail_offset, index_hash = INDEX_HEADER_STRUCT.unpack_from(records)
+        if magic != INDEX_MAGIC or index_size != chain_size or index_hash != tail_hash:
+            return build_index()
+        entries, table_size = StateTable.from_bytes(memoryview(records)[INDEX_HEADER_STRUCT.size :])
+        journal = memoryview(records)[INDEX_HEADER_STRUCT.size + table_size :]
+        for evidence_id, case_id, state, offset in INDEX_ENTRY_STRUCT.iter_unpack(journal):
+            entries.set(evidence_id, state, case_id, offset)
+    except (OSError, struct.error, ValueError):
+        return build_index()
+    if len(journal) > INDEX_JOURNAL_LIMIT * INDEX_ENTRY_STRUCT.size:
+        write_index(entries, chain_size, tail_offset, tail_hash)
+    return entries, chain_size, tail_hash
+
+
+# append the entries of freshly written blocks to the index and move its tail forward
+# the index is only touched if it described the chain right before these blocks were appended
+def update_index(prev_hash, new_entries, chain_size, tail_hash):
+    if len(new_entries) == 0:
+        return
+    try:
+        with open(INDEX_PATH, "r+b") as index:
+            magic, old_size, _, old_hash = INDEX_HEADER_STRUCT.unpack(index.read(INDEX_HEADER_STRUCT.size))
+            if magic != INDEX_MAGIC or old_size != new_entries[0].offset or old_hash != prev_hash:
+                return
+            records = bytearray()
+            for entry in new_entries:
+                records += INDEX_ENTRY_STRUCT.pack(entry.evidence_id, entry.case_id, entry.state, entry.offset)
+            index.seek(0, os.SEEK_END)
+            index.write(records)
+            # Header goes last, so an interrupted update leaves a stale index that gets rebuilt
+            index.seek(0)
+            index.write(INDEX_HEADER_STRUCT.pack(INDEX_MAGIC, chain_size, new_entries[-1].offset, tail_hash))
+    except (OSError, struct.error):
+        pass
+
+
+# ---- Block offset index ----
+# A packed array with the start offset of every block, pinned to the chain tail like the index.
+# The header also remembers the newest timestamp and whether timestamps never went backward, which is
+# what lets time ranges be found by binary search.
+
+
+# walk the data lengths of the chain and write the offset of every block
+# returns the number of blocks, whether their timestamps are in order and the array of their offsets,
+# which stays usable when the offset index can't be written
+def build_offsets(chain_size, tail_hash):
+    offsets = array("Q")
+    last_timestamp = float("-inf")
+    sorted_times = True
+    chain = ChainMap()
+    try:
+        offset = 0
+        while offset < chain_size:
+            chain_view, part_offset = chain.locate(offset)
+            part_start = offset - part_offset
+            part_end = min(chain_size - part_start, len(chain_view))
+            while part_offset < part_end:
+                offsets.append(part_start + part_offset)
+                timestamp = TIMESTAMP_STRUCT.unpack_from(chain_view, part_offset + TIMESTAMP_POSITION)[0]
+                sorted_times = sorted_times and timestamp >= last_timestamp
+                last_timestamp = max(timestamp, last_timestamp)
+                part_offset += BLOCK_LEN + LENGTH_STRUCT.unpack_from(chain_view, part_offset + LENGTH_POSITION)[0]
+            offset = part_start + part_offset
+    finally:
+        chain.close()
+    try:
+        replace_file(
+            OFFSETS_PATH,
+            OFFSETS_HEADER_STRUCT.pack(OFFSETS_MAGIC, chain_size, tail_hash, last_timestamp, sorted_times)
+            + offsets.tobytes(),
+        )
+    except OSError:
+        pass  # The offset index is only a cache, the next lookup will rebuild it
+    return len(offsets), sorted_times, offsets
+
+
+# make sure the offset index matches the chain, rebuilding it if needed
+# returns the number of blocks in it and whether their timestamps are in order
+def load_offsets():
+    block_count, sorted_times, _ = check_offsets()
+    return block_count, sorted_times
+
+
+# load_offsets, also returning the array of offsets when the index had to be rebuilt (None otherwise)
+def check_offsets():
+    if not path.exists(BLOCKCHAIN_PATH):
+        return 0, True, array("Q")
+    chain_size, tail_hash = load_tail()
+    if tail_hash is None:
+        return 0, True, array("Q")
+    try:
+        with open(OFFSETS_PATH, "rb") as offsets_file:
+            magic, offsets_size, offsets_hash, _, sorted_times = OFFSETS_HEADER_STRUCT.unpack(
+                offsets_file.read(OFFSETS_HEADER_STRUCT.size)
+            )
+            block_count, remainder = divmod(path.getsize(OFFSETS_PATH) - OFFSETS_HEADER_STRUCT.size, 8)
+        if magic == OFFSETS_MAGIC and offsets_size == chain_size and offsets_hash == tail_hash and remainder == 0:
+            return block_count, sorted_times, None
+    except (OSError, struct.error):
+        pass
+    return build_offsets(chain_size, tail_hash)
+
+
+# the offsets of the offset index, a sequence of ints, and whether their timestamps are in order
+# the index is mapped read-only, unless it was just rebuilt and its offsets are at hand anyway, which is
+# also how readers go on when it can't be written
+@contextmanager
+def open_offsets():
+    block_count, sorted_times, offsets = check_offsets()
+    if offsets is None:
+        try:
+            offsets_map, offsets_view = map_file(OFFSETS_PATH)
+        except (OSError, ValueError):
+            # Removed meanwhile, walk the chain
+            block_count, sorted_times, offsets = build_offsets(*load_tail())
+    if offsets is not None:
+        yield offsets, sorted_times
+        return
+    offsets = offsets_view[OFFSETS_HEADER_STRUCT.size : OFFSETS_HEADER_STRUCT.size + block_count * 8]  # noqa: E203
+    offsets = offsets.cast("Q")
+    try:
+        yield offsets, sorted_times
+    finally:
+        offsets.release()
+        unmap_file(offsets_map, offsets_view)
+
+
+# append the offsets of freshly written blocks, if the offset index described the chain right before them
+def update_offsets(prev_hash, new_entries, chain_size, tail_hash):
+    try:
+        with open(OFFSETS_PATH, "r+b") as offsets_file:
+            magic, old_size, old_hash, last_timestamp, sorted_times = OFFSETS_HEADER_STRUCT.unpack(
+                offsets_file.read(OFFSETS_HEADER_STRUCT.size)
+            )
+            if magic != OFFSETS_MAGIC or old_size != new_entries[0].offset or old_hash != prev_hash:
+                return
+            for entry in new_entries:
+                sorted_times = sorted_times and entry.timestamp >= last_timestamp
+                last_timestamp = max(entry.timestamp, last_timestamp)
+            offsets_file.seek(0, os.SEEK_END)
+            offsets_file.write(array("Q", [entry.offset for entry in new_entries]).tobytes())
+            offsets_file.seek(0)
+            offsets_file.write(
+                OFFSETS_HEADER_STRUCT.pack(OFFSETS_MAGIC, chain_size, tail_hash, last_timestamp, sorted_times)
+            )
+    except (OSError, struct.error):
+        pass
+
+
+# position of the first block in offsets with a timestamp at or after value
+def search_timestamps(chain, offsets, value):
+    low = 0
+    high = len(offsets)
+    while low < high:
+        middle = (low + high) // 2
+        if TIMESTAMP_STRUCT.unpack_from(*chain.locate(offsets[middle] + TIMESTAMP_POSITION))[0] < value:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+# find the positions of the first and last blocks in [since, until) by binary search over the timestamps
+# returns (first, last) block positions, or None when timestamps are out of order and a scan is needed
+def find_time_window(since, until):
+    chain = ChainMap()
+    try:
+        with open_offsets() as (offsets, sorted_times):
+            if not sorted_times:
+                return None
+            first = 0 if since is None else search_timestamps(chain, offsets, since)
+            last = len(offsets) if until is None else search_timestamps(chain, offsets, until)
+    finally:
+        chain.close()
+    return first, max(first, last)
+
+
+# ---- Case and item posting lists ----
+
+
+# write sorted case and item postings atomically, replacing any previous file and its journal
+def write_postings(case_postings, item_postings, chain_size, tail_hash):
+    records = bytearray(
+        POSTINGS_HEADER_STRUCT.pack(POSTINGS_MAGIC, chain_size, tail_hash, len(case_postings), len(item_postings))
+    )
+    for posting in case_postings:
+        records += CASE_POSTING_STRUCT.pack(*posting)
+    for posting in item_postings:
+        records += ITEM_POSTING_STRUCT.pack(*posting)
+    try:
+        replace_file(POSTINGS_PATH, records)
+    except OSError:
+        pass  # The posting lists are only a cache, the next lookup will rebuild them
+
+
+# scan the chain and rebuild the posting lists from scratch
+def build_postings(chain_size, tail_hash):
+    case_postings = []
+    item_postings = []
+    for offset, block, _ in iter_blocks(0, chain_size):
+        case_postings.append((block[2], offset))
+        item_postings.append((block[3], offset))
+    case_postings.sort()
+    item_postings.sort()
+    write_postings(case_postings, item_postings, chain_size, tail_hash)
+
+
+# fold the journal into the sorted posting lists
+def compact_postings(postings_view, case_count, item_count, chain_size, tail_hash):
+    items_start = POSTINGS_HEADER_STRUCT.size + case_count * CASE_POSTING_STRUCT.size
+    journal_start = items_start + item_count * ITEM_POSTING_STRUCT.size
+    case_postings = list(CASE_POSTING_STRUCT.iter_unpack(postings_view[POSTINGS_HEADER_STRUCT.size : items_start]))
+    item_postings = list(ITEM_POSTING_STRUCT.iter_unpack(postings_view[items_start:journal_start]))
+    for case_id, evidence_id, offset in JOURNAL_POSTING_STRUCT.iter_unpack(postings_view[journal_start:]):
+        case_postings.append((case_id, offset))
+        item_postings.append((evidence_id, offset))
+    case_postings.sort()
+    item_postings.sort()
+    write_postings(case_postings, item_postings, chain_size, tail_hash)
+
+
+# binary search a sorted posting section for key, returns the offsets of its blocks in chain order
+def search_postings(postings_view, start, count, posting_struct, key):
+    low = 0
+    high = count
+    while low < high:
+        middle = (low + high) // 2
+        if posting_struct.unpack_from(postings_view, start + middle * posting_struct.size)[0] < key:
+            low = middle + 1
+        else:
+            high = middle
+    offsets = []
+    while low < count:
+        posting_key, offset = posting_struct.unpack_from(postings_view, start + low * posting_struct.size)
+        if posting_key != key:
+            break
+        offsets.append(offset)
+        low += 1
+    return offsets
+
+
+# map the posting lists if they describe the chain with the given tail
+# returns the map, a memoryview over it and the number of case, item and journal postings, or None
+def map_postings(chain_size, tail_hash):
+    try:
+        postings_map, postings_view = map_file(POSTINGS_PATH)
+    except (OSError, ValueError):
+        return None
+    try:
+        magic, postings_size, postings_hash, case_count, item_count = POSTINGS_HEADER_STRUCT.unpack_from(postings_view)
+        journal_start = (
+            POSTINGS_HEADER_STRUCT.size + case_count * CASE_POSTING_STRUCT.size + item_count * ITEM_POSTING_STRUCT.size
+        )
+        journal_count, remainder = divmod(len(postings_view) - journal_start, JOURNAL_POSTING_STRUCT.size)
+        if (
+            magic == POSTINGS_MAGIC
+            and postings_size == chain_size
+            and postings_hash == tail_hash
+            and journal_count >= 0
+            and remainder == 0
+        ):
+            return postings_map, postings_view, case_count, item_count, journal_count
+    except struct.error:
+        pass
+    unmap_file(postings_map, postings_view)
+    return None
+
+
+# find the offsets of the blocks belonging to any of case_ids (16 byte ids) and any of item_ids
+# an empty set doesn't filter, returns the offsets in chain order or None if there are no posting lists
+def lookup_postings(case_ids, item_ids):
+    if not path.exists(BLOCKCHAIN_PATH):
+        return []
+    chain_size, tail_hash = load_tail()
+    if tail_hash is None:
+        return []
+    postings = map_postings(chain_size, tail_hash)
+    if postings is None:
+        build_postings(chain_size, tail_hash)
+        postings = map_postings(chain_size, tail_hash)
+        if postings is None:
+            return None
+    postings_map, postings_view, case_count, item_count, journal_count = postings
+    items_start = POSTINGS_HEADER_STRUCT.size + case_count * CASE_POSTING_STRUCT.size
+    journal_start = items_start + item_count * ITEM_POSTING_STRUCT.size
+    try:
+        case_offsets = set()
+        for case_id in case_ids:
+            case_offsets.update(
+                search_postings(postings_view, POSTINGS_HEADER_STRUCT.size, case_count, CASE_POSTING_STRUCT, case_id)
+            )
+        item_offsets = set()
+        for item_id in item_ids:
+            item_offsets.update(search_postings(postings_view, items_start, item_count, ITEM_POSTING_STRUCT, item_id))
+        for case_id, evidence_id, offset in JOURNAL_POSTING_STRUCT.iter_unpack(postings_view[journal_start:]):
+            if case_id in case_ids:
+                case_offsets.add(offset)
+            if evidence_id in item_ids:
+                item_offsets.add(offset)
+        if journal_count > POSTINGS_JOURNAL_LIMIT:
+            compact_postings(postings_view, case_count, item_count, chain_size, tail_hash)
+    finally:
+        unmap_file(postings_map, postings_view)
+    if len(case_ids) > 0 and len(item_ids) > 0:
+        return sorted(case_offsets & item_offsets)
+    return sorted(case_offsets | item_offsets)
+
+
+# read a page of count offsets at row start of the sorted case or item postings, counted from the end
+# when reverse, the journal is merged into the page, so a page costs the same however many blocks were
+# appended since the last compaction (up to POSTINGS_JOURNAL_LIMIT, past which it is compacted first)
+# returns the offsets and the number of postings in the section, or None if there are no posting lists
+def read_posting_section(section, start, count, reverse):
+    if not path.exists(BLOCKCHAIN_PATH):
+        return [], 0
+    chain_size, tail_hash = load_tail()
+    if tail_hash is None:
+        return [], 0
+    postings = map_postings(chain_size, tail_hash)
+    if postings is None:
+        build_postings(chain_size, tail_hash)
+        postings = map_postings(chain_size, tail_hash)
+    elif postings[4] > POSTINGS_JOURNAL_LIMIT:
+        compact_postings(postings[1], postings[2], postings[3], chain_size, tail_hash)
+        unmap_file(postings[0], postings[1])
+        postings = map_postings(chain_size, tail_hash)
+    if postings is None:
+        return None
+    postings_map, postings_view, case_count, item_count, journal_count = postings
+    journal_start = (
+        POSTINGS_HEADER_STRUCT.size + case_count * CASE_POSTING_STRUCT.size + item_count * ITEM_POSTING_STRUCT.size
+    )
+    if section == "case":
+        section_start, section_count, posting_struct = POSTINGS_HEADER_STRUCT.size, case_count, CASE_POSTING_STRUCT
+    else:
+        section_start = POSTINGS_HEADER_STRUCT.size + case_count * CASE_POSTING_STRUCT.size
+        section_count, posting_struct = item_count, ITEM_POSTING_STRUCT
+    try:
+        journal = sorted(
+            (case_id if section == "case" else evidence_id, offset)
+            for case_id, evidence_id, offset in JOURNAL_POSTING_STRUCT.iter_unpack(postings_view[journal_start:])
+        )
+        # The position of every journal posting in the section with the journal merged in
+        journal_positions = [
+            search_section(postings_view, section_start, section_count, posting_struct, posting) + position
+            for position, posting in enumerate(journal)
+        ]
+        total = section_count + len(journal)
+        first, last = page_positions(start, count, total, reverse)
+        journal_position = bisect_left(journal_positions, first)
+        section_position = first - journal_position
+        offsets = []
+        for position in range(first, last):
+            if journal_position < len(journal) and journal_positions[journal_position] == position:
+                offsets.append(journal[journal_position][1])
+                journal_position += 1
+            else:
+                offsets.append(
+                    posting_struct.unpack_from(postings_view, section_start + section_position * posting_struct.size)[1]
+                )
+                section_position += 1
+    finally:
+        unmap_file(postings_map, postings_view)
+    if reverse:
+        offsets.reverse()
+    return offsets, total
+
+
+# binary search a sorted posting section for the number of postings before posting, a (key, offset) tuple
+def search_section(postings_view, start, count, posting_struct, posting):
+    low = 0
+    high = count
+    while low < high:
+        middle = (low + high) // 2
+        if posting_struct.unpack_from(postings_view, start + middle * posting_struct.size) < posting:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+# add the postings of freshly written blocks to the journal, if the posting lists described the chain
+# right before them
+def update_postings(prev_hash, new_entries, chain_size, tail_hash):
+    try:
+        with open(POSTINGS_PATH, "r+b") as postings:
+            magic, old_size, old_hash, case_count, item_count = POSTINGS_HEADER_STRUCT.unpack(
+                postings.read(POSTINGS_HEADER_STRUCT.size)
+            )
+            if magic != POSTINGS_MAGIC or old_size != new_entries[0].offset or old_hash != prev_hash:
+                return
+            records = bytearray()
+            for entry in new_entries:
+                records += JOURNAL_POSTING_STRUCT.pack(entry.case_id, entry.evidence_id, entry.offset)
+            postings.seek(0, os.SEEK_END)
+            postings.write(records)
+            postings.seek(0)
+            postings.write(POSTINGS_HEADER_STRUCT.pack(POSTINGS_MAGIC, chain_size, tail_hash, case_count, item_count))
+    except (OSError, struct.error):
+        pass
+
+
+# record blocks that were just appended after the block with hash prev_hash
+def record_append(prev_hash, new_entries, chain_size, tail_hash):
+    if len(new_entries) > 0:
+        write_tail(chain_size, new_entries[-1].offset, tail_hash)
+        update_index(prev_hash, new_entries, chain_size, tail_hash)
+        update_offsets(prev_hash, new_entries, chain_size, tail_hash)
+        update_postings(prev_hash, new_entries, chain_size, tail_hash)
 
 
 def print_menu():
@@ -677,20 +3597,52 @@ def print_menu():
         "\tadd -c case_id -i item_id [-i item_id ...]\n"
         "\tcheckout -i item_id\n"
         "\tcheckin -i item_id\n"
-        "\tlog [-r] [-n num_entries] [-c case_id] [-i item_id]\n"
+        "\tlog [-r] [-n num_entries] [-c case_id] [-i item_id] [-s state] [--since time] [--until time]\n"
+        "\t    [--format text|jsonl|csv]\n"
         "\tremove -i item_id -y reason [-o owner]\n"
         "\tinit\n"
-        "\tverify\n"
+        "\tverify [--full] [--jobs num_jobs] [--engine python|numpy]\n"
+        "\tbatch [-f file]\n"
+        "\tstatus -i item_id\n"
+        "\tstats\n"
+        "\tsegments\n"
+        "\tarchive [-n num_segments] [--lzma] [--cut]\n"
+        "\texpand [-n num_segments]\n"
+        "\tserve\n"
         "Tags:\n"
         "\t-c case_id\tMust be a valid UUID. When used with log only blocks with the given case_id are returned.\n"
         "\t-i item_id\tWhen used with log only blocks with the given item_id are returned. "
         "The item ID must be unique within the blockchain.\n"
         "\t-r, --reverse\tReverses the order of the block entries to show the most recent entries first.\n"
         "\t-n num_entries\tWhen used with log, shows num_entries number of block entries.\n"
+        "\t-s state\tWhen used with log only blocks with the given state are returned.\n"
+        "\t--since time, --until time\tWhen used with log, only blocks from time (inclusive) until time "
+        "(exclusive) are returned. Times are ISO 8601, as shown by log.\n"
+        "\t--format format\tOutput format of log: text (default), jsonl (one JSON object per block) or csv "
+        "(with a header row).\n"
         "\t-y reason, --why reason\tMust be one of: DISPOSED, DESTROYED, or RELEASED. If the reason given is RELEASED,"
         "-o must also be given.\n"
         "\t-o owner\tInformation about the lawful owner to whom the evidence was released\n"
+        "\t--full\tWhen used with verify, ignores the last checkpoint and validates the whole blockchain.\n"
+        "\t--jobs num_jobs\tWhen used with verify, hashes the blockchain in num_jobs parallel processes.\n"
+        "\t--engine engine\tWhen used with verify, checks the evidence states block by block (python, the "
+        "default) or with array operations over the whole chain (numpy, which needs NumPy).\n"
+        "\t-f file\tWhen used with batch, reads operations from file instead of stdin. Each line is a JSON "
+        "object or CSV: action,item_id followed by case_id for add or reason[,owner] for remove.\n"
+        "\tstats reports the items per state and per case, the blocks per month (UTC) and the time items spent "
+        "checked out, it needs NumPy.\n"
+        "\tsegments lists the segment files of a blockchain stored in segments: with $BCHOC_SEGMENT_SIZE set, the "
+        "blockchain file is cut into a new segment file each time it grows past that many bytes. Segments can be "
+        "moved to the directories listed in $BCHOC_SEGMENT_PATH.\n"
+        "\tarchive compresses the segments cut so far (or the first num_segments of them) into archives of "
+        "independently compressed frames with zlib (or lzma with --lzma), reads only decompress the frames they "
+        "need. With --cut the blockchain file is cut into a segment first, so all of the chain is archived. "
+        "expand restores the segment files byte for byte.\n"
+        "\tserve keeps the blockchain open behind the Unix socket $BCHOC_SOCKET (default: the blockchain path "
+        "followed by .sock), other commands go through it when $BCHOC_DAEMON is 1 and give up on a daemon "
+        "that doesn't answer within $BCHOC_DAEMON_TIMEOUT seconds (default: 600).\n"
     )
 
 
-main()
+if __name__ == "__main__":
+    main()
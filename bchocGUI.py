@@ -3,8 +3,11 @@
 # TODO:
 # Ensure output is saved to commandLineOutput
 
-from tkinter import Tk, Frame, Label, Button, simpledialog, messagebox
-import bchoc, os, subprocess
+from tkinter import Tk, Toplevel, Frame, Label, Button, Entry, Checkbutton, Scrollbar, StringVar, BooleanVar
+from tkinter import simpledialog, messagebox, ttk
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import bchoc, queue, threading
 
 # global parameters
 BACKGROUND_COLOR = "#fdf6e3"  # Solarized background color
@@ -13,6 +16,18 @@ FONT_COLOR = "#657b83"  # Solarized body font color
 BIG_FONT = "Calibri Bold"
 SMALL_FONT = "Calibri"
 FONT_SIZE = 14
+POLL_INTERVAL = 50  # milliseconds between checks for messages from the worker
+LOG_ROWS = 25  # rows of the log viewer, only this many blocks are read at a time
+
+# chain of custody engine, kept open so every click reuses its index
+chain = bchoc.ChainOfCustody()
+
+# commands run on a worker thread so the window stays responsive, one at a time since they share the engine
+# the worker talks back through a queue of ("progress", scanned, total), ("done", input, output) and
+# ("page", request, start, page) messages
+worker = ThreadPoolExecutor(max_workers=1)
+messages = queue.Queue()
+cancelRequested = threading.Event()
 
 # command line variables
 # global userInput  # this is the user's command to be sent to bchoc.py
@@ -21,7 +36,7 @@ FONT_SIZE = 14
 # main window
 window = Tk()
 window.title("Blockchain Chain of Custody")
-window.geometry("350x325")
+window.geometry("350x400")
 window.configure(bg=BACKGROUND_COLOR)
 
 # setup grid
@@ -41,24 +56,134 @@ mainPrompt = Label(
 )
 mainPrompt.grid(row=0, column=0, columnspan=2)
 bottomPad = Label(window, text=" ", font=(BIG_FONT, FONT_SIZE * 2), bg=BACKGROUND_COLOR)
-bottomPad.grid(row=5, column=0, columnspan=2)
+bottomPad.grid(row=7, column=0, columnspan=2)
 
-# open bchoc.py, run command, save output
+# send the command "userInput" to the worker, its output is displayed by pollMessages
 def run():
+    cancelRequested.clear()
+    cancel.config(state="normal")
+    worker.submit(execute, userInput)
+
+
+# runs on the worker: run a command on the chain of custody engine and post its output
+def execute(commandInput):
+    # split the command from its arguments and run it in process, scans report progress
+    command, _, arguments = commandInput.partition(" ")
+    if command in bchoc.WRITE_COMMANDS:
+        recoverChain()
+    try:
+        arguments = bchoc.parse_command(command, arguments)
+        if command == "log" or command == "verify":
+            arguments["progress"] = reportProgress
+        commandLineOutput = describe(getattr(chain, command)(**arguments))
+    except bchoc.CancelledError:
+        commandLineOutput = "Cancelled."
+    except bchoc.CustodyError as error:
+        commandLineOutput = describeError(error)
+    except Exception as error:  # keep the worker alive for the next command
+        commandLineOutput = "Error: %s" % error
+
+    messages.put(("done", commandInput, commandLineOutput))
+
+
+# runs on the worker: report a torn final block left by a crash when the GUI starts, without changing the chain
+def checkChain():
+    try:
+        torn = chain.torn_tail()
+    except (bchoc.CustodyError, OSError) as error:
+        messages.put(("done", "recover", "Error: %s" % error))
+        return
+    if torn is not None:
+        messages.put(
+            (
+                "done",
+                "recover",
+                "Error: blockchain ends in a torn block of %d bytes at offset %d, the next write will cut it"
+                % (torn[1], torn[0]),
+            )
+        )
+
+
+# runs on the worker: cut a torn final block left by a crash before a command that writes, and say so
+def recoverChain():
+    try:
+        recovered = chain.recover()
+    except (bchoc.CustodyError, OSError) as error:
+        messages.put(("done", "recover", "Error: %s" % error))
+        return
+    if recovered is not None:
+        messages.put(
+            (
+                "done",
+                "recover",
+                "Recovered blockchain: cut a torn block of %d bytes at offset %d, saved to %s"
+                % (recovered[1], recovered[0], bchoc.TORN_PATH),
+            )
+        )
+
+
+# runs on the worker: post the progress of a scan, or stop it if Cancel was clicked
+def reportProgress(scanned, total):
+    if cancelRequested.is_set():
+        raise bchoc.CancelledError("cancelled")
+    messages.put(("progress", scanned, total))
+
+
+# runs on the Tk thread: apply the messages posted by the worker, then check again later
+def pollMessages():
     global commandLineOutput  # this is the output from bchoc.py
 
-    # open bchoc.py and run the command "userInput", retrieve output as commandLineOutput
-    commandLineOutput = subprocess.Popen("python ./bchoc.py %s" % userInput, stdout=subprocess.PIPE)
-
-    # parse subprocess output
-    commandLineOutput = commandLineOutput.stdout.read().decode("utf-8")
-
-    # retrieve bchoc.py command line output, display results
-    messagebox.showinfo(
-        "Command Output",
-        'Your input\n"%s"\nreturned the following output: \n\n%s'
-        % (userInput, commandLineOutput),
-    )
+    try:
+        while True:
+            message = messages.get_nowait()
+            if message[0] == "progress":
+                progressBar["value"] = 100 * message[1] / max(message[2], 1)
+            elif message[0] == "page":
+                showLogPage(*message[1:])
+            else:
+                progressBar["value"] = 0
+                cancel.config(state="disabled")
+                commandLineOutput = message[2]
+
+                # display results
+                messagebox.showinfo(
+                    "Command Output",
+                    'Your input\n"%s"\nreturned the following output: \n\n%s'
+                    % (message[1], commandLineOutput),
+                )
+    except queue.Empty:
+        pass
+
+    window.after(POLL_INTERVAL, pollMessages)
+
+
+# turn a result of the engine into text
+def describe(result):
+    if isinstance(result, (bchoc.CustodyAction, bchoc.LogEntry)):
+        return "Case: %s\nItem: %d\nAction: %s\nTime: %s" % (
+            result.case_id,
+            result.item_id,
+            result.state,
+            datetime.fromtimestamp(result.timestamp).isoformat(),
+        )
+    if isinstance(result, bchoc.VerifyResult):
+        return "Transactions in blockchain: %d\nState of blockchain: CLEAN" % result.block_count
+    if isinstance(result, bool):  # init
+        if result:
+            return "Blockchain file not found. Created INITIAL block."
+        return "Blockchain file found with INITIAL block."
+    return "\n\n".join(describe(item) for item in result)  # add and log
+
+
+# turn an error of the engine into text
+def describeError(error):
+    if isinstance(error, bchoc.ChainError) and error.bad_block is not None:
+        return "State of blockchain: ERROR\nBad block: %s\nParent block: %s\n%s" % (
+            error.bad_block.hex(),
+            "NOT FOUND" if error.parent_block is None else error.parent_block.hex(),
+            error,
+        )
+    return "Error: %s" % error
 
 
 # ---- Button Click Events ----
@@ -155,30 +280,7 @@ def checkinClicked():
 
 
 def logClicked():
-    global userInput  # need to declare within the functions
-
-    userInput = simpledialog.askstring(
-        "Log",
-        "Command Description: \n\nDisplay the blockchain entries giving the oldest first (unless -r is given).\n\nFormat:\n[-r] [-n num_entries] [-c case_id] [-i item_id]",
-        parent=window,
-    )
-
-    if userInput is not None:
-        # append necessary command to user input
-        userInput = "log " + userInput
-
-        # remove space if no flags were used
-        if userInput == "log ":
-            userInput = "log"
-
-        # send command to bchoc.py
-        run()
-
-    else:
-        messagebox.showinfo("Error", "No command found. Try again.")
-
-    # flush userInput
-    del userInput
+    openLogViewer()
 
 
 def initClicked():
@@ -217,6 +319,10 @@ def verifyClicked():
     del userInput
 
 
+def cancelClicked():
+    cancelRequested.set()
+
+
 def helpClicked():
     messagebox.showinfo(
         "Help: Argument Flags",
@@ -227,6 +333,144 @@ def helpClicked():
 
 # ---- End of Button Click Events ----
 
+# ---- Log Viewer ----
+# A window listing the blockchain in a Treeview that only holds one page of LOG_ROWS blocks. The
+# scrollbar, mouse wheel and column headings ask the worker for the page at the new position, which
+# the engine reads straight from its offset index or posting lists, so opening and scrolling cost the
+# same on any chain. Newer page requests make older ones stale, their results are dropped.
+
+logWindow = None
+logStart = 0  # row of the chain shown at the top of the viewer
+logTotal = 0  # rows matching the filters
+logSort = "time"
+logRequest = 0  # number of the latest page request
+
+
+# open the log viewer, or bring it to the front
+def openLogViewer():
+    global logWindow, logTree, logScrollbar, logStatus, logCase, logItem, logReverse
+
+    if logWindow is not None and logWindow.winfo_exists():
+        logWindow.lift()
+        return
+
+    logWindow = Toplevel(window)
+    logWindow.title("Blockchain Log")
+    logWindow.configure(bg=BACKGROUND_COLOR)
+    logWindow.grid_rowconfigure(1, weight=1)
+    logWindow.grid_columnconfigure(0, weight=1)
+
+    # filters: -c case_id, -i item_id (several may be separated by spaces) and -r
+    controls = Frame(logWindow, bg=BACKGROUND_COLOR)
+    controls.grid(row=0, column=0, columnspan=2, sticky="EW")
+    logCase = StringVar()
+    logItem = StringVar()
+    logReverse = BooleanVar()
+    Label(controls, text="Case:", font=(SMALL_FONT, FONT_SIZE), bg=BACKGROUND_COLOR).pack(side="left")
+    Entry(controls, textvariable=logCase, width=38).pack(side="left")
+    Label(controls, text="Item:", font=(SMALL_FONT, FONT_SIZE), bg=BACKGROUND_COLOR).pack(side="left")
+    Entry(controls, textvariable=logItem, width=10).pack(side="left")
+    Checkbutton(
+        controls, text="Reverse", variable=logReverse, bg=BACKGROUND_COLOR, command=lambda: requestLogPage(0)
+    ).pack(side="left")
+    Button(controls, text="Apply", font=(SMALL_FONT, FONT_SIZE), command=lambda: requestLogPage(0)).pack(
+        side="left"
+    )
+
+    # one page of blocks, the scrollbar is driven by hand to stand for the whole log
+    logTree = ttk.Treeview(logWindow, columns=("case", "item", "action", "time"), show="headings", height=LOG_ROWS)
+    for column, width in (("case", 290), ("item", 80), ("action", 110), ("time", 220)):
+        logTree.heading(column, text=column.title(), command=lambda column=column: sortLog(column))
+        logTree.column(column, width=width, anchor="w")
+    logTree.grid(row=1, column=0, sticky="NEWS")
+    logScrollbar = Scrollbar(logWindow, orient="vertical", command=scrollLog)
+    logScrollbar.grid(row=1, column=1, sticky="NS")
+    logTree.bind("<MouseWheel>", lambda event: scrollLog("scroll", -1 if event.delta > 0 else 1, "units"))
+    logTree.bind("<Button-4>", lambda event: scrollLog("scroll", -1, "units"))
+    logTree.bind("<Button-5>", lambda event: scrollLog("scroll", 1, "units"))
+    logStatus = Label(logWindow, text="", font=(SMALL_FONT, FONT_SIZE), bg=BACKGROUND_COLOR)
+    logStatus.grid(row=2, column=0, columnspan=2, sticky="W")
+
+    requestLogPage(0)
+
+
+# ask the worker for the page starting at row start
+def requestLogPage(start):
+    global logStart, logRequest
+
+    logStart = max(min(start, logTotal - LOG_ROWS), 0)
+    logRequest += 1
+    arguments = ""
+    arguments += "".join(" -c " + case_id for case_id in logCase.get().split())
+    arguments += "".join(" -i " + item_id for item_id in logItem.get().split())
+    worker.submit(fetchLogPage, logRequest, logStart, logSort, logReverse.get(), arguments)
+
+
+# runs on the worker: read a page of the log and post it
+def fetchLogPage(request, start, sort, reverse, arguments):
+    try:
+        filters = bchoc.parse_command("log", arguments)
+        page = chain.log_page(start, LOG_ROWS, reverse, sort, filters["case_ids"], filters["item_ids"])
+    except bchoc.CustodyError as error:
+        page = describeError(error)
+    except Exception as error:  # keep the worker alive for the next command
+        page = "Error: %s" % error
+    messages.put(("page", request, start, page))
+
+
+# runs on the Tk thread: show a page posted by the worker, unless a newer one was requested since
+def showLogPage(request, start, page):
+    global logTotal
+
+    if request != logRequest or logWindow is None or not logWindow.winfo_exists():
+        return
+    if isinstance(page, str):
+        logStatus.config(text=page)
+        return
+    logTree.delete(*logTree.get_children())
+    for entry in page.entries:
+        logTree.insert(
+            "",
+            "end",
+            values=(entry.case_id, entry.item_id, entry.state, datetime.fromtimestamp(entry.timestamp).isoformat()),
+        )
+    logTotal = page.total
+    if logTotal == 0:
+        logScrollbar.set(0, 1)
+        logStatus.config(text="No blocks found.")
+    else:
+        logScrollbar.set(start / logTotal, min((start + LOG_ROWS) / logTotal, 1))
+        logStatus.config(text="Blocks %d-%d of %d" % (start + 1, start + len(page.entries), logTotal))
+
+
+# scrollbar and mouse wheel: ("moveto", fraction) or ("scroll", steps, "units" or "pages")
+def scrollLog(*arguments):
+    if arguments[0] == "moveto":
+        requestLogPage(int(float(arguments[1]) * logTotal))
+    elif arguments[0] == "scroll":
+        requestLogPage(logStart + int(arguments[1]) * (LOG_ROWS if arguments[2] == "pages" else 1))
+
+
+# column headings: page through the whole log by time, case or item, clicking again flips the order
+# the action of a block isn't indexed, so that column only sorts the rows on screen
+def sortLog(column):
+    global logSort
+
+    if column == "action":
+        rows = sorted(logTree.get_children(), key=lambda row: logTree.set(row, "action"))
+        for position, row in enumerate(rows):
+            logTree.move(row, "", position)
+        return
+    if column == logSort:
+        logReverse.set(not logReverse.get())
+    else:
+        logSort = column
+        logReverse.set(False)
+    requestLogPage(0)
+
+
+# ---- End of Log Viewer ----
+
 # ---- Buttons ----
 
 # add button
@@ -271,9 +515,26 @@ help = Button(
 )
 help.grid(row=4, column=1, sticky="NEWS")
 
+# progress of the running scan, in percent of the blockchain file
+progressBar = ttk.Progressbar(window, orient="horizontal", mode="determinate", maximum=100)
+progressBar.grid(row=5, column=0, columnspan=2, sticky="EW")
+
+# cancel button, enabled while a command runs
+cancel = Button(
+    window, text="Cancel", font=(BIG_FONT, FONT_SIZE), state="disabled", command=cancelClicked
+)
+cancel.grid(row=6, column=0, columnspan=2, sticky="NEWS")
+
 # ---- End of Buttons ----
 
 # run the GUI
+worker.submit(checkChain)
+window.after(POLL_INTERVAL, pollMessages)
 window.mainloop()
 
+# stop a running scan and let the worker finish
+cancelRequested.set()
+worker.shutdown(wait=False)
+chain.close()
+
 # ---- END OF GUI ----
@@ -0,0 +1,99 @@
+import importlib.util
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+from hashlib import sha1
+
+BCHOC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bchoc.py")
+CASE_ID = "65cc391d-6568-4dcc-a3f1-86a2f04140f3"
+OTHER_CASE_ID = "11111111-2222-4333-8444-555555555555"
+BLOCK_STRUCT = struct.Struct("20s d 16s I 11s I")
+STATE_POSITION = struct.calcsize("20s d 16s I")
+SIDECARS = (".tail", ".idx", ".off", ".pst", ".chk")
+# Every way verify can run, all of them must reach the same verdict on the same chain
+VERIFY_RUNS = [["--engine", "python"], ["--engine", "python", "--jobs", "3"]]
+if importlib.util.find_spec("numpy") is not None:
+    VERIFY_RUNS += [["--engine", "numpy"], ["--engine", "numpy", "--jobs", "3"]]
+
+
+# a fresh blockchain in a temporary directory, driven through the command line like a user would
+class ChainTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.chain_path = os.path.join(self.directory, "chain.bin")
+        self.env = dict(os.environ, BCHOC_FILE_PATH=self.chain_path)
+        for variable in ("BCHOC_DAEMON", "BCHOC_SEGMENT_SIZE", "BCHOC_SEGMENT_PATH", "BCHOC_SOCKET"):
+            self.env.pop(variable, None)
+
+    # run bchoc with arguments, returns the exit code, stdout and stderr
+    def bchoc(self, *arguments, stdin=None, env=None):
+        result = subprocess.run(
+            [sys.executable, BCHOC, *arguments],
+            input=stdin,
+            env=self.env if env is None else env,
+            capture_output=True,
+            text=True,
+        )
+        return result.returncode, result.stdout, result.stderr
+
+    # run bchoc and fail the test unless it succeeds, returns stdout
+    def bchoc_ok(self, *arguments, stdin=None):
+        code, out, err = self.bchoc(*arguments, stdin=stdin)
+        self.assertEqual(code, 0, "bchoc %s failed: %s" % (" ".join(arguments), err))
+        return out
+
+    # add items to two cases and move them through every state in a few commits, of the first items 1 is
+    # checked in, 2 disposed, 3 checked out and 4 released
+    def build_chain(self, first_item=1, item_count=40):
+        lines = []
+        for item_id in range(first_item, first_item + item_count):
+            lines.append("add,%d,%s" % (item_id, CASE_ID if item_id % 3 else OTHER_CASE_ID))
+        for item_id in range(first_item, first_item + item_count, 2):
+            lines.append("checkout,%d" % item_id)
+        for item_id in range(first_item, first_item + item_count, 4):
+            lines.append("checkin,%d" % item_id)
+        for item_id in range(first_item + 1, first_item + item_count, 6):
+            lines.append("remove,%d,DISPOSED" % item_id)
+        for item_id in range(first_item + 3, first_item + item_count, 12):
+            lines.append("remove,%d,RELEASED,Jane Doe" % item_id)
+        self.bchoc("init")
+        for start in range(0, len(lines), 25):
+            self.bchoc_ok("batch", stdin="\n".join(lines[start : start + 25]) + "\n")  # noqa: E203
+
+    # the offsets and bytes of every block in the blockchain file
+    def read_blocks(self):
+        with open(self.chain_path, "rb") as chain:
+            data = chain.read()
+        blocks = []
+        offset = 0
+        while offset < len(data):
+            length = BLOCK_STRUCT.size + BLOCK_STRUCT.unpack_from(data, offset)[5]
+            blocks.append((offset, data[offset : offset + length]))  # noqa: E203
+            offset += length
+        return blocks
+
+    # append a block with a valid link to the last block, so only the evidence states can catch it
+    def append_linked_block(self, evidence_id, state):
+        last_block = self.read_blocks()[-1][1]
+        block = BLOCK_STRUCT.pack(sha1(last_block).digest(), 1e9, bytes(16), evidence_id, state, 0)
+        with open(self.chain_path, "ab") as chain:
+            chain.write(block)
+
+    def remove_sidecars(self):
+        for suffix in SIDECARS:
+            if os.path.exists(self.chain_path + suffix):
+                os.remove(self.chain_path + suffix)
+
+    # the verify output and exit code of every engine, for comparing them
+    def verify_all(self, *arguments):
+        return {" ".join(run): self.bchoc("verify", *arguments, *run)[:2] for run in VERIFY_RUNS}
+
+    def assert_engines_agree(self, results, code):
+        verdicts = set(results.values())
+        self.assertEqual(len(verdicts), 1, results)
+        self.assertEqual(verdicts.pop()[0], code, results)
@@ -0,0 +1,76 @@
+import json
+import os
+import unittest
+
+from chaintest import CASE_ID, ChainTestCase
+
+
+class BatchTest(ChainTestCase):
+    def setUp(self):
+        super().setUp()
+        self.bchoc_ok("init")
+
+    def test_json_and_csv_lines(self):
+        lines = [
+            json.dumps({"action": "add", "item_id": 3, "case_id": CASE_ID}),
+            'add,"4",%s' % CASE_ID,
+            "# comment",
+            "",
+            json.dumps({"action": "checkout", "item_id": "3"}),
+            'remove,4,RELEASED,"Doe, John"',
+        ]
+        batch_path = os.path.join(self.directory, "batch.txt")
+        with open(batch_path, "w") as batch_file:
+            batch_file.write("\n".join(lines) + "\n")
+        self.assertEqual(
+            self.bchoc_ok("batch", "-f", batch_path),
+            "Line 1: add item 3 -> CHECKEDIN\n"
+            "Line 2: add item 4 -> CHECKEDIN\n"
+            "Line 5: checkout item 3 -> CHECKEDOUT\n"
+            "Line 6: remove item 4 -> RELEASED\n"
+            "Applied: 4 \nFailed: 0\n",
+        )
+        self.assertEqual(self.bchoc_ok("status", "-i", "4").splitlines()[2], "  Status: RELEASED")
+
+    # json values of the wrong type are rejected with the field at fault, never coerced
+    def test_json_types(self):
+        lines = [
+            json.dumps({"action": "add", "item_id": 3, "case_id": CASE_ID}),
+            json.dumps({"action": "checkout", "item_id": True}),
+            json.dumps({"action": "checkout", "item_id": 3.5}),
+            json.dumps({"action": "checkout", "item_id": [3]}),
+            json.dumps({"action": "remove", "item_id": 3, "reason": 5}),
+            json.dumps({"action": 1, "item_id": 3}),
+            "[1, 2]",
+            '{"action": "checkout"',
+            "checkout",
+            json.dumps({"action": "checkin", "item_id": 99}),
+        ]
+        code, out, err = self.bchoc("batch", stdin="\n".join(lines) + "\n")
+        self.assertEqual(code, 1, err)
+        self.assertEqual(
+            out,
+            "Line 1: add item 3 -> CHECKEDIN\n"
+            "Line 2: ERROR item_id must be an integer\n"
+            "Line 3: ERROR item_id must be an integer\n"
+            "Line 4: ERROR item_id must be an integer\n"
+            "Line 5: ERROR reason must be a string\n"
+            "Line 6: ERROR action must be a string\n"
+            "Line 7: ERROR malformed operation\n"
+            "Line 8: ERROR malformed operation\n"
+            "Line 9: ERROR malformed operation\n"
+            "Line 10: ERROR item 99 not found\n"
+            "Applied: 1 \nFailed: 9\n",
+        )
+        self.assertEqual(
+            self.bchoc("verify", "--full")[:2], (0, "Transactions in blockchain: 2\nState of blockchain: CLEAN\n")
+        )
+
+    def test_arguments(self):
+        self.assertEqual(self.bchoc("batch", "-f", os.path.join(self.directory, "missing.txt"))[0], 1)
+        self.assertEqual(self.bchoc("batch", "-f", "a", "-f", "b")[0], 1)
+        self.assertEqual(self.bchoc("batch", "-x")[0], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
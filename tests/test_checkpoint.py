@@ -0,0 +1,35 @@
+import os
+import unittest
+
+from chaintest import STATE_POSITION, VERIFY_RUNS, ChainTestCase
+
+
+class CheckpointTest(ChainTestCase):
+    def test_resume_matches_full(self):
+        self.build_chain()
+        self.bchoc_ok("verify")
+        self.assertTrue(os.path.exists(self.chain_path + ".chk"))
+        self.build_chain(first_item=100, item_count=20)
+        for run in VERIFY_RUNS:
+            self.assertEqual(self.bchoc("verify", *run)[:2], self.bchoc("verify", "--full", *run)[:2], run)
+
+    def test_resume_finds_appended_error(self):
+        self.build_chain()
+        self.bchoc_ok("verify")
+        self.append_linked_block(3, b"CHECKEDOUT\0")
+        full = self.verify_all("--full")
+        self.assert_engines_agree(full, 1)
+        self.assertEqual(self.verify_all(), full)
+
+    def test_rewritten_history_is_not_resumed(self):
+        self.build_chain()
+        self.bchoc_ok("verify")
+        offset, block = self.read_blocks()[-1]
+        with open(self.chain_path, "r+b") as chain:
+            chain.seek(offset + STATE_POSITION)
+            chain.write(b"BOGUS\0\0\0\0\0\0")
+        self.assert_engines_agree(self.verify_all(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
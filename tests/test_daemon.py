@@ -0,0 +1,102 @@
+import os
+import subprocess
+import sys
+import unittest
+
+from chaintest import BCHOC, CASE_ID, ChainTestCase
+
+# Serves an engine whose lookups fail, or hang past the reply timeout, for some items, then looks them
+# up through one client connection and prints what each call raised or returned
+FAILING_DAEMON_SCRIPT = """
+import os, sys, threading, time
+os.environ["BCHOC_DAEMON_TIMEOUT"] = "1"
+sys.path.insert(0, sys.argv[1])
+import bchoc
+class FailingChain(bchoc.ChainOfCustody):
+    def lookup(self, item_id):
+        if item_id == 1:
+            raise RuntimeError("boom")
+        if item_id == 2:
+            raise OSError(28, "No space left on device")
+        if item_id == 3:
+            time.sleep(3)
+        return super().lookup(item_id)
+chain = FailingChain()
+chain.init()
+chain.add(sys.argv[3], [4])
+daemon = bchoc.ChainDaemon(sys.argv[2], chain)
+threading.Thread(target=daemon.serve_forever, daemon=True).start()
+remote = bchoc.RemoteChain(sys.argv[2])
+calls = [("lookup", {"item_id": 1}), ("lookup", {"item_id": 2}), ("lookup", {"item_id": 9}), ("lookup", {"bogus": 1})]
+calls += [("drop", {}), ("lookup", {"item_id": 4}), ("lookup", {"item_id": 3})]
+for command, arguments in calls:
+    try:
+        print(remote.call(command, **arguments).state)
+    except bchoc.CustodyError as error:
+        print(type(error).__name__, error)
+print(bchoc.RemoteChain(sys.argv[2]).lookup(4).state)
+"""
+
+
+class DaemonTest(ChainTestCase):
+    def setUp(self):
+        super().setUp()
+        self.env["BCHOC_SOCKET"] = os.path.join(self.directory, "bchoc.sock")
+
+    # start bchoc serve and wait until it listens
+    def start_daemon(self):
+        daemon = subprocess.Popen([sys.executable, BCHOC, "serve"], stdout=subprocess.PIPE, env=self.env, text=True)
+        self.addCleanup(daemon.stdout.close)
+        self.addCleanup(daemon.wait)
+        self.addCleanup(daemon.terminate)
+        self.assertTrue(daemon.stdout.readline().startswith("Serving"))
+        return daemon
+
+    def test_commands_through_the_daemon(self):
+        self.build_chain(item_count=12)
+        direct = {
+            "log": self.bchoc_ok("log"),
+            "status": self.bchoc_ok("status", "-i", "3"),
+            "verify": self.bchoc_ok("verify", "--full"),
+        }
+        daemon = self.start_daemon()
+        self.env["BCHOC_DAEMON"] = "1"
+        self.assertEqual(self.bchoc_ok("log"), direct["log"])
+        self.assertEqual(self.bchoc_ok("status", "-i", "3"), direct["status"])
+        self.assertEqual(self.bchoc_ok("verify", "--full"), direct["verify"])
+        self.bchoc_ok("add", "-c", CASE_ID, "-i", "500")
+        self.assertEqual(self.bchoc("checkin", "-i", "500")[0], 1)
+        already_serving = "Error: a daemon is already serving %s\n" % self.env["BCHOC_SOCKET"]
+        self.assertEqual(self.bchoc("serve")[::2], (1, already_serving))
+        daemon.terminate()
+        self.assertEqual(daemon.wait(), 0)
+        self.assertFalse(os.path.exists(self.env["BCHOC_SOCKET"]))
+        self.assertEqual(self.bchoc_ok("log").splitlines()[-3:-1], ["Item: 500", "Action: CHECKEDIN"])
+
+    # failed requests are answered and keep the connection usable, a timeout closes it and a new one is needed
+    def test_errors_and_timeouts(self):
+        result = subprocess.run(
+            [sys.executable, "-c", FAILING_DAEMON_SCRIPT, os.path.dirname(BCHOC), self.env["BCHOC_SOCKET"], CASE_ID],
+            env=self.env,
+            capture_output=True,
+            text=True,
+            timeout=60,
+        )
+        self.assertEqual(
+            result.stdout.splitlines(),
+            [
+                "CustodyError boom",
+                "CustodyError [Errno 28] No space left on device",
+                "ItemNotFoundError item 9 not found",
+                "InvalidArgumentError FailingChain.lookup() got an unexpected keyword argument 'bogus'",
+                "InvalidArgumentError unknown command drop",
+                "CHECKEDIN",
+                "ChainError the daemon didn't answer within 1 seconds",
+                "CHECKEDIN",
+            ],
+            result.stderr,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
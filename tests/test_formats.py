@@ -0,0 +1,73 @@
+import csv
+import io
+import json
+import unittest
+
+from chaintest import CASE_ID, ChainTestCase
+
+
+class FormatTest(ChainTestCase):
+    # the log as dicts of LOG_FIELDS without the timestamp, read from the text format
+    def text_records(self, *arguments):
+        records = []
+        for entry in self.bchoc_ok("log", *arguments).strip().split("\n\n"):
+            fields = dict(line.split(": ", 1) for line in entry.splitlines())
+            records.append(
+                {
+                    "case_id": fields["Case"],
+                    "item_id": fields["Item"],
+                    "action": fields["Action"],
+                    "time": fields["Time"],
+                }
+            )
+        return records
+
+    def jsonl_records(self, *arguments):
+        records = [json.loads(line) for line in self.bchoc_ok("log", "--format", "jsonl", *arguments).splitlines()]
+        for record in records:
+            self.assertIsInstance(record["item_id"], int)
+            self.assertIsInstance(record["timestamp"], float)
+            record["item_id"] = str(record.pop("item_id"))
+            del record["timestamp"]
+        return records
+
+    def csv_records(self, *arguments):
+        records = list(csv.DictReader(io.StringIO(self.bchoc_ok("log", "--format", "csv", *arguments), newline="")))
+        for record in records:
+            float(record.pop("timestamp"))
+        return records
+
+    def assert_formats_agree(self, *arguments):
+        expected = self.text_records(*arguments)
+        self.assertEqual(self.jsonl_records(*arguments), expected, arguments)
+        self.assertEqual(self.csv_records(*arguments), expected, arguments)
+        return expected
+
+    def test_formats_agree(self):
+        self.build_chain()
+        self.assertEqual(len(self.assert_formats_agree()), 82)
+        self.assert_formats_agree("-r", "-n", "7")
+        self.assert_formats_agree("-c", CASE_ID, "-i", "4")
+
+    # records are written in chunks, none may be lost or repeated at the chunk boundaries
+    def test_many_blocks(self):
+        self.bchoc_ok("init")
+        self.bchoc_ok("batch", stdin="".join("add,%d,%s\n" % (item_id, CASE_ID) for item_id in range(1, 9001)))
+        records = self.assert_formats_agree()
+        self.assertEqual([int(record["item_id"]) for record in records], list(range(9001)))
+
+    # a state holding separators and quotes comes out quoted in csv and escaped in json
+    def test_quoted_state(self):
+        self.build_chain(item_count=4)
+        self.append_linked_block(3, b'A,"B"\n\0\0\0\0\0')
+        self.assertEqual(self.jsonl_records()[-1]["action"], 'A,"B"\n')
+        self.assertEqual(self.csv_records()[-1]["action"], 'A,"B"\n')
+
+    def test_unknown_format(self):
+        self.build_chain(item_count=4)
+        code, out, err = self.bchoc("log", "--format", "xml")
+        self.assertEqual((code, out), (1, ""))
+
+
+if __name__ == "__main__":
+    unittest.main()
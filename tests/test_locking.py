@@ -0,0 +1,102 @@
+import os
+import subprocess
+import sys
+import unittest
+
+from chaintest import BCHOC, CASE_ID, VERIFY_RUNS, ChainTestCase
+
+# Threads applying operations through one engine with a group commit window, prints the outcome of each
+GROUP_COMMIT_SCRIPT = """
+import sys, threading
+sys.path.insert(0, sys.argv[1])
+import bchoc
+chain = bchoc.ChainOfCustody(group_commit=0.05)
+results = []
+def checkout(item_id):
+    try:
+        chain.checkout(item_id)
+        results.append("ok")
+    except bchoc.CustodyError as error:
+        results.append(type(error).__name__)
+threads = [threading.Thread(target=checkout, args=(item_id,)) for item_id in [1, 2, 3, 4, 5, 6, 1, 2]]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+chain.close()
+print(" ".join(sorted(results)))
+"""
+
+
+# -i arguments for every item id
+def item_arguments(item_ids):
+    return [argument for item_id in item_ids for argument in ("-i", str(item_id))]
+
+
+def clean_output(block_count):
+    return "Transactions in blockchain: %d\nState of blockchain: CLEAN\n" % block_count
+
+
+class MissingChainTest(ChainTestCase):
+    def test_writes_dont_create_the_chain(self):
+        for command in (["checkout", "-i", "1"], ["checkin", "-i", "1"], ["remove", "-i", "1", "-y", "DISPOSED"]):
+            code, out, err = self.bchoc(*command)
+            self.assertEqual(code, 1, command)
+            self.assertFalse(os.path.exists(self.chain_path), command)
+        self.assertEqual(self.bchoc_ok("log").splitlines()[0], "Blockchain file not found. Created INITIAL block.")
+
+    def test_init_after_failed_write(self):
+        self.bchoc("checkout", "-i", "1")
+        self.assertEqual(self.bchoc_ok("init"), "Blockchain file not found. Created INITIAL block.\n")
+        self.assertEqual(self.bchoc_ok("init"), "Blockchain file found with INITIAL block.\n")
+
+
+class ConcurrentWritersTest(ChainTestCase):
+    # every writer process moves its own items, none of the appends may be lost or fork the chain
+    def test_concurrent_processes(self):
+        self.bchoc_ok("add", "-c", CASE_ID, *item_arguments(range(1, 41)))
+        writers = []
+        for first in range(1, 5):
+            writer = subprocess.Popen(
+                [sys.executable, BCHOC, "batch"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                env=self.env,
+                text=True,
+            )
+            writers.append(writer)
+            for item_id in range(first, 41, 4):
+                writer.stdin.write("checkout,%d\ncheckin,%d\n" % (item_id, item_id))
+            writer.stdin.close()
+        self.assertEqual([writer.wait() for writer in writers], [0, 0, 0, 0])
+        for run in VERIFY_RUNS:
+            self.assertEqual(self.bchoc("verify", "--full", *run)[:2], (0, clean_output(121)))
+
+    def test_same_item_added_once(self):
+        self.bchoc_ok("init")
+        writers = [
+            subprocess.Popen(
+                [sys.executable, BCHOC, "add", "-c", CASE_ID, "-i", "7"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                env=self.env,
+            )
+            for _ in range(4)
+        ]
+        self.assertEqual(sorted(writer.wait() for writer in writers), [0, 1, 1, 1])
+        self.assertEqual(self.bchoc("verify", "--full")[:2], (0, clean_output(2)))
+
+    def test_group_commit(self):
+        self.bchoc_ok("add", "-c", CASE_ID, *item_arguments(range(1, 7)))
+        result = subprocess.run(
+            [sys.executable, "-c", GROUP_COMMIT_SCRIPT, os.path.dirname(BCHOC)],
+            env=self.env,
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(result.stdout, "InvalidStateError InvalidStateError ok ok ok ok ok ok\n", result.stderr)
+        self.assertEqual(self.bchoc("verify", "--full")[:2], (0, clean_output(13)))
+
+
+if __name__ == "__main__":
+    unittest.main()
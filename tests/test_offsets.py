@@ -0,0 +1,26 @@
+import os
+import unittest
+
+from chaintest import OTHER_CASE_ID, ChainTestCase
+
+
+# the sidecars can't be written, readers must still see the whole chain
+class UnwritableSidecarTest(ChainTestCase):
+    def test_missing_offset_index(self):
+        self.build_chain()
+        expected = {
+            "log": self.bchoc_ok("log"),
+            "reverse": self.bchoc_ok("log", "-r", "-n", "5"),
+            "case": self.bchoc_ok("log", "-c", OTHER_CASE_ID),
+        }
+        self.remove_sidecars()
+        os.mkdir(self.chain_path + ".off")  # Replacing a directory with a file fails
+        self.assertEqual(self.bchoc_ok("log"), expected["log"])
+        self.assertEqual(self.bchoc_ok("log", "-r", "-n", "5"), expected["reverse"])
+        self.assertEqual(self.bchoc_ok("log", "-c", OTHER_CASE_ID), expected["case"])
+        self.assert_engines_agree(self.verify_all("--full"), 0)
+        self.assertTrue(os.path.isdir(self.chain_path + ".off"))
+
+
+if __name__ == "__main__":
+    unittest.main()
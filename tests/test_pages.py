@@ -0,0 +1,97 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+from uuid import UUID
+
+from chaintest import BCHOC, CASE_ID, OTHER_CASE_ID, ChainTestCase
+
+# Reads log_page arguments as json lines from stdin, prints every page as json, or the error it raised
+PAGE_SCRIPT = """
+import json, sys
+sys.path.insert(0, sys.argv[1])
+import bchoc
+chain = bchoc.ChainOfCustody()
+for line in sys.stdin:
+    try:
+        page = chain.log_page(**json.loads(line))
+        entries = [[str(entry[0])] + list(entry[1:]) for entry in page.entries]
+        print(json.dumps({"total": page.total, "entries": entries}))
+    except bchoc.CustodyError as error:
+        print(json.dumps({"error": type(error).__name__}))
+chain.close()
+"""
+
+
+class LogPageTest(ChainTestCase):
+    # the pages log_page returns for each dict of its arguments
+    def log_pages(self, queries):
+        result = subprocess.run(
+            [sys.executable, "-c", PAGE_SCRIPT, os.path.dirname(BCHOC)],
+            input="".join(json.dumps(query) + "\n" for query in queries),
+            env=self.env,
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return [json.loads(line) for line in result.stdout.splitlines()]
+
+    # page through every sort and direction and compare with the whole chain sorted here
+    def assert_pages(self):
+        everything = self.log_pages([{"start": 0, "count": 10**6}])[0]
+        entries = everything["entries"]
+        self.assertEqual(everything["total"], len(entries))
+        orders = {
+            "time": list(range(len(entries))),
+            "case": sorted(
+                range(len(entries)), key=lambda n: (UUID(entries[n][0]).int.to_bytes(16, byteorder="little"), n)
+            ),
+            "item": sorted(range(len(entries)), key=lambda n: (entries[n][1], n)),
+        }
+        windows = [(0, 5), (3, 11), (len(entries) - 2, 9), (len(entries) + 5, 3), (0, 0), (17, 40)]
+        queries = []
+        expected = []
+        for sort, order in orders.items():
+            for reverse in (False, True):
+                rows = [entries[n] for n in (order[::-1] if reverse else order)]
+                for start, count in windows:
+                    queries.append({"start": start, "count": count, "reverse": reverse, "sort": sort})
+                    expected.append({"total": len(entries), "entries": rows[start : start + count]})  # noqa: E203
+        for case_id in (CASE_ID, OTHER_CASE_ID):
+            rows = [entry for entry in entries if entry[0] == case_id]
+            queries.append({"start": 2, "count": 6, "reverse": True, "case_ids": [case_id]})
+            expected.append({"total": len(rows), "entries": rows[::-1][2:8]})
+        rows = [entry for entry in entries if entry[1] in (3, 4)]
+        queries.append({"start": 1, "count": 3, "item_ids": [3, 4]})
+        expected.append({"total": len(rows), "entries": rows[1:4]})
+        self.assertEqual(self.log_pages(queries), expected)
+
+    def test_pages(self):
+        self.build_chain()
+        self.assert_pages()
+        self.remove_sidecars()
+        self.assert_pages()
+
+    # blocks appended after the posting lists were written are paged from their journal
+    def test_journaled_pages(self):
+        self.build_chain()
+        self.assert_pages()
+        for item_id in range(500, 505):
+            self.bchoc_ok("add", "-c", OTHER_CASE_ID if item_id % 2 else CASE_ID, "-i", str(item_id))
+            self.bchoc_ok("checkout", "-i", str((item_id - 500) * 4 + 5))
+            self.assert_pages()
+
+    def test_invalid_pages(self):
+        self.build_chain(item_count=4)
+        queries = [
+            {"start": -1, "count": 3},
+            {"start": 0, "count": -1, "sort": "case"},
+            {"start": 0, "count": 3, "sort": "owner"},
+            {"start": 0, "count": 3, "case_ids": ["not a case"]},
+        ]
+        self.assertEqual(self.log_pages(queries), [{"error": "InvalidArgumentError"}] * 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
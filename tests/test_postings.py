@@ -0,0 +1,57 @@
+import os
+import unittest
+
+from chaintest import CASE_ID, OTHER_CASE_ID, ChainTestCase
+
+QUERIES = [["-c", CASE_ID], ["-c", OTHER_CASE_ID], ["-i", "1"], ["-i", "4"], ["-i", "500"], ["-c", CASE_ID, "-i", "3"]]
+
+
+class PostingsTest(ChainTestCase):
+    # the log entries of a case or item picked out of the whole log, what the posting lists must find
+    def filtered_log(self, case_id=None, item_id=None):
+        entries = self.bchoc_ok("log").strip().split("\n\n")[1:]  # Without the INITIAL block
+        return [
+            entry
+            for entry in entries
+            if (case_id is None or entry.startswith("Case: %s\n" % case_id))
+            and (item_id is None or "\nItem: %s\n" % item_id in entry)
+        ]
+
+    def assert_queries(self):
+        for query in QUERIES:
+            arguments = dict(zip(query[::2], query[1::2]))
+            expected = self.filtered_log(arguments.get("-c"), arguments.get("-i"))
+            self.assertEqual(self.bchoc_ok("log", *query), "".join(entry + "\n\n" for entry in expected)[:-1], query)
+            reverse = self.bchoc_ok("log", "-r", "-n", "2", *query)
+            self.assertEqual(reverse, "".join(entry + "\n\n" for entry in expected[::-1][:2])[:-1], query)
+
+    def test_queries_match_a_scan(self):
+        self.build_chain()
+        self.assert_queries()
+        self.assertTrue(os.path.exists(self.chain_path + ".pst"))
+        self.remove_sidecars()
+        self.assert_queries()
+
+    # blocks appended after the posting lists were written are journaled, not lost
+    def test_appended_blocks(self):
+        self.build_chain()
+        self.bchoc_ok("log", "-c", CASE_ID)
+        self.bchoc_ok("add", "-c", OTHER_CASE_ID, "-i", "500")
+        self.bchoc_ok("checkout", "-i", "1")
+        self.assert_queries()
+
+    # posting lists of another chain, or damaged ones, are rebuilt from the chain
+    def test_stale_postings(self):
+        self.build_chain()
+        self.bchoc_ok("log", "-c", CASE_ID)
+        with open(self.chain_path + ".pst", "r+b") as postings:
+            postings.seek(40)
+            postings.write(b"\xff" * 16)
+        self.assert_queries()
+        with open(self.chain_path + ".pst", "wb") as postings:
+            postings.write(b"BCP1")
+        self.assert_queries()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import stat
+import struct
+import unittest
+
+from chaintest import BLOCK_STRUCT, CASE_ID, ChainTestCase
+
+
+class RecoveryTest(ChainTestCase):
+    # append the first size bytes of a block to the chain, as a crash in the middle of an append leaves them
+    def append_torn_block(self, size):
+        torn = BLOCK_STRUCT.pack(bytes(20), 1e9, bytes(16), 7, b"CHECKEDIN\0\0", 100) + bytes(100)
+        with open(self.chain_path, "ab") as chain:
+            chain.write(torn[:size])
+        return torn[:size]
+
+    def test_torn_tail_is_cut_by_a_write(self):
+        for size in (50, BLOCK_STRUCT.size + 40):
+            self.build_chain()
+            with open(self.chain_path, "rb") as chain:
+                chain_bytes = chain.read()
+            torn = self.append_torn_block(size)
+            code, out, err = self.bchoc("add", "-c", CASE_ID, "-i", "500")
+            self.assertEqual(code, 0, err)
+            self.assertIn("Recovered blockchain", err)
+            with open(self.chain_path, "rb") as chain:
+                self.assertEqual(chain.read(len(chain_bytes) + len(torn))[: len(chain_bytes)], chain_bytes)
+            with open(self.chain_path + ".torn", "rb") as torn_file:
+                self.assertEqual(torn_file.read(), torn)
+            self.assert_engines_agree(self.verify_all("--full"), 0)
+            os.remove(self.chain_path)
+            os.remove(self.chain_path + ".torn")
+            self.remove_sidecars()
+
+    def test_reading_never_cuts(self):
+        self.build_chain()
+        self.append_torn_block(50)
+        with open(self.chain_path, "rb") as chain:
+            chain_bytes = chain.read()
+        for command in (["status", "-i", "1"], ["log"], ["verify"]):
+            code, out, err = self.bchoc(*command)
+            self.assertEqual(code, 1, command)
+            self.assertIn("torn block of 50 bytes", err)
+        with open(self.chain_path, "rb") as chain:
+            self.assertEqual(chain.read(), chain_bytes)
+        self.assertFalse(os.path.exists(self.chain_path + ".torn"))
+
+    # a block whose length runs past the end in the middle of the chain is damage, not a torn append
+    def test_damaged_length_is_not_cut(self):
+        self.build_chain()
+        offset, block = self.read_blocks()[3]
+        self.remove_sidecars()
+        with open(self.chain_path, "r+b") as chain:
+            chain.seek(offset + BLOCK_STRUCT.size - 4)
+            chain.write(struct.pack("I", 1000000))
+            chain.seek(0)
+            chain_bytes = chain.read()
+        for command in (["verify"], ["add", "-c", CASE_ID, "-i", "500"]):
+            code, out, err = self.bchoc(*command)
+            self.assertEqual(code, 1, command)
+            self.assertNotIn("CLEAN", out)
+        self.assert_engines_agree(self.verify_all("--full"), 1)
+        with open(self.chain_path, "rb") as chain:
+            self.assertEqual(chain.read(), chain_bytes)
+        self.assertFalse(os.path.exists(self.chain_path + ".torn"))
+
+
+@unittest.skipIf(os.geteuid() == 0, "root can write to a read-only chain")
+class ReadOnlyChainTest(ChainTestCase):
+    def test_read_only_chain(self):
+        self.build_chain()
+        log = self.bchoc_ok("log")
+        status = self.bchoc_ok("status", "-i", "3")
+        self.remove_sidecars()
+        os.chmod(self.chain_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.chmod(self.directory, stat.S_IRUSR | stat.S_IXUSR)
+        self.addCleanup(os.chmod, self.directory, stat.S_IRWXU)
+        self.assertEqual(self.bchoc_ok("log"), log)
+        self.assertEqual(self.bchoc_ok("status", "-i", "3"), status)
+        self.assert_engines_agree(self.verify_all("--full"), 0)
+        code, out, err = self.bchoc("add", "-c", CASE_ID, "-i", "500")
+        self.assertEqual(code, 1)
+        self.assertEqual(len(err.strip().splitlines()), 1, err)
+        self.assertTrue(err.startswith("Error:"), err)
+
+
+if __name__ == "__main__":
+    unittest.main()
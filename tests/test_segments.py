@@ -0,0 +1,109 @@
+import glob
+import os
+import subprocess
+import sys
+import unittest
+
+from chaintest import BCHOC, CASE_ID, ChainTestCase
+
+# Appends to a chain on a file system without hard links, then archives it, and appends again once they
+# work, prints the number of segments after each step and what archive raised
+NO_LINKS_SCRIPT = """
+import os, sys
+sys.path.insert(0, sys.argv[1])
+import bchoc
+link = os.link
+def failing_link(source, target):
+    raise OSError(95, "Operation not supported")
+os.link = failing_link
+chain = bchoc.ChainOfCustody()
+chain.init()
+for item_id in range(1, 41):
+    chain.add(sys.argv[2], [item_id])
+print(len(chain.segments()))
+try:
+    chain.archive(cut=True)
+except bchoc.ChainError as error:
+    print(error)
+os.link = link
+chain.add(sys.argv[2], [41])
+print(len(chain.segments()))
+chain.close()
+"""
+
+class SegmentTest(ChainTestCase):
+    def setUp(self):
+        super().setUp()
+        self.env["BCHOC_SEGMENT_SIZE"] = "1500"
+
+    # the bytes of every segment file and of the blockchain file
+    def read_segments(self):
+        contents = {}
+        for segment_file in sorted(glob.glob(self.chain_path + ".0*")) + [self.chain_path]:
+            with open(segment_file, "rb") as segment:
+                contents[os.path.basename(segment_file)] = segment.read()
+        return contents
+
+    def test_archive_expand_round_trip(self):
+        self.build_chain()
+        segments = self.read_segments()
+        self.assertGreater(len(segments), 2)
+        log = self.bchoc_ok("log")
+        for archive_arguments in (["archive"], ["archive", "--lzma"], ["archive", "--cut"]):
+            self.bchoc_ok(*archive_arguments)
+            self.assertEqual(glob.glob(self.chain_path + ".0*[0-9]"), [])
+            self.assertEqual(self.bchoc_ok("log"), log)
+            self.assert_engines_agree(self.verify_all("--full"), 0)
+            self.bchoc_ok("expand")
+            self.assertEqual(glob.glob(self.chain_path + ".*.bca"), [])
+            expanded = self.read_segments()
+            self.assertEqual(b"".join(expanded.values()), b"".join(segments.values()))
+            if archive_arguments != ["archive", "--cut"]:
+                self.assertEqual(expanded, segments)
+
+    def test_tampered_archive(self):
+        self.build_chain()
+        self.bchoc_ok("archive", "-n", "1")
+        archive_file = glob.glob(self.chain_path + ".*.bca")[0]
+        with open(archive_file, "r+b") as archive:
+            archive.seek(os.path.getsize(archive_file) // 2)
+            archive.write(b"\x00" * 8)
+        code, _, _ = self.bchoc("verify", "--full")
+        self.assertEqual(code, 1)
+
+    # archivers and expanders running side by side each write their own temporary file
+    def test_concurrent_archivers(self):
+        self.build_chain()
+        segments = self.read_segments()
+        log = self.bchoc_ok("log")
+        for command in ("archive", "expand"):
+            workers = [
+                subprocess.Popen([sys.executable, BCHOC, command], stdout=subprocess.DEVNULL, env=self.env)
+                for _ in range(4)
+            ]
+            self.assertEqual([worker.wait() for worker in workers], [0, 0, 0, 0])
+            self.assertEqual(glob.glob(self.chain_path + "*.tmp"), [])
+            self.assertEqual(self.bchoc_ok("log"), log)
+            self.assert_engines_agree(self.verify_all("--full"), 0)
+        self.assertEqual(self.read_segments(), segments)
+
+    # the blocks stand when the active segment can't be cut, the failure is reported once and retried
+    def test_cut_without_hard_links(self):
+        result = subprocess.run(
+            [sys.executable, "-c", NO_LINKS_SCRIPT, os.path.dirname(BCHOC), CASE_ID],
+            env=self.env,
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(
+            result.stdout, "1\nblockchain could not be cut: [Errno 95] Operation not supported\n2\n", result.stderr
+        )
+        self.assertEqual(
+            result.stderr, "Warning: the blockchain segment could not be cut: [Errno 95] Operation not supported\n"
+        )
+        self.assertEqual(len(self.bchoc_ok("log").split("\n\n")), 42)
+        self.assert_engines_agree(self.verify_all("--full"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import importlib.util
+import unittest
+from hashlib import sha1
+from uuid import UUID
+
+from chaintest import BLOCK_STRUCT, CASE_ID, OTHER_CASE_ID, ChainTestCase
+
+JANUARY = 1704844800  # 2024-01-10T00:00:00Z
+FEBRUARY = 1706745600  # 2024-02-01T00:00:00Z
+
+
+@unittest.skipIf(importlib.util.find_spec("numpy") is None, "stats needs NumPy")
+class StatsTest(ChainTestCase):
+    # append a block linked to the last one, with the given time and case
+    def append_block(self, evidence_id, state, timestamp, case_id):
+        last_block = self.read_blocks()[-1][1]
+        case = UUID(case_id).int.to_bytes(16, byteorder="little")
+        block = BLOCK_STRUCT.pack(sha1(last_block).digest(), timestamp, case, evidence_id, state.ljust(11, b"\0"), 0)
+        with open(self.chain_path, "ab") as chain:
+            chain.write(block)
+
+    def test_stats(self):
+        self.bchoc_ok("init")
+        self.append_block(1, b"CHECKEDIN", JANUARY, CASE_ID)
+        self.append_block(2, b"CHECKEDIN", JANUARY + 60, OTHER_CASE_ID)
+        self.append_block(1, b"CHECKEDOUT", JANUARY + 864000, CASE_ID)
+        self.append_block(1, b"CHECKEDIN", JANUARY + 864100, CASE_ID)
+        self.append_block(1, b"CHECKEDOUT", FEBRUARY, CASE_ID)
+        self.append_block(2, b"DISPOSED", FEBRUARY + 60, OTHER_CASE_ID)
+        self.append_block(1, b"RELEASED", FEBRUARY + 300, CASE_ID)
+        self.append_block(3, b"CHECKEDIN", FEBRUARY + 1209600, CASE_ID)
+        stats = (
+            "Transactions in blockchain: 9\n"
+            "Items: 3\n"
+            "Items per state:\n"
+            "  CHECKEDIN: 1\n"
+            "  DISPOSED: 1\n"
+            "  RELEASED: 1\n"
+            "Items per case:\n"
+            "  %s: 1\n"
+            "  %s: 2\n"
+            "Blocks per month:\n"
+            "  2024-01: CHECKEDIN 3, CHECKEDOUT 1\n"
+            "  2024-02: CHECKEDIN 1, CHECKEDOUT 1, DISPOSED 1, RELEASED 1\n"
+            "Checkouts: 2\n"
+            "  Time checked out: 400.0s (mean 200.0s, longest 300.0s)\n"
+        ) % (OTHER_CASE_ID, CASE_ID)
+        self.assertEqual(self.bchoc_ok("stats"), stats)
+        self.remove_sidecars()
+        self.assertEqual(self.bchoc_ok("stats"), stats)
+
+    # an item still checked out counts as out until now
+    def test_open_checkout(self):
+        self.bchoc_ok("add", "-c", CASE_ID, "-i", "1")
+        self.bchoc_ok("checkout", "-i", "1")
+        lines = self.bchoc_ok("stats").splitlines()
+        self.assertEqual(lines[-2], "Checkouts: 1")
+        self.assertRegex(lines[-1], r"^  Time checked out: (\d+\.\d)s \(mean \1s, longest \1s\)$")
+
+    def test_empty_chain(self):
+        self.bchoc_ok("init")
+        self.assertEqual(
+            self.bchoc_ok("stats"),
+            "Transactions in blockchain: 1\nItems: 0\nItems per state:\nItems per case:\nBlocks per month:\n"
+            "Checkouts: 0\n",
+        )
+        self.assertEqual(self.bchoc("stats", "-x")[0], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import os
+import struct
+import subprocess
+import sys
+import unittest
+
+from chaintest import BCHOC, BLOCK_STRUCT, CASE_ID, ChainTestCase
+
+# Verifies the chain with NumPy unavailable, so only the default engine can run
+WITHOUT_NUMPY_SCRIPT = """
+import sys
+sys.path.insert(0, sys.argv[1])
+import bchoc
+bchoc.load_numpy = lambda: None
+print(bchoc.ChainOfCustody().verify(full=True).block_count)
+"""
+
+
+class VerifyEnginesTest(ChainTestCase):
+    def test_clean_chain(self):
+        self.build_chain()
+        results = self.verify_all("--full")
+        self.assert_engines_agree(results, 0)
+        self.assertIn("CLEAN", next(iter(results.values()))[1])
+
+    # the numpy engine is opt-in, verify runs the python engine unless --engine numpy is given
+    def test_default_engine(self):
+        self.build_chain()
+        result = subprocess.run(
+            [sys.executable, "-c", WITHOUT_NUMPY_SCRIPT, os.path.dirname(BCHOC)],
+            env=self.env,
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(result.stdout, "82\n", result.stderr)
+        self.assertEqual(self.bchoc("verify", "--full")[:2], self.bchoc("verify", "--full", "--engine", "python")[:2])
+
+    def test_broken_link(self):
+        self.build_chain()
+        offset, block = self.read_blocks()[30]
+        with open(self.chain_path, "r+b") as chain:
+            chain.seek(offset)
+            chain.write(bytes(20))
+        self.assert_engines_agree(self.verify_all("--full"), 1)
+
+    def test_double_checkout(self):
+        self.build_chain()
+        self.append_linked_block(3, b"CHECKEDOUT\0")
+        self.remove_sidecars()
+        self.assert_engines_agree(self.verify_all("--full"), 1)
+
+    def test_invalid_state(self):
+        self.build_chain()
+        self.append_linked_block(1, b"BOGUS\0\0\0\0\0\0")
+        self.assert_engines_agree(self.verify_all("--full"), 1)
+
+    def test_removed_item_returns(self):
+        self.build_chain()
+        self.append_linked_block(2, b"CHECKEDIN\0\0")
+        self.assert_engines_agree(self.verify_all("--full"), 1)
+
+    def test_released_without_owner(self):
+        self.build_chain()
+        self.append_linked_block(1, b"RELEASED\0\0\0")
+        self.assert_engines_agree(self.verify_all("--full"), 1)
+
+    # sidecars are caches, pointing them at other blocks must not change what verify finds
+    def test_tampered_offset_index(self):
+        self.build_chain()
+        self.append_linked_block(3, b"CHECKEDOUT\0")
+        # Point the forged block's offset at the block adding item 3, which would make its states look valid
+        added_offset = next(
+            offset for offset, block in self.read_blocks() if BLOCK_STRUCT.unpack(block[: BLOCK_STRUCT.size])[3] == 3
+        )
+        self.bchoc("log", "-r", "-n", "1")
+        with open(self.chain_path + ".off", "r+b") as offsets_file:
+            offsets_file.seek(-8, os.SEEK_END)
+            offsets_file.write(struct.pack("<Q", added_offset))
+        self.assert_engines_agree(self.verify_all("--full"), 1)
+        self.assert_engines_agree(self.verify_all(), 1)
+
+    # parallel runs split the chain at offsets of the offset index, splits inside blocks must not change
+    # the verdict
+    def test_misaligned_offset_index(self):
+        self.build_chain()
+        self.bchoc_ok("log", "-r", "-n", "1")
+        expected = self.verify_all("--full")
+        self.assert_engines_agree(expected, 0)
+        with open(self.chain_path + ".off", "rb") as offsets_file:
+            index = offsets_file.read()
+        header_size = struct.calcsize("<4s Q 20s d ? 7x")
+        offsets = struct.unpack("<%dQ" % ((len(index) - header_size) // 8), index[header_size:])
+        for shift in (4, 20, 36):
+            shifted = struct.pack("<%dQ" % len(offsets), *[offset + shift for offset in offsets])
+            with open(self.chain_path + ".off", "wb") as offsets_file:
+                offsets_file.write(index[:header_size] + shifted)
+            self.assertEqual(self.verify_all("--full"), expected, shift)
+
+    def test_tampered_index_and_postings(self):
+        self.build_chain()
+        self.bchoc_ok("log", "-c", CASE_ID)
+        self.bchoc_ok("log", "-r", "-n", "1")
+        self.bchoc_ok("status", "-i", "1")
+        expected = self.verify_all("--full")
+        for suffix in (".idx", ".pst", ".off"):
+            with open(self.chain_path + suffix, "r+b") as sidecar:
+                sidecar.seek(os.path.getsize(self.chain_path + suffix) // 2)
+                sidecar.write(b"\xff" * 16)
+        self.assertEqual(self.verify_all("--full"), expected)
+        self.assert_engines_agree(expected, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()